@@ -0,0 +1,90 @@
+import argparse, asyncio, logging, os, sqlite3, sys, tempfile, time
+import aiosqlite
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db.db import DatabaseManager
+
+# Queries per second of the DatabaseManager lookups and single-row updates: one aiosqlite connection opened per call on a
+# rollback-journal file (how every method worked before the pool) against the persistent WAL-mode connection pool.
+# Usage: python benchmarks/db_benchmark.py [--users 200] [--operations 2000] [--concurrency 1]
+
+
+# Per-call connection versions of user_exists and update_last_price, as they were before the pool
+
+async def user_exists_per_call(db_name: str, chat_id: int):
+    async with aiosqlite.connect(db_name) as db:
+        async with db.execute('SELECT id FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
+            return await cursor.fetchone()
+
+async def update_last_price_per_call(db_name: str, asin: str, new_last_price: float) -> None:
+    async with aiosqlite.connect(db_name) as db:
+        await db.execute('UPDATE ASIN SET last_price = ? WHERE asin = ?', (new_last_price, asin))
+        await db.commit()
+
+# Runs operations calls of operation(i), concurrency at a time, and returns the calls per second
+
+async def measure(operation, operations: int, concurrency: int) -> float:
+
+    counter = iter(range(operations))
+
+    async def worker():
+        for i in counter:
+            await operation(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return operations / (time.perf_counter() - started)
+
+async def seed(db: DatabaseManager, users: int) -> None:
+
+    await db.create_tables()
+
+    for chat_id in range(1, users + 1):
+        await db.add_user(chat_id)
+        await db.add_asin(f"B0{chat_id:08d}", f"Product {chat_id}", 10.0)
+        await db.link_user_to_asin(chat_id, f"B0{chat_id:08d}", 9)
+
+async def main(users: int, operations: int, concurrency: int) -> None:
+
+    logger = logging.getLogger("benchmark")
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        db_name = os.path.join(directory, "benchmark.db")
+        db = DatabaseManager(logger, db_name = db_name)
+        await seed(db, users)
+        await db.close()
+
+        # the per-call connections run on the journal mode the file had before the pool switched it to WAL
+
+        with sqlite3.connect(db_name) as connection:
+            connection.execute('PRAGMA journal_mode = DELETE')
+
+        results = {
+            "lookup per-call": await measure(lambda i: user_exists_per_call(db_name, i % users + 1), operations, concurrency),
+            "update per-call": await measure(lambda i: update_last_price_per_call(db_name, f"B0{i % users + 1:08d}", float(i)), operations, concurrency),
+            "lookup pooled": await measure(lambda i: db.user_exists(i % users + 1), operations, concurrency),
+            "update pooled": await measure(lambda i: db.update_last_price(f"B0{i % users + 1:08d}", float(i)), operations, concurrency),
+        }
+
+        await db.close()
+
+    print(f"{users} users, {operations} operations, concurrency {concurrency}")
+
+    for name, rate in results.items():
+        print(f"{name:<18}{rate:>10.0f} queries/s")
+
+    print(f"lookup speedup {results['lookup pooled'] / results['lookup per-call']:.1f}x, "
+          f"update speedup {results['update pooled'] / results['update per-call']:.1f}x")
+
+
+if __name__ == "__main__":
+
+    arguments = argparse.ArgumentParser(description = "DatabaseManager connection pool benchmark")
+    arguments.add_argument("--users", type = int, default = 200)
+    arguments.add_argument("--operations", type = int, default = 2000)
+    arguments.add_argument("--concurrency", type = int, default = 1)
+    options = arguments.parse_args()
+
+    asyncio.run(main(options.users, options.operations, options.concurrency))
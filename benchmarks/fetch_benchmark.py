@@ -0,0 +1,95 @@
+import argparse, asyncio, gzip, logging, os, sys, time
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts.client import WebRequest
+from scripts.scraper import ProductPageWatcher, parse_page
+from benchmarks.parser_benchmark import URL, load_pages
+
+# Bytes transferred and wall time per product of a full fetch against a streaming fetch (stopped by ProductPageWatcher)
+# on the saved product pages of tests/fixtures/pages. Every page is served through an httpx MockTransport in chunks,
+# paced to the given bandwidth after a first-byte latency, and fetched with WebRequest.make_request then parsed.
+# Usage: python benchmarks/fetch_benchmark.py [--bandwidth 2.0] [--latency 0.05] [--chunk 16] [--gzip] [--repeat 3]
+
+
+# Response body sent chunk by chunk at the given pace, counting the bytes the client actually pulled
+
+class PacedBody(httpx.AsyncByteStream):
+
+    def __init__(self, content: bytes, chunk_size: int, bandwidth: float, sent: list):
+        self.content = content
+        self.chunk_size = chunk_size
+        self.bandwidth = bandwidth
+        self.sent = sent
+
+    async def __aiter__(self):
+
+        for start in range(0, len(self.content), self.chunk_size):
+
+            chunk = self.content[start:start + self.chunk_size]
+            await asyncio.sleep(len(chunk) / self.bandwidth)
+            self.sent[0] += len(chunk)
+            yield chunk
+
+
+async def fetch(client: WebRequest, streaming: bool) -> tuple:
+
+    started = time.perf_counter()
+    response = await client.make_request("GET", URL, stream_until = ProductPageWatcher if streaming else None)
+    product_data, _ = parse_page(URL, response.request_content.content, "lxml")
+
+    return product_data, time.perf_counter() - started
+
+
+async def measure(content: bytes, streaming: bool, options: argparse.Namespace) -> tuple:
+
+    body = gzip.compress(content) if options.gzip else content
+    sent = [0]
+
+    async def serve(request: httpx.Request) -> httpx.Response:
+
+        await asyncio.sleep(options.latency)
+
+        return httpx.Response(200, headers = {"Content-Encoding": "gzip"} if options.gzip else {},
+                              stream = PacedBody(body, options.chunk * 1024, options.bandwidth * 1048576, sent))
+
+    client = WebRequest(logging.getLogger("benchmark"))
+    client.session.pools["amazon"].client = httpx.AsyncClient(transport = httpx.MockTransport(serve))
+    results = list()
+
+    try:
+        for _ in range(options.repeat):
+            sent[0] = 0
+            product_data, elapsed = await fetch(client, streaming)
+            results.append((product_data, sent[0], elapsed))
+    finally:
+        await client.close()
+
+    return results[0][0], min(result[1] for result in results), min(result[2] for result in results)
+
+
+def main(options: argparse.Namespace) -> None:
+
+    print(f"{options.bandwidth} MB/s, {options.latency * 1000:.0f} ms first byte, {options.chunk} KB chunks, {'gzip' if options.gzip else 'identity'} body")
+    print(f"{'page':<24}{'size':>9}{'full bytes':>13}{'full time':>12}{'stream bytes':>15}{'stream time':>14}{'saved':>8}{'same product':>14}")
+
+    for name, content in load_pages().items():
+
+        full_product, full_bytes, full_time = asyncio.run(measure(content, False, options))
+        stream_product, stream_bytes, stream_time = asyncio.run(measure(content, True, options))
+
+        print(f"{name:<24}{len(content) // 1024:>7}KB{full_bytes // 1024:>11}KB{full_time * 1000:>10.1f}ms{stream_bytes // 1024:>13}KB"
+              f"{stream_time * 1000:>12.1f}ms{1 - stream_bytes / full_bytes:>8.0%}{'yes' if stream_product == full_product else 'NO':>14}")
+
+
+if __name__ == "__main__":
+
+    arguments = argparse.ArgumentParser(description = "Streaming against full product page fetch benchmark")
+    arguments.add_argument("--bandwidth", type = float, default = 2.0, help = "MB/s the stand-in server sends at")
+    arguments.add_argument("--latency", type = float, default = 0.05, help = "seconds before the first byte")
+    arguments.add_argument("--chunk", type = int, default = 16, help = "KB per chunk sent")
+    arguments.add_argument("--gzip", action = "store_true", help = "send the pages gzip-compressed, as amazon.it does")
+    arguments.add_argument("--repeat", type = int, default = 3, help = "fetches per page and mode, the best one is reported")
+
+    main(arguments.parse_args())
@@ -0,0 +1,181 @@
+import argparse, asyncio, ctypes, json, logging, os, resource, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from lxml import html
+from scripts.client import HTTPResponse
+from scripts.scraper import ProductParser, extract_product_fast, parse_page
+
+# Parses per second and peak memory per page of every parser mode on the saved product pages of tests/fixtures/pages.
+# Peak memory is the growth of the maximum resident set size while parsing the page once, since the lxml tree
+# lives in libxml2 where tracemalloc cannot see it (resource is only available on Unix).
+# The "original" mode is the parser before the precompiled XPath engine, five absolute expressions over the whole page.
+# With --workers it measures the ProductParser backends instead: parses per second through parse_product_data on the event
+# loop (0) or with that many parser processes, and the event-loop lag meanwhile.
+# Usage: python benchmarks/parser_benchmark.py [--seconds 1.0] [--modes original lxml fast] [--workers 0 1 2 4 [--parser-mode lxml]]
+
+PAGES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "fixtures", "pages")
+URL = "https://www.amazon.it/dp/B0EXAMPLE1"
+
+def parse_original(content: bytes) -> tuple:
+
+    html_tree = html.fromstring(content)
+
+    return (
+        html_tree.xpath("normalize-space(//span[@id='productTitle']/text())"),
+        html_tree.xpath("//div[@id='apex_desktop']//div[@id='corePriceDisplay_desktop_feature_div']//span[@class='a-price-whole']/text()"),
+        html_tree.xpath("//div[@id='apex_desktop']//div[@id='corePriceDisplay_desktop_feature_div']//span[@class='a-price-fraction']/text()"),
+        html_tree.xpath("normalize-space(//div[@id='merchantInfoFeature_feature_div']/div[@class='offer-display-feature-text']/div[@class='offer-display-feature-text a-spacing-none ']/span[@class='a-size-small offer-display-feature-text-message']//text())"),
+        html_tree.xpath("normalize-space(//div[@id='averageCustomerReviews_feature_div']//span[@id='acrPopover']/span[@class='a-declarative']/a[@class='a-popover-trigger a-declarative']/span[@class='a-size-base a-color-base']/text())")
+    )
+
+def parse(content: bytes, mode: str) -> None:
+
+    if mode == "original":
+        parse_original(content)
+    else:
+        parse_page(URL, content, mode)
+
+def load_pages() -> dict:
+
+    with open(os.path.join(PAGES, "expected.json"), encoding = "utf-8") as file:
+        names = sorted(json.load(file))
+
+    pages = dict()
+
+    for name in names:
+        with open(os.path.join(PAGES, name), "rb") as file:
+            pages[name] = file.read()
+
+    return pages
+
+# Parses the page for about the given time and returns the parses per second
+
+def parses_per_second(content: bytes, mode: str, seconds: float) -> float:
+
+    parses = 0
+    started = time.perf_counter()
+
+    while time.perf_counter() - started < seconds:
+        parse(content, mode)
+        parses += 1
+
+    return parses / (time.perf_counter() - started)
+
+# KiB the resident set grows by while the page is parsed once. With glibc the free heap is
+# handed back first so the parse cannot hide in it, and on Linux the high-water mark is reset to the current resident set.
+# Elsewhere the peak left by the imports may hide part of the growth
+
+def peak_memory(content: bytes, mode: str) -> int:
+
+    parse(b"<html><body></body></html>", mode)  # loads the parser code before the baseline
+
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    parse(content, mode)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+def main(seconds: float, modes: list) -> None:
+
+    pages = load_pages()
+
+    print(f"{'page':<24}{'size':>9}{'fast path':>11}" + "".join(f"{mode + ' parses/s':>22}{mode + ' peak':>16}" for mode in modes))
+
+    for name, content in pages.items():
+
+        row = f"{name:<24}{len(content) // 1024:>7}KB{'hit' if extract_product_fast(URL, content) is not None else 'fallback':>11}"
+
+        for mode in modes:
+
+            row += f"{parses_per_second(content, mode, seconds):>22.1f}{peak_memory(content, mode):>14}KB"
+
+        print(row)
+
+# Keeps two pages in flight per parser process (one on the loop) for about the given time, while a 10 ms timer measures
+# how late the event loop runs it. Returns the parses per second, the 99th percentile and the worst lag in seconds
+
+async def pool_throughput(parser: ProductParser, responses: list, seconds: float) -> tuple:
+
+    loop = asyncio.get_running_loop()
+    lags = list()
+    parses = 0
+
+    async def heartbeat() -> None:
+
+        while True:
+            tick = loop.time()
+            await asyncio.sleep(0.01)
+            lags.append(loop.time() - tick - 0.01)
+
+    async def feed(offset: int) -> None:
+
+        nonlocal parses
+
+        while loop.time() < deadline:
+            await parser.parse_product_data(responses[(offset + parses) % len(responses)])
+            parses += 1
+
+    ticker = asyncio.ensure_future(heartbeat())
+    await asyncio.sleep(0.02)
+    started = loop.time()
+    deadline = started + seconds
+
+    await asyncio.gather(*[feed(offset) for offset in range(max(1, parser.workers) * 2)])
+
+    elapsed = loop.time() - started
+    await asyncio.sleep(0.02)  # a timer held up until the end (parsing on the loop never yields) still counts
+    ticker.cancel()
+    lags.sort()
+
+    return parses / elapsed, lags[int(len(lags) * 0.99)] if lags else 0.0, lags[-1] if lags else 0.0
+
+def pool_main(seconds: float, mode: str, worker_counts: list) -> None:
+
+    responses = list()
+
+    for content in load_pages().values():
+        response = httpx.Response(200, content = content, request = httpx.Request("GET", URL))
+        responses.append(HTTPResponse(url = response.url, status_code = 200, headers = {}, request_content = response))
+
+    print(f"{os.cpu_count()} cores, {mode} mode, {len(responses)} pages")
+    print(f"{'workers':<10}{'parses/s':>12}{'speedup':>10}{'loop lag p99':>15}{'loop lag max':>15}")
+
+    baseline = None
+
+    for workers in worker_counts:
+
+        parser = ProductParser(logging.getLogger("benchmark"), mode = mode, workers = workers)  # forks before the event loop, like the monitor
+
+        try:
+            rate, p99, worst = asyncio.run(pool_throughput(parser, responses, seconds))
+        finally:
+            parser.close()
+
+        baseline = baseline or rate
+        print(f"{workers:<10}{rate:>12.1f}{rate / baseline:>9.2f}x{p99 * 1000:>13.1f}ms{worst * 1000:>13.1f}ms")
+
+
+if __name__ == "__main__":
+
+    arguments = argparse.ArgumentParser(description = "Product page parser benchmark")
+    arguments.add_argument("--seconds", type = float, default = 1.0, help = "time spent parsing each page in each mode")
+    arguments.add_argument("--modes", nargs = "+", default = ["original", "lxml", "fast"], choices = ["original", "lxml", "fast", "diff"])
+    arguments.add_argument("--workers", nargs = "+", type = int, help = "parser process counts to compare, 0 parses on the event loop")
+    arguments.add_argument("--parser-mode", default = "lxml", choices = ["lxml", "fast", "diff"], help = "parser mode of the --workers runs")
+    options = arguments.parse_args()
+
+    if options.workers:
+        pool_main(options.seconds, options.parser_mode, options.workers)
+    else:
+        main(options.seconds, options.modes)
@@ -1,290 +1,1020 @@
-import aiosqlite
-from typing import Callable
-
-
-# Class assigned to manage the creation and queries of the database
-
-class DatabaseManager:
-     
-     __slots__ = ('logger', 'db_name', 'initialized')
-    
-     _instance = None  
-
-     def __new__(cls, *args, **kwargs):
-
-        if cls._instance is None:
-            cls._instance = super(DatabaseManager, cls).__new__(cls)
-
-        return cls._instance
-
-     def __init__(self, logger: Callable, db_name="db/amazon_bot.db"):
-
-        if not hasattr(self, 'initialized'):  
-            self.db_name = db_name
-            self.logger = logger
-            self.initialized = True  
-    
-
-     async def create_tables(self) -> None:
-        
-        async with aiosqlite.connect(self.db_name) as db:
-
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS User (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE,
-                    email TEXT NULL
-                )
-            ''')
-
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS ASIN (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    asin TEXT UNIQUE,
-                    title TEXT,
-                    last_price REAL
-                )
-            ''')
-
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS UserToAsin (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    asin_id INTEGER,
-                    target_price REAL,
-                    FOREIGN KEY (user_id) REFERENCES User(id),
-                    FOREIGN KEY (asin_id) REFERENCES ASIN(id)
-                )
-            ''')
-
-            await db.commit()
-            self.logger.info("Database: Successfully Created Tables")
-    
-     async def add_user(self, chat_id: int) -> None:
-
-        async with aiosqlite.connect(self.db_name) as db:
-
-            await db.execute('''
-                INSERT OR IGNORE INTO User (chat_id) 
-                VALUES (?)
-            ''', (chat_id,))
-
-            await db.commit()
-            self.logger.info(f"Database: Successfully Added User {chat_id}")
-    
-     async def add_asin(self, asin: str, title = "N/A", current_price=0.0) -> None:
-
-        async with aiosqlite.connect(self.db_name) as db:
-
-            await db.execute('''
-                INSERT OR IGNORE INTO ASIN (asin, title, last_price) 
-                VALUES (?, ?, ?)
-            ''', (asin, title, current_price))
-
-            await db.commit()
-            self.logger.info(f"Database: Successfully Added ASIN {asin}")
-    
-     async def add_email(self, email: str, chat_id: int) -> None:
-         
-         async with aiosqlite.connect(self.db_name) as db:
-             
-             await db.execute('''
-                  UPDATE User
-                  SET email = ?
-                  WHERE chat_id = ?
-            ''', (email, chat_id))
-
-             await db.commit()
-    
-     async def delete_email(self, chat_id: int) -> None:
-         
-         async with aiosqlite.connect(self.db_name) as db:
-             
-             await db.execute('''
-                  UPDATE User
-                  SET email = NULL
-                  WHERE chat_id = ?
-            ''', (chat_id,))
-
-             await db.commit()
-         
-    
-     async def update_last_price(self, asin: str, new_last_price: int) -> None:
-         
-        async with aiosqlite.connect(self.db_name) as db:
-
-            await db.execute('''
-                  UPDATE ASIN
-                  SET last_price = ?
-                  WHERE asin = ?
-            ''', (new_last_price, asin))
-
-            await db.commit()
-    
-     async def update_title(self, asin: str, new_title: str) -> None:
-         
-         async with aiosqlite.connect(self.db_name) as db:
-             
-            await db.execute('''
-                  UPDATE ASIN
-                  SET title = ?
-                  WHERE asin = ?
-            ''', (new_title, asin))
-
-            await db.commit()
-    
-     async def get_all_asins(self) -> list:
-        
-        async with aiosqlite.connect(self.db_name) as db:
-
-            async with db.execute('SELECT asin FROM ASIN') as cursor:
-
-                rows = await cursor.fetchall()
-                asins = [row[0] for row in rows]
-                return asins
-        
-     async def get_all_users(self) -> list:
-         
-         async with aiosqlite.connect(self.db_name) as db:
-             
-            async with db.execute('SELECT chat_id FROM User') as cursor:
-
-                rows = await cursor.fetchall()
-                users = [row[0] for row in rows]
-                return users
-    
-     async def get_email_status(self, chat_id: int) -> str:
-         
-         async with aiosqlite.connect(self.db_name) as db:
-             
-             async with db.execute('SELECT email FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
-                 
-                email = await cursor.fetchone()
-                if email is None:
-                    return None
-                return email[0]
-    
-     async def link_user_to_asin(self, chat_id: int, asin: str, target_price: int) -> None:
-
-        async with aiosqlite.connect(self.db_name) as db:
-
-            async with db.execute('SELECT id FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
-                user_id = await cursor.fetchone()
-                if user_id is None:
-                    raise ValueError("User not found")
-                user_id = user_id[0]
-
-            async with db.execute('SELECT id FROM ASIN WHERE asin = ?', (asin,)) as cursor:
-                asin_id = await cursor.fetchone()
-                if asin_id is None:
-                    raise ValueError("ASIN not found")
-                asin_id = asin_id[0]
-
-            await db.execute('''
-                INSERT INTO UserToAsin (user_id, asin_id, target_price) 
-                VALUES (?, ?, ?)
-            ''', (user_id, asin_id, target_price))
-
-            await db.commit()
-            self.logger.info(f"Database: Successfully Added ASIN {asin} to User's {chat_id} monitor list with price target {target_price}€")
-    
-     async def notify_users(self, asin: str, current_price: int) -> list:
-
-        async with aiosqlite.connect(self.db_name) as db:
-
-            async with db.execute('SELECT id, last_price FROM ASIN WHERE asin = ?', (asin,)) as cursor:
-                asin_data = await cursor.fetchone()
-                if asin_data is None:
-                    raise ValueError("ASIN non trovato")
-                asin_id, last_price = asin_data
-            
-            if current_price == last_price:
-                return []
-
-            async with db.execute('''
-                SELECT u.chat_id
-                FROM UserToAsin uta
-                JOIN User u ON uta.user_id = u.id
-                WHERE uta.asin_id = ? 
-                AND (uta.target_price >= ?)
-            ''', (asin_id, current_price)) as cursor:
-                user_list = await cursor.fetchall()
-                
-            return user_list
-    
-     async def get_monitored_products_by_user(self, chat_id: int) -> dict:
-   
-        async with aiosqlite.connect(self.db_name) as db:
-      
-             async with db.execute('SELECT id FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
-                user_id = await cursor.fetchone()
-                if user_id is None:
-                    return []
-                user_id = user_id[0]
-
-
-             async with db.execute('''
-                SELECT a.asin, a.title, a.last_price, uta.target_price
-                FROM UserToAsin uta
-                JOIN ASIN a ON uta.asin_id = a.id
-                WHERE uta.user_id = ?
-                ''', (user_id,)) as cursor:
-                rows = await cursor.fetchall()
-
-        monitored_products = []
-        for row in rows:
-            monitored_products.append({
-                "asin" : row[0],
-                "title" : row[1],
-                "last_price" : row[2],
-                "target_price" : row[3]
-            })
-
-        return monitored_products
-    
-     async def delete_link(self, chat_id: int, asin: str) -> None:
-
-        async with aiosqlite.connect(self.db_name) as db:
- 
-            async with db.execute('SELECT id FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
-                user_id = await cursor.fetchone()
-                if user_id is None:
-                    raise ValueError("Utente non trovato")
-                user_id = user_id[0]
-
-       
-            async with db.execute('SELECT id FROM ASIN WHERE asin = ?', (asin,)) as cursor:
-                asin_id = await cursor.fetchone()
-                if asin_id is None:
-                    raise ValueError("ASIN non trovato")
-                asin_id = asin_id[0]
-
-           
-            await db.execute('''
-                DELETE FROM UserToAsin 
-                WHERE user_id = ? AND asin_id = ?
-            ''', (user_id, asin_id))
-
-            await db.commit()
-            self.logger.info(f"Database: Successfully Removed ASIN {asin} to User's {chat_id} monitor list")
-        
-     async def user_exists(self, chat_id: int) -> bool:
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute('SELECT id FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
-                return await cursor.fetchone()
-
-     async def asin_exists(self, asin: str) -> bool:
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute('SELECT id FROM ASIN WHERE asin = ?', (asin,)) as cursor:
-                return await cursor.fetchone()
-
-     async def link_exists(self, chat_id: int, asin: str) -> bool:
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute('''
-                SELECT UserToAsin.id 
-                FROM UserToAsin
-                JOIN User ON User.id = UserToAsin.user_id
-                JOIN ASIN ON ASIN.id = UserToAsin.asin_id
-                WHERE User.chat_id = ? AND ASIN.asin = ?
-            ''', (chat_id, asin)) as cursor:
+import asyncio, json, os, time
+import aiosqlite
+from contextlib import asynccontextmanager
+from typing import Callable, AsyncIterator
+from config.settings import (
+    DATABASE_POOL_SIZE,
+    DATABASE_BUSY_TIMEOUT,
+    DATABASE_CACHE_SIZE,
+    DATABASE_MMAP_SIZE,
+    WRITE_BUFFER_MAX_SIZE,
+    WRITE_BUFFER_MAX_AGE,
+    ALERT_DIGEST,
+    ALERT_DIGEST_WINDOW,
+    ALERT_MIN_DROP,
+    ALERT_MIN_DROP_PERCENT,
+    ALERT_COOLDOWN
+)
+
+
+# Schema migrations, applied in order by DatabaseManager.create_tables(). Never edit a released entry, append a new one instead
+
+SCHEMA_MIGRATIONS = (
+
+    # 1: initial schema
+
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS User (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER UNIQUE,
+            email TEXT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ASIN (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            asin TEXT UNIQUE,
+            title TEXT,
+            last_price REAL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS UserToAsin (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            asin_id INTEGER,
+            target_price REAL,
+            FOREIGN KEY (user_id) REFERENCES User(id),
+            FOREIGN KEY (asin_id) REFERENCES ASIN(id)
+        )
+        ''',
+    ),
+
+    # 2: one link per user and product, covering index for the notification filter
+
+    (
+        '''
+        DELETE FROM UserToAsin
+        WHERE id NOT IN (SELECT MIN(id) FROM UserToAsin GROUP BY user_id, asin_id)
+        ''',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_usertoasin_user_asin
+        ON UserToAsin (user_id, asin_id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_usertoasin_asin_target
+        ON UserToAsin (asin_id, target_price, user_id)
+        ''',
+    ),
+
+    # 3: subscriber count per product, kept in sync by triggers on UserToAsin, so the monitor skips products nobody watches
+
+    (
+        '''
+        ALTER TABLE ASIN ADD COLUMN subscribers INTEGER NOT NULL DEFAULT 0
+        ''',
+        '''
+        UPDATE ASIN
+        SET subscribers = (SELECT COUNT(*) FROM UserToAsin WHERE UserToAsin.asin_id = ASIN.id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_asin_watched
+        ON ASIN (asin) WHERE subscribers > 0
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_usertoasin_subscribe AFTER INSERT ON UserToAsin
+        BEGIN
+            UPDATE ASIN SET subscribers = subscribers + 1 WHERE id = NEW.asin_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_usertoasin_unsubscribe AFTER DELETE ON UserToAsin
+        BEGIN
+            UPDATE ASIN SET subscribers = subscribers - 1 WHERE id = OLD.asin_id;
+        END
+        ''',
+    ),
+
+    # 4: work distribution leases, one row per product telling which worker holds it, until when, and when it is next due
+
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS AsinLease (
+            asin_id INTEGER PRIMARY KEY,
+            owner TEXT NULL,
+            lease_until REAL NOT NULL DEFAULT 0,
+            due_at REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (asin_id) REFERENCES ASIN(id)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_asinlease_due
+        ON AsinLease (due_at)
+        ''',
+        '''
+        INSERT OR IGNORE INTO AsinLease (asin_id)
+        SELECT id FROM ASIN
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_usertoasin_lease AFTER INSERT ON UserToAsin
+        BEGIN
+            INSERT OR IGNORE INTO AsinLease (asin_id) VALUES (NEW.asin_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_asin_lease_cleanup AFTER DELETE ON ASIN
+        BEGIN
+            DELETE FROM AsinLease WHERE asin_id = OLD.id;
+        END
+        ''',
+    ),
+
+    # 5: transactional alert outbox, rows are written in the transaction of the price update that triggers them
+    # and drained by the AlertDispatcher. The idempotency key is unique among pending rows only, so the same
+    # product, price and recipient is never queued twice while a later price drop to the same price alerts again
+
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS AlertOutbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            email TEXT NULL,
+            asin TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            claimed_until REAL NOT NULL DEFAULT 0,
+            sent_at REAL NULL,
+            last_error TEXT NULL
+        )
+        ''',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_alertoutbox_pending_key
+        ON AlertOutbox (idempotency_key) WHERE status = 'pending'
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_alertoutbox_due
+        ON AlertOutbox (next_attempt_at) WHERE status = 'pending'
+        ''',
+    ),
+
+    # 6: pending alerts by recipient, digests pull in every alert of the recipients they claim
+
+    (
+        '''
+        CREATE INDEX IF NOT EXISTS idx_alertoutbox_recipient
+        ON AlertOutbox (chat_id) WHERE status = 'pending'
+        ''',
+    ),
+
+    # 7: alert hysteresis, the last price and time each subscription was alerted about. A subscription is alerted again
+    # only on a new low under that price, and re-armed once the price goes back above its target
+
+    (
+        '''
+        ALTER TABLE UserToAsin ADD COLUMN last_notified_price REAL NULL
+        ''',
+        '''
+        ALTER TABLE UserToAsin ADD COLUMN last_notified_at REAL NOT NULL DEFAULT 0
+        ''',
+    ),
+
+)
+
+# Statements on the hot lookup paths, shared with DatabaseManager.verify_query_plans() so their plans are checked at startup
+
+NOTIFY_USERS_QUERY = '''
+    SELECT u.chat_id
+    FROM UserToAsin uta
+    JOIN User u ON uta.user_id = u.id
+    WHERE uta.asin_id = ?
+    AND (uta.target_price >= ?)
+'''
+
+MONITORED_PRODUCTS_QUERY = '''
+    SELECT a.asin, a.title, a.last_price, uta.target_price
+    FROM UserToAsin uta
+    JOIN ASIN a ON uta.asin_id = a.id
+    WHERE uta.user_id = ?
+'''
+
+DELETE_LINK_STATEMENT = '''
+    DELETE FROM UserToAsin
+    WHERE user_id = ? AND asin_id = ?
+'''
+
+# Only products with at least one subscriber are worth fetching, the count is maintained by the UserToAsin triggers.
+# The watched products come from the idx_asin_watched partial index and each lowest target from one seek on
+# idx_usertoasin_asin_target, instead of a join grouped over the whole ASIN table
+
+WATCH_STATS_QUERY = '''
+    SELECT a.asin, a.subscribers, (SELECT MIN(uta.target_price) FROM UserToAsin uta WHERE uta.asin_id = a.id)
+    FROM ASIN a
+    WHERE a.subscribers > 0
+'''
+
+LINK_EXISTS_QUERY = '''
+    SELECT UserToAsin.id
+    FROM UserToAsin
+    JOIN User ON User.id = UserToAsin.user_id
+    JOIN ASIN ON ASIN.id = UserToAsin.asin_id
+    WHERE User.chat_id = ? AND ASIN.asin = ?
+'''
+
+CLAIM_DUE_ASINS_QUERY = '''
+    SELECT l.asin_id, a.asin, a.title, a.last_price
+    FROM AsinLease l
+    JOIN ASIN a ON a.id = l.asin_id
+    WHERE l.due_at <= ?
+    AND (l.owner IS NULL OR l.lease_until <= ?)
+    AND a.subscribers > 0
+    ORDER BY l.due_at
+    LIMIT ?
+'''
+
+CLAIM_ALERTS_QUERY = '''
+    SELECT id, channel, chat_id, email, asin, payload, attempts
+    FROM AlertOutbox
+    WHERE status = 'pending'
+    AND next_attempt_at <= ?
+    AND claimed_until <= ?
+    ORDER BY next_attempt_at
+    LIMIT ?
+'''
+
+CLAIM_RECIPIENT_ALERTS_QUERY = '''
+    SELECT id, channel, chat_id, email, asin, payload, attempts
+    FROM AlertOutbox
+    WHERE status = 'pending'
+    AND claimed_until <= ?
+    AND (attempts = 0 OR next_attempt_at <= ?)
+    AND chat_id IN ({chats})
+'''
+
+# Subscriptions alerted by a new price: under the target, a real new low below the last price notified
+# (by at least ALERT_MIN_DROP euros or ALERT_MIN_DROP_PERCENT, whichever is smaller, and at least half a cent) and out
+# of the cooldown. Parameters: the alert_thresholds() below
+
+ALERT_HYSTERESIS_FILTER = '''
+        uta.target_price >= ca.price
+        AND (uta.last_notified_price IS NULL
+             OR ca.price <= uta.last_notified_price - MAX(MIN(?, uta.last_notified_price * ? / 100.0), 0.005))
+        AND uta.last_notified_at <= ?
+'''
+
+# Minimum drop, minimum drop percent and cooldown cutoff of ALERT_HYSTERESIS_FILTER. A threshold left unset (0) stands in
+# as a drop no price can make, so it never undercuts the configured one, unless both are unset
+
+def alert_thresholds(now: float) -> list:
+
+    min_drop, min_drop_percent = ALERT_MIN_DROP, ALERT_MIN_DROP_PERCENT
+
+    if min_drop > 0 or min_drop_percent > 0:
+        min_drop = min_drop if min_drop > 0 else float("inf")
+        min_drop_percent = min_drop_percent if min_drop_percent > 0 else 100.0  # prices are never 0 or less
+
+    return [min_drop, min_drop_percent, now - ALERT_COOLDOWN]
+
+# Resolves the subscribers of every (asin, price, payload) alert of a flush and queues one row per recipient and channel
+
+ENQUEUE_ALERTS_STATEMENT = '''
+    WITH CycleAlert(asin, price, payload) AS (VALUES {values}),
+    Target AS (
+        SELECT ca.asin, ca.price, ca.payload, u.chat_id, u.email
+        FROM CycleAlert ca
+        JOIN ASIN a ON a.asin = ca.asin
+        JOIN UserToAsin uta ON uta.asin_id = a.id
+        JOIN User u ON u.id = uta.user_id
+        WHERE {filter}
+    )
+    INSERT OR IGNORE INTO AlertOutbox (idempotency_key, channel, chat_id, email, asin, payload, created_at, next_attempt_at)
+    SELECT printf('%s:%.2f:%d:telegram', asin, price, chat_id), 'telegram', chat_id, NULL, asin, payload, ?, ?
+    FROM Target
+    UNION ALL
+    SELECT printf('%s:%.2f:%d:email', asin, price, chat_id), 'email', chat_id, email, asin, payload, ?, ?
+    FROM Target
+    WHERE email IS NOT NULL
+'''
+
+# Records the alert on the subscriptions ENQUEUE_ALERTS_STATEMENT just queued, run right after it with the same filter
+
+MARK_NOTIFIED_STATEMENT = '''
+    WITH CycleAlert(asin, price) AS (VALUES {values})
+    UPDATE UserToAsin AS uta
+    SET last_notified_price = ca.price, last_notified_at = ?
+    FROM CycleAlert ca
+    JOIN ASIN a ON a.asin = ca.asin
+    WHERE uta.asin_id = a.id
+    AND {filter}
+'''
+
+# A price back above the target re-arms the subscription, the next drop under it alerts again
+
+REARM_ALERTS_STATEMENT = '''
+    UPDATE UserToAsin
+    SET last_notified_price = NULL
+    WHERE asin_id = (SELECT id FROM ASIN WHERE asin = ?)
+    AND target_price < ?
+    AND last_notified_price IS NOT NULL
+'''
+
+# Scans of the in-memory lists a flush statement is built around, the VALUES list of the cycle's alerts and the CTE over it
+
+LIST_SCANS = ("SCAN ca", "SCAN Target")
+
+HOT_QUERIES = {
+
+    "notify_users": (NOTIFY_USERS_QUERY, (1, 0.0)),
+    "get_monitored_products_by_user": (MONITORED_PRODUCTS_QUERY, (1,)),
+    "delete_link": (DELETE_LINK_STATEMENT, (1, 1)),
+    "link_exists": (LINK_EXISTS_QUERY, (1, "A")),
+    "get_watch_stats": (WATCH_STATS_QUERY, ()),
+    "claim_due_asins": (CLAIM_DUE_ASINS_QUERY, (0.0, 0.0, 1)),
+    "claim_alerts": (CLAIM_ALERTS_QUERY, (0.0, 0.0, 1)),
+    "claim_recipient_alerts": (CLAIM_RECIPIENT_ALERTS_QUERY.format(chats = "?, ?"), (0.0, 0.0, 1, 2)),
+    "rearm_alerts": (REARM_ALERTS_STATEMENT, ("A", 0.0)),
+    "enqueue_alerts": (ENQUEUE_ALERTS_STATEMENT.format(values = "(?, ?, ?), (?, ?, ?)", filter = ALERT_HYSTERESIS_FILTER),
+                       ("A", 1.0, "{}", "B", 1.0, "{}", 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)),
+    "mark_notified": (MARK_NOTIFIED_STATEMENT.format(values = "(?, ?), (?, ?)", filter = ALERT_HYSTERESIS_FILTER),
+                      ("A", 1.0, "B", 1.0, 0.0, 0.0, 0.0, 0.0)),
+
+}
+
+
+# Class assigned to manage the creation and queries of the database
+
+class DatabaseManager:
+
+     __slots__ = ('logger', 'db_name', 'initialized', 'pool_size', 'pool', 'pool_owner',
+                  'pending_prices', 'pending_titles', 'pending_alerts', 'pending_since', 'flush_lock')
+
+     _instance = None
+
+     def __new__(cls, *args, **kwargs):
+
+        if cls._instance is None:
+            cls._instance = super(DatabaseManager, cls).__new__(cls)
+
+        return cls._instance
+
+     def __init__(self, logger: Callable, db_name="db/amazon_bot.db", pool_size: int = DATABASE_POOL_SIZE):
+
+        if not hasattr(self, 'initialized'):
+            self.db_name = db_name
+            self.logger = logger
+            self.pool_size = max(1, pool_size)
+            self.pool = None
+            self.pool_owner = None
+            self.pending_prices = dict()
+            self.pending_titles = dict()
+            self.pending_alerts = dict()
+            self.pending_since = None
+            self.flush_lock = None
+            self.initialized = True
+
+     # Opens a persistent connection tuned for concurrent access from the bot and monitor processes
+
+     async def _open_connection(self) -> aiosqlite.Connection:
+
+        db = await aiosqlite.connect(self.db_name, timeout=DATABASE_BUSY_TIMEOUT / 1000, isolation_level=None)
+
+        await db.execute('PRAGMA journal_mode = WAL')
+        await db.execute('PRAGMA synchronous = NORMAL')
+        await db.execute(f'PRAGMA busy_timeout = {int(DATABASE_BUSY_TIMEOUT)}')
+        await db.execute(f'PRAGMA cache_size = {int(DATABASE_CACHE_SIZE)}')
+        await db.execute(f'PRAGMA mmap_size = {int(DATABASE_MMAP_SIZE)}')
+        await db.execute('PRAGMA temp_store = MEMORY')
+
+        return db
+
+     # The pool belongs to the process and event loop that created it: a forked child or a new asyncio.run() gets a fresh one
+
+     async def _get_pool(self) -> asyncio.Queue:
+
+        owner = (os.getpid(), asyncio.get_running_loop())
+
+        if self.pool is None or self.pool_owner != owner:
+
+            stale_pool = self.pool if self.pool_owner is not None and self.pool_owner[0] == owner[0] else None
+
+            self.pool = asyncio.Queue(maxsize=self.pool_size)
+            self.pool_owner = owner
+            self.flush_lock = asyncio.Lock()
+
+            for _ in range(self.pool_size):
+                self.pool.put_nowait(None)  # connections are opened lazily on first checkout
+
+            if stale_pool is not None:
+                await self._drain(stale_pool)
+
+        return self.pool
+
+     async def _drain(self, pool: asyncio.Queue) -> None:
+
+        while not pool.empty():
+
+            db = pool.get_nowait()
+
+            if db is not None:
+                try:
+                    await db.close()
+                except Exception as e:
+                    self.logger.error(f"Database: Unable to close pooled connection: {e}")
+
+     # Checks out a pooled connection in autocommit mode, every statement outside a transaction is committed on its own
+
+     @asynccontextmanager
+     async def connection(self) -> AsyncIterator[aiosqlite.Connection]:
+
+        pool = await self._get_pool()
+        db = await pool.get()
+
+        try:
+            if db is None:
+                db = await self._open_connection()
+            yield db
+
+        except BaseException:
+            if db is not None and db.in_transaction:
+                await db.rollback()
+            raise
+
+        finally:
+            if pool is self.pool:
+                pool.put_nowait(db)
+            elif db is not None:
+                await db.close()
+
+     # Checks out a pooled connection wrapped in a write transaction, committed on exit and rolled back on error.
+     # BEGIN IMMEDIATE takes the write lock up front so readers upgrading to writers never hit SQLITE_BUSY halfway through
+
+     @asynccontextmanager
+     async def transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+
+        async with self.connection() as db:
+
+            await db.execute('BEGIN IMMEDIATE')
+            yield db
+            await db.commit()
+
+     async def close(self) -> None:
+
+        try:
+            await self.flush_updates()
+        except Exception as e:
+            self.logger.error(f"Database: Unable to flush buffered updates on shutdown: {e}")
+
+        if self.pool is not None and self.pool_owner[0] == os.getpid():
+            pool = self.pool
+            self.pool = None
+            self.pool_owner = None
+            await self._drain(pool)
+            self.logger.info("Database: Successfully Closed Connection Pool")
+
+     # Brings the schema up to the latest version, PRAGMA user_version records how many SCHEMA_MIGRATIONS have been applied.
+     # Everything runs in one write transaction, so concurrent processes never migrate the same file twice
+
+     async def create_tables(self) -> None:
+        
+        async with self.transaction() as db:
+
+            async with db.execute('PRAGMA user_version') as cursor:
+                version = (await cursor.fetchone())[0]
+
+            for target_version, statements in enumerate(SCHEMA_MIGRATIONS[version:], start = version + 1):
+
+                for statement in statements:
+                    await db.execute(statement)
+
+                await db.execute(f'PRAGMA user_version = {target_version}')
+                self.logger.info(f"Database: Successfully Migrated Schema to Version {target_version}")
+
+            self.logger.info("Database: Successfully Created Tables")
+
+     # Runs EXPLAIN QUERY PLAN on the given statements and returns the full table scans of each one that has any.
+     # Shared by the startup check below and the query plan tests
+
+     async def query_plan_scans(self, queries: dict = HOT_QUERIES) -> dict:
+
+        scans = dict()
+
+        async with self.connection() as db:
+
+            for name, (statement, parameters) in queries.items():
+
+                async with db.execute(f'EXPLAIN QUERY PLAN {statement}', parameters) as cursor:
+                    plan = [row[3] for row in await cursor.fetchall()]
+
+                details = [detail for detail in plan if detail.startswith("SCAN") and "INDEX" not in detail and "CONSTANT ROW" not in detail and detail not in LIST_SCANS]
+
+                if details:
+                    scans[name] = details
+
+        return scans
+
+     # Reports any full scan of a table on the hot lookup paths, e.g. after an index went missing
+
+     async def verify_query_plans(self) -> bool:
+
+        scans = await self.query_plan_scans()
+
+        for name, details in scans.items():
+            self.logger.error(f"Database: Query plan of {name} scans a whole table -> {'; '.join(details)} ✗")
+
+        if not scans:
+            self.logger.info("Database: Query plans use indexes on every hot lookup path ✓")
+
+        return not scans
+    
+     async def add_user(self, chat_id: int) -> None:
+
+        async with self.connection() as db:
+
+            await db.execute('''
+                INSERT OR IGNORE INTO User (chat_id) 
+                VALUES (?)
+            ''', (chat_id,))
+
+            self.logger.info(f"Database: Successfully Added User {chat_id}")
+    
+     async def add_asin(self, asin: str, title = "N/A", current_price=0.0) -> None:
+
+        async with self.connection() as db:
+
+            await db.execute('''
+                INSERT OR IGNORE INTO ASIN (asin, title, last_price) 
+                VALUES (?, ?, ?)
+            ''', (asin, title, current_price))
+
+            self.logger.info(f"Database: Successfully Added ASIN {asin}")
+    
+     async def add_email(self, email: str, chat_id: int) -> None:
+         
+         async with self.connection() as db:
+             
+             await db.execute('''
+                  UPDATE User
+                  SET email = ?
+                  WHERE chat_id = ?
+            ''', (email, chat_id))
+
+    
+     async def delete_email(self, chat_id: int) -> None:
+         
+         async with self.connection() as db:
+             
+             await db.execute('''
+                  UPDATE User
+                  SET email = NULL
+                  WHERE chat_id = ?
+            ''', (chat_id,))
+
+         
+    
+     async def update_last_price(self, asin: str, new_last_price: int) -> None:
+         
+        async with self.connection() as db:
+
+            await db.execute('''
+                  UPDATE ASIN
+                  SET last_price = ?
+                  WHERE asin = ?
+            ''', (new_last_price, asin))
+
+    
+     async def update_title(self, asin: str, new_title: str) -> None:
+         
+         async with self.connection() as db:
+             
+            await db.execute('''
+                  UPDATE ASIN
+                  SET title = ?
+                  WHERE asin = ?
+            ''', (new_title, asin))
+
+    
+     # Write-behind buffer: price and title updates are kept in memory (last write wins per ASIN)
+     # and written by flush_updates() in a single transaction. A price passed with an alert payload (the product
+     # snapshot the message is built from) also queues its alerts in the AlertOutbox within that transaction
+
+     async def buffer_last_price(self, asin: str, new_last_price: float, alert: dict = None) -> None:
+
+        self.pending_prices[asin] = new_last_price
+
+        if alert is not None:
+            self.pending_alerts[asin] = (new_last_price, json.dumps(alert))
+        else:
+            self.pending_alerts.pop(asin, None)  # a newer price without alert (e.g. out of stock) replaces the older one
+
+        await self._flush_if_needed()
+
+     async def buffer_title(self, asin: str, new_title: str) -> None:
+
+        self.pending_titles[asin] = new_title
+        await self._flush_if_needed()
+
+     # A failed threshold flush is logged, not raised: the batch is back in the buffer and goes out with the next flush,
+     # while the caller (e.g. a product with both a new title and a new price) still gets to buffer its other updates
+
+     async def _flush_if_needed(self) -> None:
+
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+
+        if (len(self.pending_prices) + len(self.pending_titles) >= WRITE_BUFFER_MAX_SIZE
+                or time.monotonic() - self.pending_since >= WRITE_BUFFER_MAX_AGE):
+
+            try:
+                await self.flush_updates()
+            except Exception as e:
+                self.logger.error(f"Database: Unable to flush buffered updates, retrying on the next flush: {e}")
+
+     async def flush_updates(self) -> int:
+
+        if not self.pending_prices and not self.pending_titles:
+            return 0
+
+        await self._get_pool()
+
+        # Flushes are serialized so an older batch can never commit after a newer one
+
+        async with self.flush_lock:
+
+            prices, self.pending_prices = self.pending_prices, dict()
+            titles, self.pending_titles = self.pending_titles, dict()
+            alerts, self.pending_alerts = self.pending_alerts, dict()
+            self.pending_since = None
+
+            if not prices and not titles:
+                return 0
+
+            try:
+
+                async with self.transaction() as db:
+
+                    await db.executemany('''
+                        UPDATE ASIN
+                        SET last_price = ?
+                        WHERE asin = ?
+                    ''', [(price, asin) for asin, price in prices.items()])
+
+                    await db.executemany('''
+                        UPDATE ASIN
+                        SET title = ?
+                        WHERE asin = ?
+                    ''', [(title, asin) for asin, title in titles.items()])
+
+                    await db.executemany(REARM_ALERTS_STATEMENT, [(asin, price) for asin, price in prices.items() if price > 0])
+
+                    await self._enqueue_alerts(db, list(alerts.items()))
+
+            except Exception:
+
+                # Put the batch back without overwriting anything buffered while the flush was running,
+                # an alert only comes back if its price was not replaced meanwhile
+                for asin, alert in alerts.items():
+                    if asin not in self.pending_prices:
+                        self.pending_alerts[asin] = alert
+                for asin, price in prices.items():
+                    self.pending_prices.setdefault(asin, price)
+                for asin, title in titles.items():
+                    self.pending_titles.setdefault(asin, title)
+                if self.pending_since is None:
+                    self.pending_since = time.monotonic()
+                raise
+
+        self.logger.info(f"Database: Successfully Flushed {len(prices)} price and {len(titles)} title updates, {len(alerts)} alerted products")
+        return len(prices) + len(titles)
+
+     async def _enqueue_alerts(self, db: aiosqlite.Connection, alerts: list, chunk_size: int = 300) -> None:
+
+        now = time.time()
+        due_at = now + (ALERT_DIGEST_WINDOW if ALERT_DIGEST else 0)  # digests wait for the alerts of the window
+
+        for start in range(0, len(alerts), chunk_size):
+
+            chunk = alerts[start:start + chunk_size]
+            values = ", ".join(["(?, ?, ?)"] * len(chunk))
+            parameters = [value for asin, (price, payload) in chunk for value in (asin, price, payload)]
+
+            thresholds = alert_thresholds(now)
+
+            await db.execute(ENQUEUE_ALERTS_STATEMENT.format(values = values, filter = ALERT_HYSTERESIS_FILTER),
+                             parameters + thresholds + [now, due_at, now, due_at])
+
+            await db.execute(MARK_NOTIFIED_STATEMENT.format(values = ", ".join(["(?, ?)"] * len(chunk)), filter = ALERT_HYSTERESIS_FILTER),
+                             [value for asin, (price, payload) in chunk for value in (asin, price)] + [now] + thresholds)
+
+     async def get_all_asins(self) -> list:
+        
+        async with self.connection() as db:
+
+            async with db.execute('SELECT asin FROM ASIN') as cursor:
+
+                rows = await cursor.fetchall()
+                asins = [row[0] for row in rows]
+                return asins
+        
+     # Returns (asin, subscribers, lowest target_price) for every watched product, used by the poll scheduler
+
+     async def get_watch_stats(self) -> list:
+
+        async with self.connection() as db:
+
+            async with db.execute(WATCH_STATS_QUERY) as cursor:
+
+                return await cursor.fetchall()
+
+     # Compaction step: removes products nobody subscribes to any more and returns their ASINs
+
+     async def prune_orphan_asins(self) -> list:
+
+        async with self.transaction() as db:
+
+            async with db.execute('''
+                SELECT asin
+                FROM ASIN
+                WHERE subscribers <= 0
+                AND NOT EXISTS (SELECT 1 FROM UserToAsin WHERE UserToAsin.asin_id = ASIN.id)
+            ''') as cursor:
+                orphans = [row[0] for row in await cursor.fetchall()]
+
+            await db.executemany('DELETE FROM ASIN WHERE asin = ?', [(asin,) for asin in orphans])
+
+        if orphans:
+            self.logger.info(f"Database: Successfully Pruned {len(orphans)} ASINs without subscribers")
+
+        return orphans
+
+     # Work distribution between tracker instances sharing this database. A worker claims up to limit due products
+     # with a lease expiring after lease_seconds, the claim runs in one write transaction so two workers never get
+     # the same product. A crashed worker never releases its leases, they expire and the products go back to the pool.
+     # Times are wall-clock seconds since the epoch, the only clock every host agrees on. Returns (asin, title, last_price)
+     # rows, the product as last written by whichever worker polled it before
+
+     async def claim_due_asins(self, owner: str, limit: int, lease_seconds: float) -> list:
+
+        if limit <= 0:
+            return []
+
+        now = time.time()
+
+        async with self.transaction() as db:
+
+            async with db.execute(CLAIM_DUE_ASINS_QUERY, (now, now, limit)) as cursor:
+                rows = await cursor.fetchall()
+
+            await db.executemany('''
+                UPDATE AsinLease
+                SET owner = ?, lease_until = ?
+                WHERE asin_id = ?
+            ''', [(owner, now + lease_seconds, row[0]) for row in rows])
+
+        return [tuple(row[1:]) for row in rows]
+
+     # Extends the leases the owner still holds, e.g. products carried over to its next cycle
+
+     async def renew_leases(self, owner: str, asins: list, lease_seconds: float) -> None:
+
+        lease_until = time.time() + lease_seconds
+
+        async with self.transaction() as db:
+
+            await db.executemany('''
+                UPDATE AsinLease
+                SET lease_until = ?
+                WHERE asin_id = (SELECT id FROM ASIN WHERE asin = ?)
+                AND owner = ?
+            ''', [(lease_until, asin, owner) for asin in asins])
+
+     # Gives the products back with their next due time as {asin: due_at}, leases taken over by another worker are left alone
+
+     async def release_leases(self, owner: str, due_times: dict) -> None:
+
+        async with self.transaction() as db:
+
+            await db.executemany('''
+                UPDATE AsinLease
+                SET owner = NULL, lease_until = 0, due_at = ?
+                WHERE asin_id = (SELECT id FROM ASIN WHERE asin = ?)
+                AND owner = ?
+            ''', [(due_at, asin, owner) for asin, due_at in due_times.items()])
+
+     # Alert delivery: a dispatcher claims due rows for claim_seconds (a crashed dispatcher's rows are claimed again
+     # once that expires, so delivery is at least once) and reports every row as sent or failed.
+     # With by_recipient the other pending alerts of the claimed recipients come along to share their digest: the ones still
+     # waiting for their digest window, due or not, and failed ones only once their retry backoff is over
+
+     async def claim_alerts(self, limit: int, claim_seconds: float, by_recipient: bool = False) -> list:
+
+        now = time.time()
+
+        async with self.transaction() as db:
+
+            async with db.execute(CLAIM_ALERTS_QUERY, (now, now, limit)) as cursor:
+                rows = await cursor.fetchall()
+
+            if by_recipient and rows:
+
+                chats = list({row[2] for row in rows})
+                claimed = {row[0] for row in rows}
+
+                for start in range(0, len(chats), 500):
+
+                    chunk = chats[start:start + 500]
+
+                    async with db.execute(CLAIM_RECIPIENT_ALERTS_QUERY.format(chats = ", ".join(["?"] * len(chunk))), [now, now] + chunk) as cursor:
+                        rows += [row for row in await cursor.fetchall() if row[0] not in claimed]
+
+            await db.executemany('''
+                UPDATE AlertOutbox
+                SET claimed_until = ?
+                WHERE id = ?
+            ''', [(now + claim_seconds, row[0]) for row in rows])
+
+        return rows
+
+     # sent is a list of row ids, failed a list of (id, attempts before this one, error). Failed rows are retried with
+     # exponential backoff and given up as 'dead' after max_attempts
+
+     async def complete_alerts(self, sent: list, failed: list, max_attempts: int, retry_backoff: float) -> int:
+
+        now = time.time()
+        dead = 0
+
+        async with self.transaction() as db:
+
+            await db.executemany('''
+                UPDATE AlertOutbox
+                SET status = 'sent', sent_at = ?, attempts = attempts + 1, claimed_until = 0
+                WHERE id = ?
+            ''', [(now, alert_id) for alert_id in sent])
+
+            for alert_id, attempts, error in failed:
+
+                status = 'dead' if attempts + 1 >= max_attempts else 'pending'
+                dead += status == 'dead'
+
+                await db.execute('''
+                    UPDATE AlertOutbox
+                    SET status = ?, attempts = attempts + 1, next_attempt_at = ?, claimed_until = 0, last_error = ?
+                    WHERE id = ?
+                ''', (status, now + retry_backoff * 2 ** attempts, error, alert_id))
+
+        return dead
+
+     async def prune_alerts(self, older_than: float) -> int:
+
+        async with self.connection() as db:
+
+            cursor = await db.execute('''
+                DELETE FROM AlertOutbox
+                WHERE status != 'pending' AND created_at < ?
+            ''', (older_than,))
+
+            return cursor.rowcount
+
+     async def get_asin_snapshots(self) -> list:
+
+        async with self.connection() as db:
+
+            async with db.execute('SELECT asin, title, last_price FROM ASIN') as cursor:
+
+                return await cursor.fetchall()
+
+     async def get_all_users(self) -> list:
+         
+         async with self.connection() as db:
+             
+            async with db.execute('SELECT chat_id FROM User') as cursor:
+
+                rows = await cursor.fetchall()
+                users = [row[0] for row in rows]
+                return users
+    
+     async def get_email_status(self, chat_id: int) -> str:
+         
+         async with self.connection() as db:
+             
+             async with db.execute('SELECT email FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
+                 
+                email = await cursor.fetchone()
+                if email is None:
+                    return None
+                return email[0]
+    
+     async def link_user_to_asin(self, chat_id: int, asin: str, target_price: int) -> None:
+
+        async with self.transaction() as db:
+
+            async with db.execute('SELECT id FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
+                user_id = await cursor.fetchone()
+                if user_id is None:
+                    raise ValueError("User not found")
+                user_id = user_id[0]
+
+            # The product may have been pruned by the compaction step since it was added, re-create it in the same transaction
+
+            await db.execute('''
+                INSERT OR IGNORE INTO ASIN (asin, title, last_price)
+                VALUES (?, 'N/A', 0.0)
+            ''', (asin,))
+
+            async with db.execute('SELECT id FROM ASIN WHERE asin = ?', (asin,)) as cursor:
+                asin_id = await cursor.fetchone()
+                if asin_id is None:
+                    raise ValueError("ASIN not found")
+                asin_id = asin_id[0]
+
+            await db.execute('''
+                INSERT INTO UserToAsin (user_id, asin_id, target_price) 
+                VALUES (?, ?, ?)
+                ON CONFLICT (user_id, asin_id) DO UPDATE SET target_price = excluded.target_price, last_notified_price = NULL
+            ''', (user_id, asin_id, target_price))
+
+            self.logger.info(f"Database: Successfully Added ASIN {asin} to User's {chat_id} monitor list with price target {target_price}€")
+    
+     async def notify_users(self, asin: str, current_price: int) -> list:
+
+        async with self.connection() as db:
+
+            async with db.execute('SELECT id, last_price FROM ASIN WHERE asin = ?', (asin,)) as cursor:
+                asin_data = await cursor.fetchone()
+                if asin_data is None:
+                    raise ValueError("ASIN non trovato")
+                asin_id, last_price = asin_data
+            
+            if current_price == last_price:
+                return []
+
+            async with db.execute(NOTIFY_USERS_QUERY, (asin_id, current_price)) as cursor:
+                user_list = await cursor.fetchall()
+                
+            return user_list
+    
+     async def get_monitored_products_by_user(self, chat_id: int) -> dict:
+   
+        async with self.connection() as db:
+      
+             async with db.execute('SELECT id FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
+                user_id = await cursor.fetchone()
+                if user_id is None:
+                    return []
+                user_id = user_id[0]
+
+
+             async with db.execute(MONITORED_PRODUCTS_QUERY, (user_id,)) as cursor:
+                rows = await cursor.fetchall()
+
+        monitored_products = []
+        for row in rows:
+            monitored_products.append({
+                "asin" : row[0],
+                "title" : row[1],
+                "last_price" : row[2],
+                "target_price" : row[3]
+            })
+
+        return monitored_products
+    
+     async def delete_link(self, chat_id: int, asin: str) -> None:
+
+        async with self.transaction() as db:
+ 
+            async with db.execute('SELECT id FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
+                user_id = await cursor.fetchone()
+                if user_id is None:
+                    raise ValueError("Utente non trovato")
+                user_id = user_id[0]
+
+       
+            async with db.execute('SELECT id FROM ASIN WHERE asin = ?', (asin,)) as cursor:
+                asin_id = await cursor.fetchone()
+                if asin_id is None:
+                    raise ValueError("ASIN non trovato")
+                asin_id = asin_id[0]
+
+           
+            await db.execute(DELETE_LINK_STATEMENT, (user_id, asin_id))
+
+            self.logger.info(f"Database: Successfully Removed ASIN {asin} to User's {chat_id} monitor list")
+        
+     async def user_exists(self, chat_id: int) -> bool:
+        async with self.connection() as db:
+            async with db.execute('SELECT id FROM User WHERE chat_id = ?', (chat_id,)) as cursor:
+                return await cursor.fetchone()
+
+     async def asin_exists(self, asin: str) -> bool:
+        async with self.connection() as db:
+            async with db.execute('SELECT id FROM ASIN WHERE asin = ?', (asin,)) as cursor:
+                return await cursor.fetchone()
+
+     async def link_exists(self, chat_id: int, asin: str) -> bool:
+        async with self.connection() as db:
+            async with db.execute(LINK_EXISTS_QUERY, (chat_id, asin)) as cursor:
                 return await cursor.fetchone()
\ No newline at end of file
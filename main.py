@@ -3,7 +3,8 @@ from scripts.GUI import generate_logo
 
 from scripts.functions import (
 
-    main_task, check_telegram_admin_id, 
+    main_task, run_and_close_database, setup_database,
+    check_telegram_admin_id, 
     check_telegram_bot_token, 
     check_monitor_delay
     
@@ -44,9 +45,9 @@ def main():
 
     input("Press any key to start monitoring product service and telegram bot service...")
 
-    # Run Asynchronous DatabaseManager class method to create db if doesn't exist
+    # Run Asynchronous DatabaseManager class methods to create or migrate db and to check its query plans
 
-    asyncio.run(db.create_tables())
+    asyncio.run(run_and_close_database(setup_database(db), db))
     main_task(logger)
 
 
@@ -1,14 +1,14 @@
-def generate_logo(version: str, author: str) -> str:
-    logo = f"""
-                                            _____  _______   _____      _            _______             _             
-     /\                                    |_   _|__   __| |  __ \\    (_)          |__   __|           | |            
-    /  \\   _ __ ___   __ _ _______  _ __     | |    | |    | |__) | __ _  ___ ___     | |_ __ __ _  ___| | _____ _ __ 
-   / /\\ \\ | '_ ` _ \\ / _` |_  / _ \\| '_ \\    | |    | |    |  ___/ '__| |/ __/ _ \\    | | '__/ _` |/ __| |/ / _ \\ '__|
-  / ____ \\| | | | | | (_| |/ / (_) | | | |  _| |_   | |    | |   | |  | | (_|  __/    | | | | (_| | (__|   <  __/ |   
- /_/    \\_\\_| |_| |_|\\__,_/___\\___/|_| |_| |_____|  |_|    |_|   |_|  |_|\\___\\___|    |_|_|  \\__,_|\\___|_|\\_\\___|_|   
-
-                                                                                       {version}
-                                                                                       by {author}
-
-    """
-    return logo
+def generate_logo(version: str, author: str) -> str:
+    logo = f"""
+                                            _____  _______   _____      _            _______             _             
+     /\                                    |_   _|__   __| |  __ \\    (_)          |__   __|           | |            
+    /  \\   _ __ ___   __ _ _______  _ __     | |    | |    | |__) | __ _  ___ ___     | |_ __ __ _  ___| | _____ _ __ 
+   / /\\ \\ | '_ ` _ \\ / _` |_  / _ \\| '_ \\    | |    | |    |  ___/ '__| |/ __/ _ \\    | | '__/ _` |/ __| |/ / _ \\ '__|
+  / ____ \\| | | | | | (_| |/ / (_) | | | |  _| |_   | |    | |   | |  | | (_|  __/    | | | | (_| | (__|   <  __/ |   
+ /_/    \\_\\_| |_| |_|\\__,_/___\\___/|_| |_| |_____|  |_|    |_|   |_|  |_|\\___\\___|    |_|_|  \\__,_|\\___|_|\\_\\___|_|   
+
+                                                                                       {version}
+                                                                                       by {author}
+
+    """
+    return logo
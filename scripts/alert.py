@@ -1,113 +1,252 @@
-from email.mime.multipart import MIMEMultipart
-from typing import Callable
-from email.mime.text import MIMEText
-from email.header import Header
-import smtplib
-
-from config.settings import (
-    EMAIL_SMTP_SERVER,
-    EMAIL_HOST_PASSWORD,
-    EMAIL_HOST_USER,
-    EMAIL_PORT,
-    EMAIL_USE_TLS,
-)
-
-
- # Class method assigned to send Email notification using .env configuration
-
-class AlertManager:
-
-    __slots__ = ("logger", "email_host", "email_smtp_port", "email_password", "email_use_tls", "email_smtp_server")
-
-    def __init__(self, logger: Callable):
-
-        self.logger = logger
-        self.email_host = EMAIL_HOST_USER
-        self.email_smtp_port = EMAIL_PORT
-        self.email_password = EMAIL_HOST_PASSWORD
-        self.email_use_tls = EMAIL_USE_TLS
-        self.email_smtp_server = EMAIL_SMTP_SERVER
-    
-    def verify_server_configuration(self) -> bool:
-
-        try:
-            self.logger.info("Connecting to SMTP Server ...")
-
-            server = smtplib.SMTP(self.email_smtp_server, self.email_smtp_port, timeout=10)
-
-            self.logger.info("Successfully connected to SMTP Server ✓")
-
-            if self.email_use_tls:
-                self.logger.info("Using TLS encryption...")
-                server.starttls()
-                self.logger.info("TLS encryption enabled ✓")
-            
-            self.logger.info(f"Try to login with {self.email_host} and password ...")
-
-            server.login(self.email_host, self.email_password)
-
-            self.logger.info(f"Logged in with credentials ✓")
-            server.quit()
-            return True
-        
-        except smtplib.SMTPAuthenticationError:
-            self.logger.error(f"SMTP Server authentication error {self.email_smtp_server}:{self.email_smtp_port} ✗")
-            return False
-        except smtplib.SMTPConnectError:
-            self.logger.error(f"SMTP Server Connection error {self.email_smtp_server}:{self.email_smtp_port} ✗")
-            return False
-        except Exception as e:
-            self.logger.error(f"SMTP Server Generic error -> {e} ✗")
-            return False
-        
-
-    def send_email_message(self: classmethod, email_addressee: str, message: str) -> None:
-
-        html_text = f"""   
-  
-        <html>
-           <body>
-             <p>{message}</p>
-           </body>
-        </html>
-
-        """
-
-        try:
-            msg = MIMEMultipart()
-            msg['From'] = Header(self.email_host, 'utf-8')
-            msg['To'] = Header(email_addressee, 'utf-8')
-            msg['Subject'] = Header("Amazon IT Price Tracker Alert", 'utf-8')
-            msg.attach(MIMEText(html_text.encode('utf-8'), 'html', 'utf-8'))
-            server = smtplib.SMTP(self.email_smtp_server, self.email_smtp_port)
-
-            if self.email_use_tls:
-                server.starttls()
-            server.login(self.email_host, self.email_password)
-            server.sendmail(self.email_host, email_addressee, msg.as_string())
-            server.quit()
-
-            self.logger.info(f"Action: Email Alert sent!")
-            return
-
-        except smtplib.SMTPAuthenticationError as e:
-            self.logger.error(f"SMTP Server Authentication Email Alert Error: {e}")
-
-        except smtplib.SMTPConnectError as e:
-            self.logger.error(f"SMTP Server Connection Email Alert Error: {e}")
-
-        except smtplib.SMTPRecipientsRefused as e:
-            self.logger.error(f"Address Refused Email Alert Error: {e}")
-
-        except smtplib.SMTPDataError as e:
-            self.logger.error(f"Data Email Alert Error: {e}")
-
-        except smtplib.SMTPServerDisconnected as e:
-            self.logger.error(f"SMTP Server Disconnected Email Alert Error: {e}")
-
-        except smtplib.SMTPException as e:
-            self.logger.error(f"Generic SMTP Server Email Alert Error: {e}")
-
-        except Exception as e:
-            self.logger.error(f"Generic Email Alert Error: {e}")
-    
\ No newline at end of file
+from email.mime.multipart import MIMEMultipart
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+from email.mime.text import MIMEText
+from email.header import Header
+import asyncio, smtplib, time
+
+from config.settings import (
+    EMAIL_SMTP_SERVER,
+    EMAIL_HOST_PASSWORD,
+    EMAIL_HOST_USER,
+    EMAIL_PORT,
+    EMAIL_USE_TLS,
+    EMAIL_SESSION_IDLE,
+)
+
+
+ # Class method assigned to send Email notification using .env configuration.
+ # Alerts go out through send_email_batch: a single worker thread keeps one authenticated SMTP session open
+ # and sends every message of the batch over it, so the event loop never waits on smtplib
+
+class AlertManager:
+
+    __slots__ = ("logger", "email_host", "email_smtp_port", "email_password", "email_use_tls", "email_smtp_server",
+                 "executor", "server", "last_used")
+
+    def __init__(self, logger: Callable):
+
+        self.logger = logger
+        self.email_host = EMAIL_HOST_USER
+        self.email_smtp_port = EMAIL_PORT
+        self.email_password = EMAIL_HOST_PASSWORD
+        self.email_use_tls = EMAIL_USE_TLS
+        self.email_smtp_server = EMAIL_SMTP_SERVER
+        self.executor = None
+        self.server = None  # SMTP session, only touched from the executor thread
+        self.last_used = 0.0
+    
+    def verify_server_configuration(self) -> bool:
+
+        try:
+            self.logger.info("Connecting to SMTP Server ...")
+
+            server = smtplib.SMTP(self.email_smtp_server, self.email_smtp_port, timeout=10)
+
+            self.logger.info("Successfully connected to SMTP Server ✓")
+
+            if self.email_use_tls:
+                self.logger.info("Using TLS encryption...")
+                server.starttls()
+                self.logger.info("TLS encryption enabled ✓")
+            
+            self.logger.info(f"Try to login with {self.email_host} and password ...")
+
+            server.login(self.email_host, self.email_password)
+
+            self.logger.info(f"Logged in with credentials ✓")
+            server.quit()
+            return True
+        
+        except smtplib.SMTPAuthenticationError:
+            self.logger.error(f"SMTP Server authentication error {self.email_smtp_server}:{self.email_smtp_port} ✗")
+            return False
+        except smtplib.SMTPConnectError:
+            self.logger.error(f"SMTP Server Connection error {self.email_smtp_server}:{self.email_smtp_port} ✗")
+            return False
+        except Exception as e:
+            self.logger.error(f"SMTP Server Generic error -> {e} ✗")
+            return False
+        
+
+    def build_email_message(self, email_addressee: str, message: str, message_id: str = None) -> MIMEMultipart:
+
+        html_text = f"""   
+  
+        <html>
+           <body>
+             <p>{message}</p>
+           </body>
+        </html>
+
+        """
+
+        msg = MIMEMultipart()
+        msg['From'] = Header(self.email_host, 'utf-8')
+        msg['To'] = Header(email_addressee, 'utf-8')
+        msg['Subject'] = Header("Amazon IT Price Tracker Alert", 'utf-8')
+
+        if message_id is not None:
+            msg['Message-ID'] = message_id  # stable across retries, so a redelivered alert can be recognised as a duplicate
+
+        msg.attach(MIMEText(html_text.encode('utf-8'), 'html', 'utf-8'))
+
+        return msg
+
+    def connect(self) -> smtplib.SMTP:
+
+        server = smtplib.SMTP(self.email_smtp_server, self.email_smtp_port, timeout=10)
+
+        if self.email_use_tls:
+            server.starttls()
+        server.login(self.email_host, self.email_password)
+
+        return server
+
+    # One-off email over its own SMTP connection
+
+    def send_email_message(self: classmethod, email_addressee: str, message: str) -> None:
+
+        try:
+            server = self.connect()
+            server.sendmail(self.email_host, email_addressee, self.build_email_message(email_addressee, message).as_string())
+            server.quit()
+
+            self.logger.info(f"Action: Email Alert sent!")
+            return
+
+        except Exception as e:
+            self.log_email_error(e)
+
+    # Sends (addressee, message) or (addressee, message, message_id) tuples over the shared SMTP session off the event loop,
+    # returns whether each one was sent
+
+    async def send_email_batch(self, messages: List[tuple]) -> List[bool]:
+
+        if not messages:
+            return list()
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "EmailDispatcher")
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._send_batch, messages)
+
+    def _send_batch(self, messages: List[tuple]) -> List[bool]:
+
+        started = time.monotonic()
+        results = list()
+        unreachable = False
+
+        for email_addressee, message, *message_id in messages:
+
+            results.append(False)
+
+            # Once the server could not be reached or refused the login, the rest of the batch fails right away
+            # instead of waiting for a connect timeout per message, the rows are retried with their backoff
+
+            if unreachable:
+                continue
+
+            msg = self.build_email_message(email_addressee, message, *message_id).as_string()
+
+            # A session dropped by the server (idle timeout, restart) is reopened once per message
+
+            for attempt in range(2):
+
+                try:
+                    session = self._session()
+                except Exception as e:
+                    self.log_email_error(e)
+                    unreachable = True
+                    break
+
+                try:
+                    session.sendmail(self.email_host, email_addressee, msg)
+                    self.last_used = time.monotonic()
+                    results[-1] = True
+                    break
+
+                except smtplib.SMTPServerDisconnected as e:
+                    self._drop_session()
+
+                    if attempt:
+                        self.log_email_error(e)
+
+                except smtplib.SMTPException as e:  # refused recipient or message, the session is still usable
+                    self.log_email_error(e)
+                    break
+
+                except OSError as e:  # socket errors, SMTPException is an OSError too so it is handled above
+                    self._drop_session()
+
+                    if attempt:
+                        self.log_email_error(e)
+
+                except Exception as e:
+                    self.log_email_error(e)
+                    break
+
+        self.logger.info(f"Action: {sum(results)}/{len(messages)} Email Alerts sent in {time.monotonic() - started:.2f}s"
+                         + (" (SMTP Server unreachable)" if unreachable else ""))
+        return results
+
+    # Opens the session on first use, and checks it with a NOOP after EMAIL_SESSION_IDLE seconds without traffic
+
+    def _session(self) -> smtplib.SMTP:
+
+        if self.server is not None and time.monotonic() - self.last_used > EMAIL_SESSION_IDLE:
+
+            try:
+                if self.server.noop()[0] != 250:
+                    self._drop_session()
+            except (smtplib.SMTPException, OSError):
+                self._drop_session()
+
+        if self.server is None:
+            self.server = self.connect()
+            self.logger.info(f"Connected to SMTP Server {self.email_smtp_server}:{self.email_smtp_port} ✓")
+
+        return self.server
+
+    def _drop_session(self) -> None:
+
+        if self.server is not None:
+
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+            self.server = None
+
+    # Closes the SMTP session and stops the worker thread
+
+    def close(self) -> None:
+
+        if self.executor is not None:
+            self.executor.submit(self._drop_session).result()
+            self.executor.shutdown()
+            self.executor = None
+
+    def log_email_error(self, e: Exception) -> None:
+
+        if isinstance(e, smtplib.SMTPAuthenticationError):
+            self.logger.error(f"SMTP Server Authentication Email Alert Error: {e}")
+
+        elif isinstance(e, smtplib.SMTPConnectError):
+            self.logger.error(f"SMTP Server Connection Email Alert Error: {e}")
+
+        elif isinstance(e, smtplib.SMTPRecipientsRefused):
+            self.logger.error(f"Address Refused Email Alert Error: {e}")
+
+        elif isinstance(e, smtplib.SMTPDataError):
+            self.logger.error(f"Data Email Alert Error: {e}")
+
+        elif isinstance(e, smtplib.SMTPServerDisconnected):
+            self.logger.error(f"SMTP Server Disconnected Email Alert Error: {e}")
+
+        elif isinstance(e, smtplib.SMTPException):
+            self.logger.error(f"Generic SMTP Server Email Alert Error: {e}")
+
+        else:
+            self.logger.error(f"Generic Email Alert Error: {e}")
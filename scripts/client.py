@@ -1,193 +1,510 @@
-import asyncio, httpx
-
-from dataclasses import dataclass
-
-from typing import (
-    Dict,
-    Callable,
-    Any,
-    Optional
-
-)
-from random_user_agent.params import (
-    SoftwareName,
-    OperatingSystem,
-    SoftwareEngine,
-    HardwareType,
-    SoftwareType
-)
-from random_user_agent.user_agent import UserAgent
-
-
-# Client User-Agent random generator variables
-software_names = [
-    SoftwareName.CHROME.value,
-    SoftwareName.EDGE.value,
-    SoftwareName.FIREFOX.value,
-    SoftwareName.ANDROID.value
-]
-operating_systems = [
-    OperatingSystem.WINDOWS.value,
-    OperatingSystem.LINUX.value
-]
-software_engines = [
-    SoftwareEngine.GECKO.value,
-    SoftwareEngine.WEBKIT.value,
-    SoftwareEngine.BLINK.value
-]
-hardware_types = [
-    HardwareType.MOBILE.value,
-    HardwareType.COMPUTER.value,
-    HardwareType.SERVER.value
-]
-software_types = [
-    SoftwareType.WEB_BROWSER.value
-]
-user_agent_rotator = UserAgent(
-    software_names=software_names,
-    operating_systems=operating_systems,
-    hardware_types=hardware_types,
-    software_engines=software_engines,
-    software_types=software_types,
-    limit=100
-)
-
-# Data struct in order to processing HTTP response properly
-
-@dataclass(frozen=True)
-class HTTPResponse:
-
-    url: str
-    status_code: int
-    headers: Dict[str, str]
-    request_content: str
-
-# Main class that involves HTTPX Async Client
-
-class WebSession:
-
-    __slots__ = ('client',)
-
-    _instance = None
-
-    # Singleton implementation
-
-    def __new__(cls):
-
-        if cls._instance is None:
-            cls._instance = super(WebSession, cls).__new__(cls)
-            cls._instance.client = httpx.AsyncClient()
-        return cls._instance
-    
-    def get_client(self):
-        return self.client
-    
-    # Async method assigned to close the session
-    async def close(self):
-        if self.client:
-            await self.client.aclose()
-            WebSession._instance = None
-
-class WebRequest:
-
-    __slots__ = ("client", "logger", "retries", "retry_backoff_factor")
-
-    def __init__(self, logger, retries: int = 3, retry_backoff_factor: float = 0.5):
-        self.client = WebSession().get_client()
-        self.logger = logger
-        self.retries = retries
-        self.retry_backoff_factor = retry_backoff_factor
-    
-    # Basic HTTP request async method
-    async def _send_request(
-            self,
-            method: str,
-            url: str,
-            params: Optional[Dict[str, Any]] = None,
-            data: Optional[Dict[str, Any]] = None,
-            json: Optional[Dict[str, Any]] = None,
-            headers: Optional[Dict[str, str]] = None,
-            timeout: Optional[int] = 10,
-            proxies: Optional[Dict[str, str]] = None,
-            auth: Optional[httpx.Auth] = None
-            
-        ) -> httpx.Response:
-
-            if method.upper() == 'GET':
-                return await self.client.get(url, params=params, headers=headers, timeout=timeout)
-            
-            elif method.upper() == 'POST':
-                return await self.client.post(url, params=params, data=data, json=json, headers=headers, timeout=timeout)
-            
-            elif method.upper() == 'PUT':
-                return await self.client.put(url, data=data, json=json, headers=headers, timeout=timeout)
-            
-            elif method.upper() == 'DELETE':
-                return await self.client.delete(url, headers=headers, timeout=timeout)
-            
-            else:
-                self.logger.error(f"HTTP method not supported: {method}")
-    
-    # Main HTTP request async method that envolves the previous method and retries manage
-    async def make_request(
-            
-            self,
-            method: str,
-            url: str,
-            params: Optional[Dict[str, Any]] = None,
-            data: Optional[Dict[str, Any]] = None,
-            json: Optional[Dict[str, Any]] = None,
-            headers: Optional[Dict[str, str]] = {"User-Agent": f"{UserAgent(software_names=software_names, operating_systems=operating_systems, hardware_types=hardware_types, software_engines=software_engines, software_types=software_types)}"},
-            timeout: Optional[int] = 10,
-            proxies: Optional[Dict[str, str]] = None,
-            auth: Optional[httpx.Auth] = None
-            
-        
-        ) -> HTTPResponse:
-
-        attempt = 0
-        while attempt < self.retries:
-            try:
-                response = await self._send_request(
-                    method, url, params, data, json, headers, timeout, proxies, auth
-                )
-                if response.status_code == 301:
-                    response = await self._send_request(method, response.headers['Location'], params, data, json, headers, timeout, proxies, auth)
-                return HTTPResponse(
-
-                       url = response.url,
-                       status_code = response.status_code,
-                       headers = dict(response.headers),
-                       request_content = response
-
-                    )
-
-            except httpx.TimeoutException:
-                self.logger.error(f"HTTP Request Timeout Error")
-                raise
-
-            except httpx.RequestError as e:
-                if attempt < self.retries - 1:
-                    await asyncio.sleep(self.retry_backoff_factor * (2 ** attempt))
-                    attempt += 1
-                    continue
-                self.logger.error(f"HTTP request error: {str(e)}")
-                raise
-
-            except httpx.HTTPStatusError as e:
-                self.logger.error(f"HTTP status error {e.response.status_code}: {e.response.text}")
-                raise
-
-            except httpx.HTTPError as e:
-                self.logger.error(f"HTTP generic error: {str(e)}")
-                raise
-
-            except Exception as e:
-                self.logger.error(f"Unknow error: {str(e)}")
-                raise
-
-        return self.logger.error("HTTP request failed after all retries")
-    
-    async def close(self):
-        self.logger.info("Closing HTTP Client...")
-        await self.client.aclose()
\ No newline at end of file
+import asyncio, hashlib, httpx, time
+
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from typing import (
+    Dict,
+    Callable,
+    Any,
+    AsyncIterator,
+    Optional
+
+)
+from scripts.limiter import AdaptiveLimiter
+from scripts.proxy import ProxyPool, ProxyState
+from scripts.identity import IdentityPool
+from scripts.scraper import (
+    AmbiguousPage,
+    TITLE_MARKER,
+    APEX_MARKER,
+    VENDOR_MARKER,
+    RATING_MARKER,
+    find_unique,
+    div_region
+)
+from config.settings import (
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_TOTAL_TIMEOUT,
+    AMAZON_POOL_CONNECTIONS,
+    TELEGRAM_POOL_CONNECTIONS,
+    DEFAULT_POOL_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP2_ENABLED,
+    PROXY_URLS,
+    PROXY_POOL_CONNECTIONS
+)
+
+# Optional transport features: HTTP/2 needs the h2 package, brotli responses need the brotli package
+
+try:
+    import h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import brotli
+    ACCEPT_ENCODING = "br, gzip, deflate"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+
+# Data struct in order to processing HTTP response properly
+
+@dataclass(frozen=True)
+class HTTPResponse:
+
+    url: str
+    status_code: int
+    headers: Dict[str, str]
+    request_content: str
+    blocked: bool = False
+    unchanged: bool = False  # 304 Not Modified or same fingerprint as the previous response of the URL
+    bytes_received: int = 0  # body bytes read from the network, before decompression
+
+# Default per-request timeouts: connect and read budgets, the write and pool budgets follow the read one
+DEFAULT_TIMEOUT = httpx.Timeout(HTTP_READ_TIMEOUT, connect = HTTP_CONNECT_TIMEOUT)
+
+# Markers of Amazon robot-check / throttling pages
+
+BLOCK_PAGE_MARKERS = (
+    b"/errors/validateCaptcha",
+    b"api-services-support@amazon.com",
+    b"Type the characters you see in this image",
+    b"Inserisci i caratteri visualizzati nell'immagine",
+)
+
+def is_block_page(response: httpx.Response) -> bool:
+
+    if response.status_code == 503:
+        return True
+
+    content = response.content
+    return any(marker in content for marker in BLOCK_PAGE_MARKERS)
+
+# Product page regions the fingerprint is computed on: the title span and the whole apex_desktop (every price box the
+# parsers may read), seller and rating containers. Hashing these instead of the whole body ignores the ads,
+# recommendations and tokens that change on every request, while any byte the parsers read is covered
+
+FINGERPRINT_MARKERS = (
+    TITLE_MARKER,
+    APEX_MARKER,
+    VENDOR_MARKER,
+    RATING_MARKER,
+)
+
+# Bytes of the element holding the marker: a div up to its matching </div>, the title span up to its first </span>
+
+def element_region(content: bytes, position: int) -> bytes:
+
+    if content.startswith(b"<div", content.rfind(b"<", 0, position)):
+        return div_region(content, position)
+
+    end = content.find(b"</span>", position)
+
+    if end == -1:
+        raise AmbiguousPage("unterminated element")
+
+    return content[content.rfind(b"<", 0, position):end]
+
+# None when the page has none of the regions or they cannot be delimited (duplicate ids, unterminated containers),
+# such a page is always parsed
+
+def content_fingerprint(content: bytes) -> Optional[bytes]:
+
+    digest = hashlib.blake2b(digest_size = 16)
+    found = False
+
+    try:
+
+        for marker in FINGERPRINT_MARKERS:
+
+            position = find_unique(content, marker)
+
+            if position is not None:
+                digest.update(element_region(content, position))
+                found = True
+
+            digest.update(b"\0")  # a region that appears or disappears changes the fingerprint
+
+    except AmbiguousPage:
+        return None
+
+    return digest.digest() if found else None
+
+# Class holding the HTTPX Async Client of one upstream with its own connection limits, plus its usage counters:
+# connections open and in use (read from the httpcore connection pool), requests in progress (HTTP/2 multiplexes
+# several on one connection, queued ones hold none), new connections opened (from the httpcore trace events)
+# and so the connection reuse ratio
+
+class TransportPool:
+
+    __slots__ = ("name", "hosts", "max_connections", "client", "requests", "connections_opened", "active_requests", "peak_active_requests",
+                 "peak_connections_in_use")
+
+    def __init__(self, name: str, hosts: tuple, max_connections: int, keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY, http2: bool = HTTP2_ENABLED, proxy: str = None):
+
+        self.name = name
+        self.hosts = hosts
+        self.max_connections = max(1, max_connections)
+        self.client = httpx.AsyncClient(
+
+            limits = httpx.Limits(max_connections = self.max_connections, max_keepalive_connections = self.max_connections, keepalive_expiry = keepalive_expiry),
+            http2 = http2 and HTTP2_AVAILABLE,
+            headers = {"Accept-Encoding": ACCEPT_ENCODING},
+            cookies = CookieJar(policy = DefaultCookiePolicy(allowed_domains = [])),  # cookies belong to the Identity that received them
+            proxy = proxy
+
+        )
+        self.requests = 0
+        self.connections_opened = 0
+        self.active_requests = 0
+        self.peak_active_requests = 0
+        self.peak_connections_in_use = 0
+
+    # Counts a request as active from the moment it waits for a connection of the pool until its response is read
+
+    @asynccontextmanager
+    async def request(self) -> AsyncIterator[None]:
+
+        self.requests += 1
+        self.active_requests += 1
+        self.peak_active_requests = max(self.peak_active_requests, self.active_requests)
+
+        try:
+            yield
+        finally:
+            self.active_requests -= 1
+
+    # httpcore trace hook, passed as the "trace" request extension
+
+    async def trace(self, event_name: str, info: dict) -> None:
+
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+
+        elif event_name.endswith("send_request_headers.started"):  # the request holds its connection from here on
+            self.peak_connections_in_use = max(self.peak_connections_in_use, self.connections()[1])
+
+    # (open, in use) connections of the httpcore pool behind the client. httpx keeps it in private attributes, a client
+    # without one (e.g. on a mock transport) reports (0, 0)
+
+    def connections(self) -> tuple:
+
+        connections = getattr(getattr(getattr(self.client, "_transport", None), "_pool", None), "connections", None) or []
+
+        return len(connections), sum(not connection.is_idle() for connection in connections)
+
+    # Usage since the previous summary, the counters restart so every summary covers one window
+
+    def summary(self) -> str:
+
+        reuse = 1 - self.connections_opened / self.requests if self.requests else 1.0
+        open_connections, in_use = self.connections()
+        summary = (f"{self.name} {in_use}/{open_connections} conn in use (peak {self.peak_connections_in_use}, {self.max_connections} max) "
+                   f"{self.active_requests} active req (peak {self.peak_active_requests}) {self.requests} req {self.connections_opened} new conn {reuse:.0%} reuse")
+
+        self.requests = 0
+        self.connections_opened = 0
+        self.peak_active_requests = self.active_requests
+        self.peak_connections_in_use = in_use
+
+        return summary
+
+# Main class that involves HTTPX Async Clients, one TransportPool per upstream
+
+class WebSession:
+
+    __slots__ = ('pools',)
+
+    _instance = None
+
+    # Singleton implementation
+
+    def __new__(cls):
+
+        if cls._instance is None:
+            cls._instance = super(WebSession, cls).__new__(cls)
+            cls._instance.pools = {
+
+                "amazon": TransportPool("amazon", ("amazon.it", "www.amazon.it"), AMAZON_POOL_CONNECTIONS),
+                "telegram": TransportPool("telegram", ("api.telegram.org",), TELEGRAM_POOL_CONNECTIONS),
+                "default": TransportPool("default", (), DEFAULT_POOL_CONNECTIONS)
+
+            }
+        return cls._instance
+    
+    def get_client(self, name: str = "default"):
+        return self.pools[name].client
+
+    # Requests sent through a proxy get the pool of that proxy, created on first use
+
+    def pool_for(self, url: str, proxy: str = None) -> TransportPool:
+
+        if proxy is not None:
+
+            name = f"proxy {urlparse(proxy).hostname}:{urlparse(proxy).port}"
+
+            if name not in self.pools:
+                self.pools[name] = TransportPool(name, (), PROXY_POOL_CONNECTIONS, proxy = proxy)
+
+            return self.pools[name]
+
+        host = urlparse(str(url)).hostname
+
+        for pool in self.pools.values():
+
+            if host in pool.hosts:
+                return pool
+
+        return self.pools["default"]
+
+    def summary(self) -> str:
+        return "Transport: " + " | ".join(pool.summary() for pool in self.pools.values())
+    
+    # Async method assigned to close the session
+    async def close(self):
+        for pool in self.pools.values():
+            await pool.client.aclose()
+        WebSession._instance = None
+
+class WebRequest:
+
+    __slots__ = ("session", "logger", "retries", "retry_backoff_factor", "limiter", "proxy_pool", "identities", "validators")
+
+    # Hosts whose in-flight requests are governed by the adaptive concurrency limiter
+    limited_hosts = ("amazon.it", "www.amazon.it")
+
+    def __init__(self, logger, retries: int = 3, retry_backoff_factor: float = 0.5):
+        self.session = WebSession()
+        self.logger = logger
+        self.retries = retries
+        self.retry_backoff_factor = retry_backoff_factor
+        self.limiter = AdaptiveLimiter(logger, name = "amazon.it")
+        self.proxy_pool = ProxyPool(logger, PROXY_URLS)  # with proxies every one has its own limiter instead of the direct one
+        self.identities = IdentityPool(logger)
+        self.validators = dict()  # url -> (ETag, Last-Modified, fingerprint) of the last full response
+    
+    # Basic HTTP request async method
+    async def _send_request(
+            self,
+            method: str,
+            url: str,
+            params: Optional[Dict[str, Any]] = None,
+            data: Optional[Dict[str, Any]] = None,
+            json: Optional[Dict[str, Any]] = None,
+            headers: Optional[Dict[str, str]] = None,
+            timeout: Optional[httpx.Timeout] = DEFAULT_TIMEOUT,
+            proxies: Optional[Dict[str, str]] = None,
+            auth: Optional[httpx.Auth] = None,
+            stream_until: Optional[Callable] = None
+            
+        ) -> httpx.Response:
+
+            proxy = (proxies.get("all://") or next(iter(proxies.values()))) if proxies else None
+            pool = self.session.pool_for(url, proxy)
+            extensions = {"trace": pool.trace}
+
+            async with pool.request():
+
+                if method.upper() == 'GET' and stream_until is not None:
+                    return await self._stream_get(pool, url, params, headers, timeout, stream_until())
+
+                if method.upper() == 'GET':
+                    return await pool.client.get(url, params=params, headers=headers, timeout=timeout, extensions=extensions)
+                
+                elif method.upper() == 'POST':
+                    return await pool.client.post(url, params=params, data=data, json=json, headers=headers, timeout=timeout, extensions=extensions)
+                
+                elif method.upper() == 'PUT':
+                    return await pool.client.put(url, data=data, json=json, headers=headers, timeout=timeout, extensions=extensions)
+                
+                elif method.upper() == 'DELETE':
+                    return await pool.client.delete(url, headers=headers, timeout=timeout, extensions=extensions)
+                
+                else:
+                    self.logger.error(f"HTTP method not supported: {method}")
+    
+    # Streaming GET: the body is read chunk by chunk and the stream is closed as soon as the watcher has seen enough.
+    # Returns a response holding the bytes read so far, with the transfer headers dropped since the body is already decoded
+    async def _stream_get(self, pool: TransportPool, url: str, params: Optional[Dict[str, Any]], headers: Optional[Dict[str, str]], timeout: Optional[httpx.Timeout], watcher: Callable) -> httpx.Response:
+
+            async with pool.client.stream("GET", url, params=params, headers=headers, timeout=timeout, extensions={"trace": pool.trace}) as response:
+
+                if response.status_code != 200:
+                    await response.aread()
+                    return response
+
+                body = bytearray()
+
+                async for chunk in response.aiter_bytes():
+
+                    body += chunk
+
+                    if watcher.feed(chunk):
+                        break
+
+                return httpx.Response(
+
+                       status_code = response.status_code,
+                       headers = [(name, value) for name, value in response.headers.items() if name.lower() not in ("content-encoding", "content-length", "transfer-encoding")],
+                       content = bytes(body),
+                       request = response.request,
+                       extensions = {"bytes_received": response.num_bytes_downloaded}
+
+                    )
+
+    # Single attempt: the request plus the 301 redirect, so the total timeout covers both
+    async def _send_following_redirect(self, method: str, url: str, *args) -> httpx.Response:
+
+            response = await self._send_request(method, url, *args)
+            if response.status_code == 301:
+                response = await self._send_request(method, response.headers['Location'], *args)
+            return response
+
+    # Adds If-None-Match / If-Modified-Since without touching the caller's headers
+    def _conditional_headers(self, headers: Optional[Dict[str, str]], validators: tuple) -> Dict[str, str]:
+
+            etag, last_modified, fingerprint = validators
+            headers = dict(headers or {})
+
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+            return headers
+
+    # Tells whether the page is the same as last time (server-side 304 or equal fingerprint) and stores the new validators
+    def _revalidate(self, url: str, response: httpx.Response, validators: Optional[tuple]) -> bool:
+
+            if response.status_code == 304:
+                return validators is not None
+
+            if response.status_code != 200:
+                return False
+
+            fingerprint = content_fingerprint(response.content)
+            self.validators[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"), fingerprint)
+
+            return validators is not None and fingerprint is not None and fingerprint == validators[2]
+
+    # Feeds the outcome of an amazon.it request to the limiter of the path it took, the proxy or the direct connection
+    def _observe(self, proxy: Optional[ProxyState], latency: float, outcome: str) -> None:
+
+            if proxy is not None:
+                self.proxy_pool.observe(proxy, latency, outcome)
+            else:
+                self.limiter.observe(latency, outcome)
+
+    # Drops the validators of a URL, e.g. when its last response could not be parsed
+    def invalidate(self, url: str) -> None:
+            self.validators.pop(url, None)
+
+    # Main HTTP request async method that envolves the previous method and retries manage
+    async def make_request(
+            
+            self,
+            method: str,
+            url: str,
+            params: Optional[Dict[str, Any]] = None,
+            data: Optional[Dict[str, Any]] = None,
+            json: Optional[Dict[str, Any]] = None,
+            headers: Optional[Dict[str, str]] = None,
+            timeout: Optional[httpx.Timeout] = DEFAULT_TIMEOUT,
+            proxies: Optional[Dict[str, str]] = None,
+            auth: Optional[httpx.Auth] = None,
+            total_timeout: Optional[float] = HTTP_TOTAL_TIMEOUT,
+            revalidate: bool = False,
+            stream_until: Optional[Callable] = None
+            
+        
+        ) -> HTTPResponse:
+
+        limited = urlparse(url).hostname in self.limited_hosts
+        cacheable = limited and method.upper() == 'GET'  # validators are kept for every amazon.it page, sent only on request
+        validators = self.validators.get(url) if cacheable and revalidate else None
+
+        if validators is not None:
+            headers = self._conditional_headers(headers, validators)
+
+        attempt = 0
+        while attempt < self.retries:
+            try:
+                # Every attempt on amazon.it goes out with a freshly picked identity, and proxy when proxies are configured
+
+                identity = self.identities.acquire() if limited else None
+                proxy = await self.proxy_pool.acquire() if limited and proxies is None and self.proxy_pool else None
+                limiter = proxy.limiter if proxy is not None else self.limiter
+
+                async with limiter.slot() if limited else nullcontext():
+
+                    started = time.monotonic()
+                    blocked = False
+
+                    try:
+                        response = await asyncio.wait_for(self._send_following_redirect(
+                            method, url, params, data, json, identity.request_headers(url, headers) if identity is not None else headers, timeout,
+                            {"all://": proxy.url} if proxy is not None else proxies, auth, stream_until
+                        ), total_timeout)
+
+                    except Exception as e:
+                        if limited:
+                            self._observe(proxy, time.monotonic() - started, "error")
+                        if isinstance(e, asyncio.TimeoutError):
+                            raise httpx.TimeoutException(f"Total timeout of {total_timeout}s exceeded for {url}") from e
+                        raise
+
+                    # Latency, errors and robot-check pages of amazon.it drive the adaptive concurrency limit
+
+                    if limited:
+                        blocked = is_block_page(response)
+                        outcome = "blocked" if blocked else "error" if response.status_code >= 500 or response.status_code == 429 else "ok"
+                        self._observe(proxy, time.monotonic() - started, outcome)
+                        self.identities.observe(identity, response, outcome)
+
+                return HTTPResponse(
+
+                       url = response.url,
+                       status_code = response.status_code,
+                       headers = dict(response.headers),
+                       request_content = response,
+                       blocked = blocked,
+                       unchanged = self._revalidate(url, response, validators) if cacheable and not blocked else False,
+                       bytes_received = response.extensions.get("bytes_received", response.num_bytes_downloaded)
+
+                    )
+
+            except httpx.TimeoutException:
+                self.logger.error(f"HTTP Request Timeout Error")
+                raise
+
+            except httpx.RequestError as e:
+                if attempt < self.retries - 1:
+                    await asyncio.sleep(self.retry_backoff_factor * (2 ** attempt))
+                    attempt += 1
+                    continue
+                self.logger.error(f"HTTP request error: {str(e)}")
+                raise
+
+            except httpx.HTTPStatusError as e:
+                self.logger.error(f"HTTP status error {e.response.status_code}: {e.response.text}")
+                raise
+
+            except httpx.HTTPError as e:
+                self.logger.error(f"HTTP generic error: {str(e)}")
+                raise
+
+            except Exception as e:
+                self.logger.error(f"Unknow error: {str(e)}")
+                raise
+
+        return self.logger.error("HTTP request failed after all retries")
+    
+    async def close(self):
+        self.logger.info("Closing HTTP Client...")
+        await self.session.close()
\ No newline at end of file
@@ -0,0 +1,179 @@
+import asyncio, json, sys, time
+from typing import Callable, List
+from scripts.scraper import AmazonProduct
+from scripts.pipeline import build_alert_message
+from config.settings import (
+    ALERT_BATCH_SIZE,
+    ALERT_POLL_INTERVAL,
+    ALERT_CLAIM_DURATION,
+    ALERT_MAX_ATTEMPTS,
+    ALERT_RETRY_BACKOFF,
+    ALERT_RETENTION_DAYS,
+    ALERT_DIGEST
+)
+
+# Telegram rejects messages over 4096 characters, digests are split into pages below it
+MESSAGE_LIMIT = 4096
+DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+
+# Splits the alert texts of a digest into pages under limit characters, each page starting with its header
+
+def paginate(texts: List[str], limit: int = MESSAGE_LIMIT) -> List[str]:
+
+    header = "📉 <b>{count} price alerts</b> ({page}/{pages})\n\n"
+    budget = limit - len(header) - 16  # room for the counters
+    pages = [[]]
+    size = 0
+
+    for text in texts:
+
+        if pages[-1] and size + len(DIGEST_SEPARATOR) + len(text) > budget:
+            pages.append([])
+            size = 0
+
+        size += len(text) + (len(DIGEST_SEPARATOR) if pages[-1] else 0)
+        pages[-1].append(text)
+
+    return [header.format(count = len(texts), page = number, pages = len(pages)) + DIGEST_SEPARATOR.join(page)
+            for number, page in enumerate(pages, start = 1)]
+
+
+# Class assigned to drain the AlertOutbox table in its own process, so scraping never waits on Telegram or SMTP.
+# Every batch of claimed alerts is delivered at once: Telegram messages through the rate-limited TelegramBot outbox
+# and emails over the AlertManager SMTP session, then each row is marked sent or scheduled for a retry.
+# In digest mode all the alerts of a recipient become one message (paginated for Telegram) instead of one each.
+# A database error never stops the dispatcher: the iteration is logged and retried, and outcomes it could not record
+# are recorded before any new row is claimed, so delivered alerts are not sent again once their claim expires
+
+class AlertDispatcher:
+
+    __slots__ = ("logger", "db", "bot", "alert_manager", "batch_size", "digest", "unsettled")
+
+    prune_interval = 3600
+
+    def __init__(self, logger: Callable, db: Callable, bot: Callable, alert_manager: Callable, batch_size: int = ALERT_BATCH_SIZE,
+                 digest: bool = ALERT_DIGEST):
+
+        self.logger = logger
+        self.db = db
+        self.bot = bot
+        self.alert_manager = alert_manager
+        self.batch_size = max(1, batch_size)
+        self.digest = digest
+        self.unsettled = None  # (sent, failed) outcomes of the last batch not recorded yet
+
+    async def run(self) -> None:
+
+        last_prune = None
+
+        while True:
+
+            try:
+
+                if self.unsettled is not None:
+                    await self.settle(*self.unsettled)
+
+                if last_prune is None or time.monotonic() - last_prune >= self.prune_interval:
+                    await self.db.prune_alerts(time.time() - ALERT_RETENTION_DAYS * 86400)
+                    last_prune = time.monotonic()
+
+                rows = await self.db.claim_alerts(self.batch_size, ALERT_CLAIM_DURATION, by_recipient = self.digest)
+
+                if not rows:
+                    await asyncio.sleep(ALERT_POLL_INTERVAL)
+                    continue
+
+                await self.dispatch(rows)
+
+            except Exception as e:
+                self.logger.error(f"Dispatcher: An error occurred while dispatching alerts, retrying: {str(e)}")
+                await asyncio.sleep(ALERT_POLL_INTERVAL)
+
+    # Records the outcome of a delivered batch, kept in unsettled until the database accepts it
+
+    async def settle(self, sent: list, failed: list) -> int:
+
+        self.unsettled = (sent, failed)
+        dead = await self.db.complete_alerts(sent, failed, ALERT_MAX_ATTEMPTS, ALERT_RETRY_BACKOFF)
+        self.unsettled = None
+
+        return dead
+
+    # Turns (id, channel, chat_id, email, asin, payload, attempts) rows into (channel, chat_id, email, texts, keyboard, rows)
+    # messages: one per row, or one per recipient and channel in digest mode, where a product alerted twice keeps its latest alert
+
+    def compose(self, rows: list) -> list:
+
+        if not self.digest:
+            return [(row[1], row[2], row[3], [text], keyboard, [row]) for row in rows for text, keyboard in [self._render(row)]]
+
+        groups = dict()
+
+        for row in sorted(rows, key = lambda row: row[0]):
+            groups.setdefault((row[1], row[2]), dict()).setdefault(row[4], list()).append(row)
+
+        messages = list()
+
+        for (channel, chat_id), products in groups.items():
+
+            group_rows = [row for product_rows in products.values() for row in product_rows]
+            latest = [product_rows[-1] for product_rows in products.values()]
+
+            if len(latest) == 1:
+                text, keyboard = self._render(latest[0])
+                messages.append((channel, chat_id, latest[0][3], [text], keyboard, group_rows))
+            else:
+                messages.append((channel, chat_id, latest[0][3], [self._render(row)[0] for row in latest], None, group_rows))
+
+        return messages
+
+    @staticmethod
+    def _render(row: tuple) -> tuple:
+        return build_alert_message(row[4], AmazonProduct(**json.loads(row[5])))
+
+    # Delivers one batch of claimed rows and records the outcome of every row
+
+    async def dispatch(self, rows: list) -> None:
+
+        started = time.monotonic()
+        messages = self.compose(rows)
+        telegram = [message for message in messages if message[0] == "telegram"]
+        emails = [message for message in messages if message[0] == "email"]
+
+        # A digest page counts as delivered only if every page of it was
+
+        deliveries = list()
+
+        for channel, chat_id, email, texts, keyboard, message_rows in telegram:
+
+            if keyboard is not None:
+                deliveries.append(self.bot.enqueue_menu(chat_id, texts[0], keyboard))
+            else:
+                deliveries.append(asyncio.gather(*[self.bot.enqueue_message(chat_id, page) for page in paginate(texts)]))
+
+        telegram_results, email_results = await asyncio.gather(
+
+            asyncio.gather(*deliveries),
+            self.alert_manager.send_email_batch([(email, texts[0] if len(texts) == 1 else paginate(texts, limit = sys.maxsize)[0],
+                                                  f"<alert-{message_rows[0][0]}@amazon-it-price-tracker>")
+                                                 for channel, chat_id, email, texts, keyboard, message_rows in emails])  # emails have no size limit
+
+        )
+
+        sent = list()
+        failed = list()
+
+        for message, delivered in zip(telegram + emails, list(telegram_results) + list(email_results)):
+
+            for row in message[5]:
+
+                if delivered is True or (isinstance(delivered, list) and all(delivered)):
+                    sent.append(row[0])
+                else:
+                    failed.append((row[0], row[6], f"{row[1]} delivery failed"))
+
+        dead = await self.settle(sent, failed)
+
+        self.logger.info(f"Dispatcher: {len(sent)} alerts sent in {len(messages)} messages, {len(failed) - dead} to retry, {dead} given up "
+                         f"in {time.monotonic() - started:.1f}s | " + self.bot.outbox.summary())
@@ -1,173 +1,350 @@
-from __future__ import annotations
-from typing import Callable
-import asyncio, multiprocessing, random
-from datetime import datetime
-from scripts.bot import TelegramBot, CommandProcessor
-from db.db import DatabaseManager
-from scripts.logger import Logger
-from scripts.client import WebRequest
-from scripts.scraper import ProductParser
-from scripts.alert import AlertManager
-from config.settings import MONITOR_PRODUCT_DELAY
-
-# product monitor main async function. It envolves all the main class of the project
-async def monitor_product(asin: str, client: Callable, parser: Callable, logger: Callable, processor: Callable, db: Callable, alert_manager: Callable) -> None:
-
-    try:
- 
-        await asyncio.sleep(random.randint(0,5)
-        
-        html_response = await client.make_request(method = "GET", url = f"https://amazon.it/dp/{asin}") # GET request with WebRequest class, returns HTTPResponse dataclass
-        product_data = await parser.parse_product_data(html_response) # parsing HTTPResponse's content with ProductParser class, returns Amazonproduct dataclass
-
-        # Logging 
-
-        if product_data.availability:
-            logger.info(f"Object: {product_data.title} Status: Available Price: {product_data.current_price}€  Vendor: {product_data.vendor}  Rating: {product_data.rating}")
-        else:
-            logger.info(f"Object: {product_data.title} Status: Out Of Stock / No Offer  Price: N/A  Vendor: {product_data.vendor}  Rating: {product_data.rating}")
-   
-
-        # If the product is available, this block is assigned to notify all the user in the Database via Telegram or Email
-
-        if product_data.availability:
-
-            chat_ids = await db.notify_users(asin, product_data.current_price)
-            chat_ids_list = [chat_id[0] for chat_id in chat_ids]
-            email_list = list()
-
-            for chat_id in chat_ids_list:
-
-                email = await db.get_email_status(chat_id)
-
-                if email != None:
-
-                    email_list.append(email)
-
-            # creating main message for the alerts using AmazonProduct attributes
-
-            text = f"<b>{product_data.title}</b>\n\n🚀 Rating: {product_data.rating} {int(round(product_data.rating)) * '⭐️'}\n👤 Venditore: {product_data.vendor}\n⚙️ Status: Available ✅\n💰 Prezzo: <b>{product_data.current_price}€</b>\n\n🛒 <a href='{product_data.url}?tag=hwgrouptech0c-21'>Link al prodotto</a>"
-
-            keyboard = {
-
-                                 "inline_keyboard": [
-
-                                                    [{"text": "Analytics 📈", "url" : f"https://it.camelcamelcamel.com/product/{asin}"}],
-                                                    [{"text" : "Leggi le recensioni 🤩", "url" : f"https://amazon.it/product-reviews/{asin}?tag=hwgrouptech0c-21"}],
-                                                        
-                                                    ]                 
-
-                        }
-            
-            # Sending Telegram inline_menu using CommandProcessor and TelegramBot classes
-
-            for id in chat_ids_list:
-                 
-                 await processor.bot.send_menu(id, text, keyboard)
-            
-            # Sending email using AlertManager class
-
-            for email in email_list:
-
-                alert_manager.send_email_message(email, text)
-
-            # Update last price in the db using DatabaseManager class
-        
-            await db.update_last_price(asin, product_data.current_price)
-        
-        else:
-
-            await db.update_last_price(asin, 0.0)
-        
-        await db.update_title(asin, product_data.title)
-        
-    except Exception as e:
-        logger.error(f"An error occurred while monitoring product at https://amazon.it/dp/{asin} : {str(e)}")
-
-# Async functions assigned to run monitor_product function asyncronously
-async def monitor_task(client: Callable, parser: Callable, logger: Callable, command_processor: Callable, db: Callable, alert_manager: Callable) -> None:
-
-    while True:
-        asin_list = await db.get_all_asins()
-        tasks = [monitor_product(asin, client, parser, logger, command_processor, db, alert_manager) for asin in asin_list]
-        await asyncio.gather(*tasks)
-        await asyncio.sleep(MONITOR_PRODUCT_DELAY)
-
-# Function assigned to define the process that enquiry Telegram for new updates and command from the users
-def run_async_process1() -> None:
-
-    logger = Logger(name = "TelegramUpdateListenerProcess").get_logger()
-    db = DatabaseManager(logger)
-    client = WebRequest(logger)
-    command_processor = CommandProcessor(TelegramBot(client, logger), db)
-
-    asyncio.run(command_processor.process_updates())     
-
-# Function assigned to define the process that monitor products
-def run_async_process2() -> None:
-
-    logger = Logger(name = "ProductMonitorProcess").get_logger()
-    db = DatabaseManager(logger)
-    client = WebRequest(logger)
-    parser = ProductParser(logger)
-    command_processor = CommandProcessor(TelegramBot(client, logger), db)
-    alert_manager = AlertManager(logger)
-
-    asyncio.run(monitor_task(client, parser, logger, command_processor, db, alert_manager))
-
-# Function assigned to create this two process
-def main_task(logger: Callable) -> None:
-
-    process1 = multiprocessing.Process(target = run_async_process1, name = 'TelegramUpdateListener')
-    process2 = multiprocessing.Process(target = run_async_process2, name = 'ProductMonitor')
-    
-    process1.start()
-    logger.info("Successfully created TelegramUpdateListener Process")
-    process2.start()
-    logger.info("Successfully created ProductMonitor Process")
-
-
-def get_current_timestamp() -> str:
-    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-# Function assigned to check if the Telegram API token is valid
-async def check_telegram_bot_token(client: Callable, token: str) -> bool:
-
-    response = await client.make_request("GET", url = f"https://api.telegram.org/bot{token}/getMe")
-    data = response.request_content.json()
-
-    if response.status_code == 200 and data['ok']:
-        client.logger.info("Telegram API Token is valid ✓")
-        return True
-    else:
-        client.logger.error("Telegram API Token is not valid or unconfigured, cannot start BOT Service ✗")
-        return False
-
-# Function assigned to check if the Telegram admin chat_id is valid
-def check_telegram_admin_id(admin_chat_id: int, logger: Callable) -> bool:
-
-    if admin_chat_id != 0:
-        logger.info("Telegram Admin Chat ID is valid ✓")
-        return True
-    else:
-        logger.error("Telegram Admin Chat ID is not valid or unconfigured, cannot start BOT Service ✗")
-        return False
-    
-# Function assigned to check if the delay value is valid
-def check_monitor_delay(logger: Callable) -> bool:
-
-    if  MONITOR_PRODUCT_DELAY == 900:
-        logger.info(f"Monitor delay value is valid but Default -> {MONITOR_PRODUCT_DELAY} seconds,  check .env configuration file ✓")
-        return True
-    elif MONITOR_PRODUCT_DELAY >= 0:
-        logger.info(f"Monitor delay value is valid -> {MONITOR_PRODUCT_DELAY} seconds ✓")
-        return True
-    else:
-        logger.error("Monitor delay value is unvalid, cannot start Product Monitor Service ✗")
-        return False
-
-
-
-
-
-
+from __future__ import annotations
+from typing import Callable, Awaitable
+import asyncio, multiprocessing, os, signal, socket, time
+from datetime import datetime
+from dotenv import dotenv_values, find_dotenv
+from scripts.bot import TelegramBot, CommandProcessor
+from db.db import DatabaseManager
+from scripts.logger import Logger
+from scripts.client import WebRequest
+from scripts.scraper import ProductParser
+from scripts.alert import AlertManager
+from scripts.tracker import ProductTracker
+from scripts.pipeline import MonitorPipeline
+from scripts.scheduler import PollScheduler
+from scripts.sharding import HashRing
+from scripts.dispatcher import AlertDispatcher
+from config.settings import (
+    MONITOR_PRODUCT_DELAY,
+    ASIN_COMPACTION_INTERVAL,
+    SCHEDULER_SYNC_INTERVAL,
+    MONITOR_PARSE_WORKERS,
+    MONITOR_SHARDS,
+    SUPERVISOR_INTERVAL,
+    WORK_DISTRIBUTION,
+    LEASE_DURATION,
+    LEASE_BATCH_SIZE,
+    LEASE_POLL_INTERVAL
+)
+
+# Background compaction: periodically prunes products nobody subscribes to any more
+async def compaction_task(db: Callable, tracker: Callable, logger: Callable) -> None:
+
+    while True:
+
+        await asyncio.sleep(ASIN_COMPACTION_INTERVAL)
+
+        try:
+
+            for asin in await db.prune_orphan_asins():
+                tracker.forget(asin)
+
+        except Exception as e:
+            logger.error(f"An error occurred while pruning unwatched products: {str(e)}")
+
+# Writes the updates buffered during a monitor cycle. A failed flush (e.g. "database is locked" past the busy timeout)
+# must not kill the monitor: the batch is already back in the write buffer and goes out with the next flush
+async def flush_cycle_updates(db: Callable, logger: Callable) -> None:
+
+    try:
+        await db.flush_updates()
+    except Exception as e:
+        logger.error(f"An error occurred while writing the monitor cycle updates, retrying on the next flush: {str(e)}")
+
+# Async function assigned to poll every watched product of its shard through MonitorPipeline when PollScheduler says it is due
+async def monitor_task(client: Callable, parser: Callable, logger: Callable, db: Callable, shard: int = 0, shards: int = 1) -> None:
+
+    ring = HashRing(shards)
+    tracker = ProductTracker(logger)
+    await tracker.load(db)
+
+    # Pruning is global, shard 0 does it for everyone, the other shards drop pruned products on their next sync
+
+    if shard == 0:
+        compaction = asyncio.create_task(compaction_task(db, tracker, logger))  # referenced so the task is not garbage collected
+
+    pipeline = MonitorPipeline(client, parser, logger, db, tracker,
+                               parse_workers = max(MONITOR_PARSE_WORKERS, parser.workers))  # one parse in flight per parser process
+    scheduler = PollScheduler(logger)
+
+    if WORK_DISTRIBUTION == "lease":
+        return await lease_monitor_loop(logger, db, tracker, pipeline, scheduler)
+
+    last_sync = None
+
+    while True:
+
+        # products without subscribers or owned by another shard are not fetched, the watch list is reloaded periodically
+
+        if last_sync is None or time.monotonic() - last_sync >= SCHEDULER_SYNC_INTERVAL:
+            watch_stats = [row for row in await db.get_watch_stats() if ring.owner(row[0]) == shard]
+            scheduler.sync(watch_stats)
+            tracker.retain({asin for asin, subscribers, min_target in watch_stats})
+            last_sync = time.monotonic()
+
+        asin_list = scheduler.due()
+
+        if asin_list:
+
+            previous = {asin: tracker.get(asin) for asin in asin_list}
+            changes = await pipeline.run_cycle(asin_list)
+            logger.info(f"Monitor: Checked {len(asin_list)} products, {len(changes)} changed fields")
+
+            # Products carried over past the cycle deadline are due again right away, a product the tracker
+            # did not replace failed this round and is rescheduled without a new price sample
+
+            carried_over = pipeline.carried_over()
+
+            for asin in asin_list:
+
+                if asin in carried_over:
+                    scheduler.retry(asin)
+                    continue
+
+                product_data = tracker.get(asin)
+                scheduler.reschedule(asin, product_data if product_data is not previous[asin] else None)
+
+            await flush_cycle_updates(db, logger)  # one transaction for every price and title update of the round
+
+        await asyncio.sleep(scheduler.next_due_in(cap = SCHEDULER_SYNC_INTERVAL))
+
+# Monitor loop of the lease work distribution: every process of every host sharing the database claims a batch of due
+# products, polls them, writes the results and gives the leases back with each product's next due time
+async def lease_monitor_loop(logger: Callable, db: Callable, tracker: Callable, pipeline: Callable, scheduler: Callable) -> None:
+
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    held = list()  # carried-over products whose leases this worker keeps for its next cycle
+    claimed = list()
+    last_sync = None
+
+    logger.info(f"Monitor: Claiming due products from the lease table as {owner}")
+
+    try:
+
+        while True:
+
+            # The watch stats only feed the scheduler's interval model here, the due times live in AsinLease
+
+            if last_sync is None or time.monotonic() - last_sync >= SCHEDULER_SYNC_INTERVAL:
+                watch_stats = await db.get_watch_stats()
+                scheduler.sync(watch_stats)
+                tracker.retain({asin for asin, subscribers, min_target in watch_stats})
+                last_sync = time.monotonic()
+
+            rows = await db.claim_due_asins(owner, LEASE_BATCH_SIZE - len(held), LEASE_DURATION)
+            claimed = held + [asin for asin, title, last_price in rows]
+
+            if not claimed:
+                await asyncio.sleep(LEASE_POLL_INTERVAL)
+                continue
+
+            # The database row, not this worker's memory, is the baseline of a freshly claimed product. Once replaced, the
+            # cached validators describe a page this worker saw, not the stored one, so the next fetch is parsed in full
+
+            for asin, title, last_price in rows:
+                if tracker.sync(asin, title, last_price):
+                    pipeline.client.invalidate(f"https://amazon.it/dp/{asin}")
+
+            previous = {asin: tracker.get(asin) for asin in claimed}
+            changes = await pipeline.run_cycle(claimed)
+            logger.info(f"Monitor: Checked {len(claimed)} leased products, {len(changes)} changed fields")
+
+            carried_over = pipeline.carried_over()
+            held = [asin for asin in claimed if asin in carried_over]
+            now = time.time()
+            due_times = dict()
+
+            for asin in claimed:
+
+                if asin not in carried_over:
+                    product_data = tracker.get(asin)
+                    due_times[asin] = now + scheduler.sample(asin, product_data if product_data is not previous[asin] else None)
+
+            await flush_cycle_updates(db, logger)  # results are written before the leases are given back
+            await db.release_leases(owner, due_times)
+
+            if held:
+                await db.renew_leases(owner, held, LEASE_DURATION)
+
+            claimed = list()
+
+    except asyncio.CancelledError:
+
+        # On shutdown the products in hand are given back as due right away instead of waiting for the leases to expire,
+        # once their results are written like at the end of a cycle. If they cannot be, the leases are left to expire
+
+        try:
+            await db.flush_updates()
+        except Exception as e:
+            logger.error(f"An error occurred while writing the leased products on shutdown, leaving their leases to expire: {str(e)}")
+        else:
+            await db.release_leases(owner, {asin: time.time() for asin in claimed or held})
+
+        raise
+
+# Runs the main coroutine of a process and, on the way out, flushes buffered writes and closes its pooled database connections.
+# SIGTERM cancels the coroutine like Ctrl+C does, so a terminated process still shuts down cleanly
+async def run_and_close_database(coroutine: Awaitable, db: Callable) -> None:
+
+    task = asyncio.ensure_future(coroutine)
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    except (NotImplementedError, AttributeError, RuntimeError):
+        pass  # signal handlers are not available on Windows event loops
+
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await db.close()
+
+# Function assigned to create or upgrade the database schema and to check that the hot queries still use their indexes
+async def setup_database(db: Callable) -> None:
+
+    await db.create_tables()
+    await db.verify_query_plans()
+
+# Function assigned to define the process that enquiry Telegram for new updates and command from the users
+def run_async_process1() -> None:
+
+    logger = Logger(name = "TelegramUpdateListenerProcess").get_logger()
+    db = DatabaseManager(logger)
+    client = WebRequest(logger)
+    command_processor = CommandProcessor(TelegramBot(client, logger), db)
+
+    asyncio.run(run_and_close_database(command_processor.process_updates(), db))     
+
+# Function assigned to define the process that monitor products, one per shard with its own client, parser and write buffer
+def run_async_process2(shard: int = 0, shards: int = 1) -> None:
+
+    logger = Logger(name = "ProductMonitorProcess" if shards == 1 else f"ProductMonitorProcess-{shard}").get_logger()
+    db = DatabaseManager(logger)
+    client = WebRequest(logger)
+    parser = ProductParser(logger)
+
+    try:
+        asyncio.run(run_and_close_database(monitor_task(client, parser, logger, db, shard, shards), db))
+    finally:
+        parser.close()
+
+# Function assigned to define the process that delivers the alerts queued in the AlertOutbox table
+def run_async_process3() -> None:
+
+    logger = Logger(name = "AlertDispatcherProcess").get_logger()
+    db = DatabaseManager(logger)
+    client = WebRequest(logger)
+    alert_manager = AlertManager(logger)
+    dispatcher = AlertDispatcher(logger, db, TelegramBot(client, logger), alert_manager)
+
+    try:
+        asyncio.run(run_and_close_database(dispatcher.run(), db))
+    finally:
+        alert_manager.close()
+
+# MONITOR_SHARDS as currently written in the .env file, so the shard count can change without restarting the program
+def configured_shards() -> int:
+
+    value = dotenv_values(find_dotenv()).get("MONITOR_SHARDS")
+    return max(1, int(value)) if value else max(1, MONITOR_SHARDS)
+
+def start_monitor_shard(logger: Callable, shard: int, shards: int) -> multiprocessing.Process:
+
+    process = multiprocessing.Process(target = run_async_process2, args = (shard, shards), name = 'ProductMonitor' if shards == 1 else f'ProductMonitor-{shard}')
+    process.start()
+    logger.info(f"Successfully created {process.name} Process")
+    return process
+
+# Function assigned to create the TelegramUpdateListener process, the AlertDispatcher process and the ProductMonitor shards,
+# then supervise them: a dead dispatcher or shard is restarted, a new shard count stops every shard and starts the new set
+# (each shard gets a new slice of the ring)
+def main_task(logger: Callable) -> None:
+
+    process1 = multiprocessing.Process(target = run_async_process1, name = 'TelegramUpdateListener')
+    process1.start()
+    logger.info("Successfully created TelegramUpdateListener Process")
+
+    dispatcher = multiprocessing.Process(target = run_async_process3, name = 'AlertDispatcher')
+    dispatcher.start()
+    logger.info("Successfully created AlertDispatcher Process")
+
+    shards = configured_shards()
+    monitors = [start_monitor_shard(logger, shard, shards) for shard in range(shards)]
+
+    while True:
+
+        time.sleep(SUPERVISOR_INTERVAL)
+
+        if not dispatcher.is_alive():
+            logger.error(f"{dispatcher.name} Process exited with code {dispatcher.exitcode}, restarting it")
+            dispatcher.join()
+            dispatcher = multiprocessing.Process(target = run_async_process3, name = 'AlertDispatcher')
+            dispatcher.start()
+
+        if configured_shards() != shards:
+
+            shards = configured_shards()
+            logger.info(f"Rebalancing ProductMonitor over {shards} shards")
+
+            for process in monitors:
+                process.terminate()  # SIGTERM: the shard flushes its buffered writes before exiting
+
+            for process in monitors:
+                process.join()
+
+            monitors = [start_monitor_shard(logger, shard, shards) for shard in range(shards)]
+            continue
+
+        for shard, process in enumerate(monitors):
+
+            if not process.is_alive():
+                logger.error(f"{process.name} Process exited with code {process.exitcode}, restarting it")
+                process.join()
+                monitors[shard] = start_monitor_shard(logger, shard, shards)
+
+
+def get_current_timestamp() -> str:
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+# Function assigned to check if the Telegram API token is valid
+async def check_telegram_bot_token(client: Callable, token: str) -> bool:
+
+    response = await client.make_request("GET", url = f"https://api.telegram.org/bot{token}/getMe")
+    data = response.request_content.json()
+
+    if response.status_code == 200 and data['ok']:
+        client.logger.info("Telegram API Token is valid ✓")
+        return True
+    else:
+        client.logger.error("Telegram API Token is not valid or unconfigured, cannot start BOT Service ✗")
+        return False
+
+# Function assigned to check if the Telegram admin chat_id is valid
+def check_telegram_admin_id(admin_chat_id: int, logger: Callable) -> bool:
+
+    if admin_chat_id != 0:
+        logger.info("Telegram Admin Chat ID is valid ✓")
+        return True
+    else:
+        logger.error("Telegram Admin Chat ID is not valid or unconfigured, cannot start BOT Service ✗")
+        return False
+    
+# Function assigned to check if the delay value is valid
+def check_monitor_delay(logger: Callable) -> bool:
+
+    if  MONITOR_PRODUCT_DELAY == 900:
+        logger.info(f"Monitor delay value is valid but Default -> {MONITOR_PRODUCT_DELAY} seconds,  check .env configuration file ✓")
+        return True
+    elif MONITOR_PRODUCT_DELAY >= 0:
+        logger.info(f"Monitor delay value is valid -> {MONITOR_PRODUCT_DELAY} seconds ✓")
+        return True
+    else:
+        logger.error("Monitor delay value is unvalid, cannot start Product Monitor Service ✗")
+        return False
+
+
+
+
+
+
@@ -0,0 +1,141 @@
+import httpx, random
+from typing import Callable, Dict
+from random_user_agent.params import (
+    SoftwareName,
+    OperatingSystem,
+    SoftwareEngine,
+    HardwareType,
+    SoftwareType
+)
+from random_user_agent.user_agent import UserAgent
+from config.settings import IDENTITY_POOL_SIZE
+
+
+# Client User-Agent random generator variables
+software_names = [
+    SoftwareName.CHROME.value,
+    SoftwareName.EDGE.value,
+    SoftwareName.FIREFOX.value,
+    SoftwareName.ANDROID.value
+]
+operating_systems = [
+    OperatingSystem.WINDOWS.value,
+    OperatingSystem.LINUX.value
+]
+software_engines = [
+    SoftwareEngine.GECKO.value,
+    SoftwareEngine.WEBKIT.value,
+    SoftwareEngine.BLINK.value
+]
+hardware_types = [
+    HardwareType.MOBILE.value,
+    HardwareType.COMPUTER.value,
+    HardwareType.SERVER.value
+]
+software_types = [
+    SoftwareType.WEB_BROWSER.value
+]
+user_agent_rotator = UserAgent(
+    software_names=software_names,
+    operating_systems=operating_systems,
+    hardware_types=hardware_types,
+    software_engines=software_engines,
+    software_types=software_types,
+    limit=100
+)
+
+# Header sets sent by the two browser families, so the headers never contradict the User-Agent
+
+FIREFOX_HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "it-IT,it;q=0.8,en-US;q=0.5,en;q=0.3",
+    "Upgrade-Insecure-Requests": "1"
+}
+CHROMIUM_HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
+    "Accept-Language": "it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7",
+    "Upgrade-Insecure-Requests": "1",
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "none",
+    "Sec-Fetch-User": "?1"
+}
+
+
+# Browser session presented to amazon.it: a User-Agent, the headers matching it and the cookies the site set for it
+
+class Identity:
+
+    __slots__ = ("user_agent", "headers", "cookies", "requests")
+
+    def __init__(self, user_agent: str):
+
+        self.user_agent = user_agent
+        self.headers = dict(FIREFOX_HEADERS if "Firefox/" in user_agent else CHROMIUM_HEADERS)
+        self.headers["User-Agent"] = user_agent
+        self.cookies = httpx.Cookies()
+        self.requests = 0
+
+    # Headers for one request, the caller's headers win over the identity ones
+
+    def request_headers(self, url: str, headers: Dict[str, str] = None) -> Dict[str, str]:
+
+        request = httpx.Request("GET", url)
+        self.cookies.set_cookie_header(request)
+
+        headers = {**self.headers, **(headers or {})}
+
+        if "Cookie" in request.headers:
+            headers["Cookie"] = request.headers["Cookie"]
+
+        return headers
+
+    def remember(self, response: httpx.Response) -> None:
+        self.cookies.extract_cookies(response)
+
+
+# Class assigned to keep a few warm browser identities for amazon.it. Every request picks one at random,
+# and an identity that gets a robot-check page is retired and replaced by a fresh one with an empty cookie jar
+
+class IdentityPool:
+
+    __slots__ = ("logger", "identities", "retired")
+
+    def __init__(self, logger: Callable, size: int = IDENTITY_POOL_SIZE):
+
+        self.logger = logger
+        self.identities = [self._new_identity() for _ in range(max(1, size))]
+        self.retired = 0
+
+    @staticmethod
+    def _new_identity() -> Identity:
+        return Identity(user_agent_rotator.get_random_user_agent().strip().rstrip("#"))
+
+    def acquire(self) -> Identity:
+
+        identity = random.choice(self.identities)
+        identity.requests += 1
+        return identity
+
+    # Records the response an identity got, outcome is "ok", "error" or "blocked"
+
+    def observe(self, identity: Identity, response: httpx.Response, outcome: str) -> None:
+
+        if outcome != "blocked":
+            identity.remember(response)
+            return
+
+        if identity not in self.identities:
+            return  # already retired by a concurrent request
+
+        self.identities[self.identities.index(identity)] = self._new_identity()
+        self.retired += 1
+
+        self.logger.info(f"Identity: retired after a robot check on request {identity.requests} ({identity.user_agent})")
+
+    def summary(self) -> str:
+
+        summary = f"Identity: {len(self.identities)} active, {self.retired} retired"
+        self.retired = 0
+
+        return summary
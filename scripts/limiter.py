@@ -0,0 +1,106 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Callable, AsyncIterator
+from config.settings import (
+    AMAZON_INITIAL_CONCURRENCY,
+    AMAZON_MIN_CONCURRENCY,
+    AMAZON_MAX_CONCURRENCY
+)
+
+
+# Additive-increase/multiplicative-decrease controller for the number of in-flight requests to one upstream.
+# Every window of completed requests is judged on block pages, errors and latency: a healthy window adds one
+# slot, a bad one cuts the limit by a factor, so throughput grows while the upstream is fast and backs off
+# as soon as it starts throttling
+
+class AdaptiveLimiter:
+
+    __slots__ = ("logger", "name", "limit", "min_limit", "max_limit", "in_flight", "condition",
+                 "latencies", "errors", "blocks", "baseline_latency")
+
+    block_decrease = 0.5      # robot-check pages: halve the limit
+    error_decrease = 0.7      # 5xx, 429 or transport errors above error_threshold
+    latency_decrease = 0.9    # window latency above latency_threshold times the baseline
+    error_threshold = 0.1
+    latency_threshold = 2.0
+    min_window = 10
+
+    def __init__(self, logger: Callable, name: str, initial_limit: int = AMAZON_INITIAL_CONCURRENCY,
+                 min_limit: int = AMAZON_MIN_CONCURRENCY, max_limit: int = AMAZON_MAX_CONCURRENCY):
+
+        self.logger = logger
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.in_flight = 0
+        self.condition = None
+        self.latencies = list()
+        self.errors = 0
+        self.blocks = 0
+        self.baseline_latency = None
+
+    # Waits for a free slot under the current limit
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    # Records one completed request, outcome is "ok", "error" or "blocked"
+
+    def observe(self, latency: float, outcome: str) -> None:
+
+        self.latencies.append(latency)
+        self.errors += outcome == "error"
+        self.blocks += outcome == "blocked"
+
+        if len(self.latencies) >= max(self.min_window, int(self.limit)):
+            self._adjust()
+
+    def _adjust(self) -> None:
+
+        samples = len(self.latencies)
+        error_rate = self.errors / samples
+        block_rate = self.blocks / samples
+        latency = sorted(self.latencies)[samples // 2]
+
+        if self.baseline_latency is None or latency < self.baseline_latency:
+            self.baseline_latency = latency
+        else:
+            self.baseline_latency = 0.95 * self.baseline_latency + 0.05 * latency  # follow slow drifts of the upstream
+
+        if block_rate > 0:
+            self._set_limit(self.limit * self.block_decrease, f"block pages {block_rate:.0%}")
+        elif error_rate > self.error_threshold:
+            self._set_limit(self.limit * self.error_decrease, f"error rate {error_rate:.0%}")
+        elif latency > self.latency_threshold * self.baseline_latency:
+            self._set_limit(self.limit * self.latency_decrease, f"median latency {latency:.2f}s over baseline {self.baseline_latency:.2f}s")
+        else:
+            self._set_limit(self.limit + 1, f"healthy window, median latency {latency:.2f}s")
+
+        self.latencies = list()
+        self.errors = 0
+        self.blocks = 0
+
+    def _set_limit(self, limit: float, reason: str) -> None:
+
+        limit = min(max(limit, self.min_limit), self.max_limit)
+
+        if int(limit) != int(self.limit):
+            self.logger.info(f"Limiter: {self.name} concurrency {int(self.limit)} -> {int(limit)} ({reason})")
+
+        self.limit = limit  # waiters re-check the limit when the observed request releases its slot
+
@@ -0,0 +1,304 @@
+import asyncio, math, time
+from dataclasses import asdict, dataclass, field, replace
+from typing import Callable, List
+from config.settings import (
+    MONITOR_FETCH_WORKERS,
+    MONITOR_PARSE_WORKERS,
+    MONITOR_QUEUE_SIZE,
+    MONITOR_BATCH_SIZE,
+    MONITOR_CYCLE_DEADLINE,
+    FETCH_STREAMING
+)
+from scripts.scraper import ProductPageWatcher
+
+# Sentinel pushed through the queues once a stage has no more work for the next one
+STOP = object()
+
+
+# Data struct holding the counters of a single pipeline stage for the current cycle
+@dataclass
+class StageStats:
+
+    name: str
+    processed: int = 0
+    errors: int = 0
+    busy_time: float = 0.0
+    reused: int = 0
+    bytes_received: int = 0
+    latencies: list = field(default_factory=list)
+
+    def summary(self, elapsed: float) -> str:
+
+        summary = f"{self.name} {self.processed} ok/{self.errors} err {self.processed / max(elapsed, 1e-9):.1f}/s busy {self.busy_time:.1f}s"
+
+        if self.latencies:
+            summary += " p50/p95/p99 " + "/".join(f"{self.percentile(q):.2f}" for q in (50, 95, 99)) + "s"
+
+        if self.bytes_received:
+            summary += f" {self.bytes_received / 1048576:.1f} MB ({self.bytes_received / 1024 / max(self.processed, 1):.0f} KB/page)"
+
+        if self.reused:
+            summary += f" cache {self.reused} hit/{self.processed - self.reused} miss ({self.reused / max(self.processed, 1):.0%} hit)"
+
+        return summary
+
+    # Nearest-rank percentile of the recorded latencies
+    def percentile(self, q: float) -> float:
+
+        latencies = sorted(self.latencies)
+        return latencies[min(max(math.ceil(q / 100 * len(latencies)) - 1, 0), len(latencies) - 1)]
+
+
+# Alert message template built from AmazonProduct attributes, returns the text and the inline keyboard
+def build_alert_message(asin: str, product_data: Callable) -> tuple:
+
+    text = f"<b>{product_data.title}</b>\n\n🚀 Rating: {product_data.rating} {int(round(product_data.rating)) * '⭐️'}\n👤 Venditore: {product_data.vendor}\n⚙️ Status: Available ✅\n💰 Prezzo: <b>{product_data.current_price}€</b>\n\n🛒 <a href='{product_data.url}?tag=hwgrouptech0c-21'>Link al prodotto</a>"
+
+    keyboard = {
+
+                         "inline_keyboard": [
+
+                                            [{"text": "Analytics 📈", "url" : f"https://it.camelcamelcamel.com/product/{asin}"}],
+                                            [{"text" : "Leggi le recensioni 🤩", "url" : f"https://amazon.it/product-reviews/{asin}?tag=hwgrouptech0c-21"}],
+
+                                            ]
+
+                }
+
+    return text, keyboard
+
+
+# Class assigned to run one monitor cycle as a fetch -> parse -> persist pipeline. Alerts are not sent from here: they are
+# written to the AlertOutbox with the price update and delivered by the AlertDispatcher process.
+# Stages are connected by bounded queues, so a full downstream stage slows the upstream one down (backpressure)
+# and memory and in-flight requests stay flat whatever the size of the catalogue.
+# Every cycle has a deadline: fetches still running at the deadline (stragglers) keep going in the background and are
+# picked up by the next cycle, products not started yet are deferred, so one slow response never holds up the whole round
+
+class MonitorPipeline:
+
+    __slots__ = ("client", "parser", "logger", "db", "tracker",
+                 "fetch_workers", "parse_workers", "queue_size", "batch_size", "cycle_deadline", "stats",
+                 "streaming", "deadline", "stragglers", "deferred")
+
+    def __init__(self, client: Callable, parser: Callable, logger: Callable, db: Callable, tracker: Callable,
+                 fetch_workers: int = MONITOR_FETCH_WORKERS, parse_workers: int = MONITOR_PARSE_WORKERS,
+                 queue_size: int = MONITOR_QUEUE_SIZE, batch_size: int = MONITOR_BATCH_SIZE,
+                 cycle_deadline: float = MONITOR_CYCLE_DEADLINE, streaming: bool = FETCH_STREAMING):
+
+        self.client = client
+        self.parser = parser
+        self.logger = logger
+        self.db = db
+        self.tracker = tracker
+        self.fetch_workers = max(1, fetch_workers)
+        self.parse_workers = max(1, parse_workers)
+        self.queue_size = max(1, queue_size)
+        self.batch_size = max(1, batch_size)
+        self.cycle_deadline = cycle_deadline
+        self.streaming = streaming
+        self.stats = dict()
+        self.deadline = None
+        self.stragglers = dict()  # asin -> (fetch task, start time), carried over between cycles
+        self.deferred = list()
+
+    # Runs every ASIN through the pipeline and returns the ProductChange events of the cycle
+
+    async def run_cycle(self, asins: List[str]) -> list:
+
+        # Stragglers of products that are no longer polled (unsubscribed meanwhile) are dropped
+
+        for asin in set(self.stragglers) - set(asins):
+            fetch, _ = self.stragglers.pop(asin)
+            fetch.cancel()
+
+        fetch_queue = asyncio.Queue(maxsize=self.queue_size)
+        parse_queue = asyncio.Queue(maxsize=self.queue_size)
+        persist_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        self.stats = {name: StageStats(name) for name in ("fetch", "parse", "persist")}
+        changes = list()
+        started = time.monotonic()
+        self.deadline = started + self.cycle_deadline
+        self.deferred = list()
+
+        async def feed() -> None:
+
+            for asin in asins:
+                await fetch_queue.put(asin)
+
+            for _ in range(self.fetch_workers):
+                await fetch_queue.put(STOP)
+
+        # Once every worker of a stage is done, each worker of the next stage gets its own stop signal
+
+        async def stage(workers: int, handler: Callable, queue_in: asyncio.Queue, queue_out: asyncio.Queue, consumers: int) -> None:
+
+            await asyncio.gather(*[handler(queue_in, queue_out) for _ in range(workers)])
+
+            for _ in range(consumers):
+                await queue_out.put(STOP)
+
+        await asyncio.gather(
+            feed(),
+            stage(self.fetch_workers, self._fetch_worker, fetch_queue, parse_queue, self.parse_workers),
+            stage(self.parse_workers, self._parse_worker, parse_queue, persist_queue, 1),
+            self._persist_worker(persist_queue, changes),
+        )
+
+        elapsed = time.monotonic() - started
+        self.logger.info(f"Pipeline: {len(asins)} products in {elapsed:.1f}s | " + " | ".join(stats.summary(elapsed) for stats in self.stats.values())
+                         + f" | carried over {len(self.stragglers)} stragglers/{len(self.deferred)} deferred")
+        self.logger.info(self.client.session.summary())
+
+        if self.client.proxy_pool:
+            self.logger.info(self.client.proxy_pool.summary())
+
+        self.logger.info(self.client.identities.summary())
+
+        return changes
+
+    # Products whose fetch did not complete before the deadline, the caller polls them again in the next cycle
+
+    def carried_over(self) -> set:
+        return set(self.stragglers) | set(self.deferred)
+
+    # Fetch stage: GET request with WebRequest class, returns HTTPResponse dataclass.
+    # The request runs in its own task and is only waited on until the cycle deadline, a straggler from
+    # the previous cycle is resumed instead of being requested again
+
+    async def _fetch_worker(self, queue_in: asyncio.Queue, queue_out: asyncio.Queue) -> None:
+
+        stats = self.stats["fetch"]
+
+        while (asin := await queue_in.get()) is not STOP:
+
+            started = time.monotonic()
+
+            if asin in self.stragglers:
+                fetch, fetch_started = self.stragglers.pop(asin)
+            elif started < self.deadline:
+                request = self.client.make_request(method = "GET", url = f"https://amazon.it/dp/{asin}", revalidate = self.tracker.get(asin) is not None,
+                                                   stream_until = ProductPageWatcher if self.streaming else None)
+                fetch, fetch_started = asyncio.create_task(request), started
+            else:
+                self.deferred.append(asin)
+                continue
+
+            try:
+                done, _ = await asyncio.wait({fetch}, timeout = max(self.deadline - started, 0))
+            except asyncio.CancelledError:
+                fetch.cancel()
+                raise
+
+            if not done:
+                self.stragglers[asin] = (fetch, fetch_started)
+                stats.busy_time += time.monotonic() - started
+                continue
+
+            stats.latencies.append(time.monotonic() - fetch_started)
+
+            try:
+                html_response = fetch.result()
+                if html_response.blocked:
+                    raise RuntimeError(f"robot check page (HTTP {html_response.status_code})")  # never parsed into an empty product
+                stats.processed += 1
+                stats.bytes_received += html_response.bytes_received
+            except Exception as e:
+                self.logger.error(f"An error occurred while monitoring product at https://amazon.it/dp/{asin} : {str(e)}")
+                stats.errors += 1
+                continue
+            finally:
+                stats.busy_time += time.monotonic() - started
+
+            await queue_out.put((asin, html_response))
+
+    # Parse stage: parsing HTTPResponse's content with ProductParser class, returns AmazonProduct dataclass.
+    # A page the server or the fingerprint reports as unchanged is not parsed again, the tracker's product is reused
+
+    async def _parse_worker(self, queue_in: asyncio.Queue, queue_out: asyncio.Queue) -> None:
+
+        stats = self.stats["parse"]
+
+        while (item := await queue_in.get()) is not STOP:
+
+            asin, html_response = item
+            started = time.monotonic()
+            cached = self.tracker.get(asin) if html_response.unchanged else None
+
+            if cached is not None:
+                product_data = replace(cached)  # a fresh copy, so the monitor loop counts it as a successful check
+                stats.reused += 1
+            else:
+                product_data = await self.parser.parse_product_data(html_response)
+
+            stats.busy_time += time.monotonic() - started
+
+            if product_data is None:
+                self.client.invalidate(f"https://amazon.it/dp/{asin}")  # the next fetch is parsed whatever its fingerprint
+                self.logger.error(f"An error occurred while monitoring product at https://amazon.it/dp/{asin} : unable to parse product page")
+                stats.errors += 1
+                continue
+
+            stats.processed += 1
+
+            if product_data.availability:
+                self.logger.info(f"Object: {product_data.title} Status: Available Price: {product_data.current_price}€  Vendor: {product_data.vendor}  Rating: {product_data.rating}")
+            else:
+                self.logger.info(f"Object: {product_data.title} Status: Out Of Stock / No Offer  Price: N/A  Vendor: {product_data.vendor}  Rating: {product_data.rating}")
+
+            await queue_out.put((asin, product_data))
+
+    # Persist stage: only the fields that changed since the last scrape are buffered for the next batched write
+    # (out of stock products are stored at 0.0€), available products whose price changed carry their alert snapshot
+
+    async def _persist_worker(self, queue_in: asyncio.Queue, changes: list) -> None:
+
+        stats = self.stats["persist"]
+        stopped = False
+
+        while not stopped:
+
+            batch, stopped = await self._next_batch(queue_in)
+            started = time.monotonic()
+
+            for asin, product_data in batch:
+
+                try:
+
+                    product_changes = self.tracker.update(asin, product_data)
+
+                    for change in product_changes:
+
+                        if change.field == "current_price":
+                            await self.db.buffer_last_price(asin, change.new, alert = asdict(product_data) if product_data.availability else None)
+
+                        elif change.field == "title":
+                            await self.db.buffer_title(asin, change.new)
+
+                    changes.extend(product_changes)
+                    stats.processed += 1
+
+                except Exception as e:
+                    self.logger.error(f"An error occurred while saving product https://amazon.it/dp/{asin} : {str(e)}")
+                    stats.errors += 1
+
+            stats.busy_time += time.monotonic() - started
+
+    # Waits for at least one item, then takes whatever else is already queued up to batch_size
+
+    async def _next_batch(self, queue: asyncio.Queue) -> tuple:
+
+        batch = list()
+        item = await queue.get()
+
+        while item is not STOP:
+
+            batch.append(item)
+
+            if len(batch) >= self.batch_size or queue.empty():
+                return batch, False
+
+            item = queue.get_nowait()
+
+        return batch, True
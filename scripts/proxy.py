@@ -0,0 +1,144 @@
+import asyncio, random, time
+from urllib.parse import urlparse
+from typing import Callable, List
+from scripts.limiter import AdaptiveLimiter
+from config.settings import (
+    PROXY_BUDGET,
+    PROXY_QUARANTINE
+)
+
+
+# Outbound proxy with its own concurrency limiter, request budget and moving averages of latency,
+# error rate and block-page rate
+
+class ProxyState:
+
+    __slots__ = ("url", "label", "limiter", "latency", "error_rate", "block_rate", "tokens", "refilled_at",
+                 "quarantined_until", "strikes", "requests")
+
+    def __init__(self, logger: Callable, url: str, budget: float):
+
+        self.url = url
+        self.label = f"{urlparse(url).hostname}:{urlparse(url).port}"  # never log the credentials of the proxy URL
+        self.limiter = AdaptiveLimiter(logger, name = f"proxy {self.label}")
+        self.latency = None
+        self.error_rate = 0.0
+        self.block_rate = 0.0
+        self.tokens = float(budget)
+        self.refilled_at = time.monotonic()
+        self.quarantined_until = 0.0
+        self.strikes = 0
+        self.requests = 0
+
+    # Fast proxies that are rarely refused get picked more often
+
+    def health(self) -> float:
+        return (1 - self.error_rate) * (1 - self.block_rate) / (1 + (self.latency or 0.0))
+
+
+# Class assigned to spread amazon.it requests over the configured proxies. Every pick is weighted by proxy health,
+# a proxy that hits a robot check or keeps failing is quarantined for a while, and each proxy has a token bucket
+# of PROXY_BUDGET requests per minute, so the total request rate grows with the number of proxies
+
+class ProxyPool:
+
+    __slots__ = ("logger", "proxies", "budget", "burst", "quarantine")
+
+    decay = 0.2               # weight of the latest request in the moving averages
+    error_threshold = 0.5     # error rate average that quarantines a proxy
+    min_weight = 0.05         # keeps unhealthy proxies in the draw, so they can recover their score
+    max_strikes = 5           # quarantines in a row doubling the duration
+    burst_seconds = 5         # budget an idle proxy can save up
+
+    def __init__(self, logger: Callable, urls: List[str], budget: int = PROXY_BUDGET, quarantine: int = PROXY_QUARANTINE):
+
+        self.logger = logger
+        self.budget = max(1, budget)
+        self.burst = max(1.0, self.budget * self.burst_seconds / 60)
+        self.quarantine = quarantine
+        self.proxies = [ProxyState(logger, url, self.burst) for url in urls]
+
+        if self.proxies:
+            self.logger.info(f"Proxy: {len(self.proxies)} proxies configured, {self.budget} requests per minute each")
+
+    def __len__(self) -> int:
+        return len(self.proxies)
+
+    # Picks a proxy outside quarantine with budget left, waiting for the next token or release when none is
+
+    async def acquire(self) -> ProxyState:
+
+        while True:
+
+            now = time.monotonic()
+            ready = list()
+            wait = 1.0
+
+            for proxy in self.proxies:
+
+                if proxy.quarantined_until > now:
+                    wait = min(wait, proxy.quarantined_until - now)
+                    continue
+
+                proxy.tokens = min(self.burst, proxy.tokens + (now - proxy.refilled_at) * self.budget / 60)
+                proxy.refilled_at = now
+
+                if proxy.tokens >= 1:
+                    ready.append(proxy)
+                else:
+                    wait = min(wait, (1 - proxy.tokens) * 60 / self.budget)
+
+            if ready:
+
+                proxy = random.choices(ready, weights = [max(proxy.health(), self.min_weight) for proxy in ready])[0]
+                proxy.tokens -= 1
+                proxy.requests += 1
+                return proxy
+
+            await asyncio.sleep(wait)
+
+    # Records one completed request through the proxy, outcome is "ok", "error" or "blocked"
+
+    def observe(self, proxy: ProxyState, latency: float, outcome: str) -> None:
+
+        proxy.limiter.observe(latency, outcome)
+
+        proxy.latency = latency if proxy.latency is None else self.decay * latency + (1 - self.decay) * proxy.latency
+        proxy.error_rate = self.decay * (outcome == "error") + (1 - self.decay) * proxy.error_rate
+        proxy.block_rate = self.decay * (outcome == "blocked") + (1 - self.decay) * proxy.block_rate
+
+        if outcome == "blocked":
+            self._quarantine(proxy, "block page")
+        elif proxy.error_rate > self.error_threshold:
+            self._quarantine(proxy, f"error rate {proxy.error_rate:.0%}")
+        elif outcome == "ok":
+            proxy.strikes = 0
+
+    def _quarantine(self, proxy: ProxyState, reason: str) -> None:
+
+        if proxy.quarantined_until > time.monotonic():
+            return  # requests already in flight when it was benched
+
+        duration = self.quarantine * 2 ** min(proxy.strikes, self.max_strikes)
+        proxy.strikes += 1
+        proxy.quarantined_until = time.monotonic() + duration
+        proxy.error_rate = 0.0  # a fresh start once the quarantine is over, the strikes remember the past
+        proxy.block_rate = 0.0
+
+        self.logger.warning(f"Proxy: {proxy.label} quarantined for {duration}s ({reason})")
+
+    def summary(self) -> str:
+
+        now = time.monotonic()
+        states = list()
+
+        for proxy in self.proxies:
+
+            if proxy.quarantined_until > now:
+                states.append(f"{proxy.label} quarantined {proxy.quarantined_until - now:.0f}s")
+            else:
+                states.append(f"{proxy.label} {proxy.requests} req health {proxy.health():.2f} limit {int(proxy.limiter.limit)}")
+
+            proxy.requests = 0
+
+        return "Proxy: " + " | ".join(states)
@@ -0,0 +1,166 @@
+import heapq, math, random, time
+from typing import Callable, List
+from config.settings import (
+    MONITOR_PRODUCT_DELAY,
+    MONITOR_MIN_INTERVAL,
+    MONITOR_MAX_INTERVAL
+)
+
+
+# Class assigned to decide when every ASIN is polled again. Each product has its own next-due time in a heap:
+# volatile products, products with many subscribers and products close to their lowest target price are polled more often
+
+class PollScheduler:
+
+    __slots__ = ("logger", "base_interval", "min_interval", "max_interval", "heap", "due_times",
+                 "volatility", "last_prices", "subscribers", "min_targets")
+
+    volatility_decay = 0.3       # weight of the latest price move in the volatility moving average
+    volatility_weight = 10.0     # a 10% average move halves the interval
+    subscribers_weight = 0.25    # 16 subscribers halve the interval
+    proximity_window = 0.10      # products within 10% of the lowest target are polled faster
+    proximity_floor = 0.25       # ... down to a quarter of the interval right at the target
+    jitter = 0.10                # +/- 10% so products scheduled together drift apart
+
+    def __init__(self, logger: Callable, base_interval: float = MONITOR_PRODUCT_DELAY,
+                 min_interval: float = MONITOR_MIN_INTERVAL, max_interval: float = MONITOR_MAX_INTERVAL):
+
+        self.logger = logger
+        self.min_interval = max(1.0, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.base_interval = min(max(base_interval, self.min_interval), self.max_interval)
+        self.heap = list()
+        self.due_times = dict()
+        self.volatility = dict()
+        self.last_prices = dict()
+        self.subscribers = dict()
+        self.min_targets = dict()
+
+    # Updates the watched products from (asin, subscribers, min_target) rows. New products are spread evenly
+    # over one base interval instead of all being due at once, products nobody watches any more are dropped
+
+    def sync(self, watch_stats: list, now: float = None) -> None:
+
+        now = time.monotonic() if now is None else now
+        watched = set()
+        new_asins = list()
+
+        for asin, subscribers, min_target in watch_stats:
+
+            watched.add(asin)
+            self.subscribers[asin] = subscribers
+            self.min_targets[asin] = min_target
+
+            if asin not in self.due_times:
+                new_asins.append(asin)
+
+        for asin in list(self.due_times):
+
+            if asin not in watched:
+                self.forget(asin)
+
+        # On startup everything is new and gets spread over the base interval, later additions are due right away
+
+        spread = self.base_interval if len(new_asins) == len(watched) else 0.0
+
+        for position, asin in enumerate(new_asins):
+            self._push(asin, now + spread * position / max(len(new_asins), 1))
+
+        if new_asins:
+            self.logger.info(f"Scheduler: {len(new_asins)} new products scheduled, {len(self.due_times)} watched")
+
+    # Pops every product whose next-due time has passed
+
+    def due(self, now: float = None) -> List[str]:
+
+        now = time.monotonic() if now is None else now
+        asins = list()
+
+        while self.heap and self.heap[0][0] <= now:
+
+            due_time, asin = heapq.heappop(self.heap)
+
+            if self.due_times.get(asin) == due_time:  # skip entries superseded by a later reschedule
+                del self.due_times[asin]
+                asins.append(asin)
+
+        return asins
+
+    # Seconds until the next product is due, capped so the caller can still re-sync the watch list
+
+    def next_due_in(self, cap: float, now: float = None) -> float:
+
+        now = time.monotonic() if now is None else now
+
+        if not self.heap:
+            return cap
+
+        return min(max(self.heap[0][0] - now, 0.0), cap)
+
+    # Schedules the next poll of a product from its latest scrape (None when the fetch failed)
+
+    def reschedule(self, asin: str, product_data: Callable = None, now: float = None) -> float:
+
+        now = time.monotonic() if now is None else now
+
+        if asin not in self.subscribers:
+            return None  # unsubscribed while it was being fetched
+
+        interval = self.sample(asin, product_data)
+        self._push(asin, now + interval)
+        return interval
+
+    # Records the latest scrape in the volatility average and returns the interval until the next poll,
+    # without queueing the product (lease mode keeps the due times in the database)
+
+    def sample(self, asin: str, product_data: Callable = None) -> float:
+
+        if product_data is not None and product_data.availability:
+
+            previous = self.last_prices.get(asin)
+
+            if previous:
+                move = abs(product_data.current_price - previous) / previous
+                self.volatility[asin] = self.volatility_decay * move + (1 - self.volatility_decay) * self.volatility.get(asin, 0.0)
+
+            self.last_prices[asin] = product_data.current_price
+
+        return self.interval(asin, product_data)
+
+    # Puts a product whose fetch was carried over to the next cycle back in the queue as due right away
+
+    def retry(self, asin: str, now: float = None) -> None:
+
+        now = time.monotonic() if now is None else now
+
+        if asin in self.subscribers:
+            self._push(asin, now)
+
+    def interval(self, asin: str, product_data: Callable = None) -> float:
+
+        interval = self.base_interval
+        interval /= 1 + self.volatility_weight * self.volatility.get(asin, 0.0)
+        interval /= 1 + self.subscribers_weight * math.log2(max(self.subscribers.get(asin, 1), 1))
+
+        min_target = self.min_targets.get(asin)
+
+        if product_data is not None and product_data.availability and min_target and product_data.current_price > 0:
+
+            gap = (product_data.current_price - min_target) / product_data.current_price
+
+            if 0 < gap < self.proximity_window:
+                interval *= self.proximity_floor + (1 - self.proximity_floor) * gap / self.proximity_window
+
+        interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def forget(self, asin: str) -> None:
+
+        for state in (self.due_times, self.volatility, self.last_prices, self.subscribers, self.min_targets):
+            state.pop(asin, None)
+
+    def _push(self, asin: str, due_time: float) -> None:
+
+        self.due_times[asin] = due_time
+        heapq.heappush(self.heap, (due_time, asin))
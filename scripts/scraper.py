@@ -1,76 +1,350 @@
-from lxml import html
-from dataclasses import dataclass
-
-# Data struct in order to processing scraped products
-@dataclass(frozen=True)
-class AmazonProduct():
-
-    url: str
-    title: str 
-    vendor: str
-    rating: str
-    current_price: float
-    availability: bool
-
-
-class ProductParser:
-
-    __slots__ = ("logger",)
-
-    def __init__(self, logger):
-        self.logger = logger
-
-    # Main method of the class assigned to scrape html content using XPath with LXML parser
-
-    async def parse_product_data(self, HTTPResponse: classmethod) -> AmazonProduct:
-
-        try:
-
-                html_tree = html.fromstring(HTTPResponse.request_content.content)
-                title = html_tree.xpath("normalize-space(//span[@id='productTitle']/text())") 
-                price_decimal = html_tree.xpath("//div[@id='apex_desktop']//div[@id='corePriceDisplay_desktop_feature_div']//span[@class='a-price-whole']/text()")
-                price_floating = html_tree.xpath("//div[@id='apex_desktop']//div[@id='corePriceDisplay_desktop_feature_div']//span[@class='a-price-fraction']/text()")
-
-                if price_decimal and price_floating:
-                    
-                    price = float(f"{price_decimal[0].replace('.','')}.{price_floating[0]}")
-                    availability = True
-
-                else:
-
-                    price = 0.0
-                    availability = False
-
-                vendor = html_tree.xpath("normalize-space(//div[@id='merchantInfoFeature_feature_div']/div[@class='offer-display-feature-text']/div[@class='offer-display-feature-text a-spacing-none ']/span[@class='a-size-small offer-display-feature-text-message']//text())")
-
-                if not vendor:
-                     
-                     vendor = "N/A"
-
-                rating = html_tree.xpath("normalize-space(//div[@id='averageCustomerReviews_feature_div']//span[@id='acrPopover']/span[@class='a-declarative']/a[@class='a-popover-trigger a-declarative']/span[@class='a-size-base a-color-base']/text())")
-
-                if not rating:
-
-                    rating = 0
-
-                else:
-
-                    rating = float(rating.replace(",", "."))
-
-                # At the end of parsing, it creates an Amazonproduct dataclass with all the information obtained
-
-                product_data = AmazonProduct(
-
-                    url = HTTPResponse.url,
-                    title = title,
-                    vendor = vendor,
-                    rating = rating,
-                    current_price = price,
-                    availability = availability
-
-                )
-
-                return product_data
-
-        except Exception as e:  # errors handling
-                self.logger.error(f"Generic Scraping Data Error: {e}")
\ No newline at end of file
+import asyncio, multiprocessing, re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html import unescape
+from lxml import etree, html
+from dataclasses import dataclass, fields
+from typing import Optional
+from config.settings import PARSER_MODE, PARSER_WORKERS
+
+# Data struct in order to processing scraped products
+@dataclass(frozen=True)
+class AmazonProduct():
+
+    url: str
+    title: str 
+    vendor: str
+    rating: str
+    current_price: float
+    availability: bool
+
+
+# XPath expressions compiled once at import. The containers holding the product data are located with a single id()
+# lookup, answered from the parser's ID table without walking the document, the field expressions then run relative
+# to those subtrees instead of the whole page
+
+FIND_CONTAINERS = etree.XPath("id('productTitle corePriceDisplay_desktop_feature_div merchantInfoFeature_feature_div averageCustomerReviews_feature_div')")
+FIND_APEX_PRICE_BOXES = etree.XPath("//div[@id='apex_desktop']//div[@id='corePriceDisplay_desktop_feature_div']")
+IN_APEX_DESKTOP = etree.XPath("boolean(ancestor::div[@id='apex_desktop'])")
+TITLE = etree.XPath("normalize-space(text())")
+PRICE_WHOLE = etree.XPath(".//span[@class='a-price-whole']/text()")
+PRICE_FRACTION = etree.XPath(".//span[@class='a-price-fraction']/text()")
+VENDOR = etree.XPath("normalize-space(div[@class='offer-display-feature-text']/div[@class='offer-display-feature-text a-spacing-none ']/span[@class='a-size-small offer-display-feature-text-message']//text())")
+RATING = etree.XPath("normalize-space(.//span[@id='acrPopover']/span[@class='a-declarative']/a[@class='a-popover-trigger a-declarative']/span[@class='a-size-base a-color-base']/text())")
+
+
+# Builds an AmazonProduct from a product page, raises on pages it cannot read
+
+def extract_product(url: str, content: bytes) -> AmazonProduct:
+
+    html_tree = html.fromstring(content)
+    containers = {element.get("id"): element for element in FIND_CONTAINERS(html_tree)}
+
+    title_span = containers.get("productTitle")
+    title = TITLE(title_span) if title_span is not None and title_span.tag == "span" else ""
+
+    # id() only returns the first element with a given id, a price box outside apex_desktop falls back to the full search
+
+    price_box = containers.get("corePriceDisplay_desktop_feature_div")
+    price_boxes = [price_box] if price_box is not None and IN_APEX_DESKTOP(price_box) else FIND_APEX_PRICE_BOXES(html_tree) if price_box is not None else []
+    price_decimal = [text for box in price_boxes for text in PRICE_WHOLE(box)]
+    price_floating = [text for box in price_boxes for text in PRICE_FRACTION(box)]
+
+    if price_decimal and price_floating:
+
+        price = float(f"{price_decimal[0].replace('.','')}.{price_floating[0]}")
+        availability = True
+
+    else:
+
+        price = 0.0
+        availability = False
+
+    vendor_box = containers.get("merchantInfoFeature_feature_div")
+    vendor = VENDOR(vendor_box) if vendor_box is not None else ""
+
+    if not vendor:
+        vendor = "N/A"
+
+    rating_box = containers.get("averageCustomerReviews_feature_div")
+    rating = RATING(rating_box) if rating_box is not None else ""
+    rating = float(rating.replace(",", ".")) if rating else 0
+
+    return AmazonProduct(
+
+        url = url,
+        title = title,
+        vendor = vendor,
+        rating = rating,
+        current_price = price,
+        availability = availability
+
+    )
+
+
+# Byte-level fast path: the same fields read with targeted scans of the raw response, no DOM is built.
+# Anything it cannot read exactly as the XPath expressions would (a missing title, markup that differs from the
+# expected one, several elements with the same id) makes it return None, and the caller falls back to extract_product
+
+TITLE_MARKER = b'id="productTitle"'
+PRICE_MARKER = b'id="corePriceDisplay_desktop_feature_div"'
+APEX_MARKER = b'id="apex_desktop"'
+VENDOR_MARKER = b'id="merchantInfoFeature_feature_div"'
+RATING_MARKER = b'id="averageCustomerReviews_feature_div"'
+
+DIV_TAG = re.compile(rb"<(/?)div\b")
+# Start tag with an exact class attribute anywhere among its attributes, as the XPath @class tests read it
+def tag(name: bytes, class_name: bytes) -> bytes:
+    return rb'<' + name + rb'\b[^>]*?\sclass="' + re.escape(class_name) + rb'"[^>]*>'
+
+PRICE_WHOLE_TEXT = re.compile(tag(b"span", b"a-price-whole") + rb'([0-9.]+)<')
+PRICE_FRACTION_TEXT = re.compile(tag(b"span", b"a-price-fraction") + rb'([0-9]+)<')
+VENDOR_TEXT = re.compile(tag(b"div", b"offer-display-feature-text") + rb'\s*' + tag(b"div", b"offer-display-feature-text a-spacing-none ") + rb'\s*' + tag(b"span", b"a-size-small offer-display-feature-text-message") + rb'([^<]*)<')
+RATING_TEXT = re.compile(tag(b"span", b"a-declarative") + rb'\s*' + tag(b"a", b"a-popover-trigger a-declarative") + rb'\s*' + tag(b"span", b"a-size-base a-color-base") + rb'([^<]*)<')
+XPATH_SPACE = re.compile(r"[ \t\r\n]+")
+
+class AmbiguousPage(Exception):
+    pass
+
+# Same whitespace handling as XPath normalize-space(), which leaves non-breaking spaces alone
+
+def normalize_space(raw: bytes) -> str:
+    return XPATH_SPACE.sub(" ", unescape(raw.decode("utf-8"))).strip(" \t\r\n")
+
+# Position of the single element carrying the marker, None when absent. Only an id attribute counts, the same
+# text at the end of another attribute (e.g. data-csa-c-slot-id="corePriceDisplay_desktop_feature_div") does not
+
+def find_unique(content: bytes, marker: bytes) -> Optional[int]:
+
+    found = None
+    position = content.find(marker)
+
+    while position != -1:
+
+        if content[position - 1:position].isspace():
+
+            if found is not None:
+                raise AmbiguousPage(f"duplicate {marker.decode()}")
+
+            found = position
+
+        position = content.find(marker, position + len(marker))
+
+    return found
+
+# Bytes of the div whose start tag holds the marker, from its start tag to the matching </div>
+
+def div_region(content: bytes, position: int) -> bytes:
+
+    start = content.rfind(b"<", 0, position)
+
+    if not content.startswith(b"<div", start):
+        raise AmbiguousPage("container is not a div")
+
+    depth = 0
+
+    for tag in DIV_TAG.finditer(content, start):
+
+        depth += -1 if tag.group(1) else 1
+
+        if depth == 0:
+            return content[start:tag.end()]
+
+    raise AmbiguousPage("unterminated container")
+
+# Text of the element with the class, "" when the region does not contain the class at all.
+# The first occurrence of the class must be the one the pattern matched, and blank text is ambiguous
+# because the HTML parser may drop it and read the next text node instead
+
+def region_text(region: bytes, pattern: re.Pattern, class_name: bytes) -> str:
+
+    first = region.find(class_name)
+
+    if first == -1:
+        return ""
+
+    match = pattern.search(region)
+
+    if match is None or first < match.start():
+        raise AmbiguousPage(f"unexpected {class_name.decode()} markup")
+
+    text = normalize_space(match.group(1))
+
+    if not text:
+        raise AmbiguousPage(f"blank {class_name.decode()} text")
+
+    return text
+
+def extract_product_fast(url: str, content: bytes) -> Optional[AmazonProduct]:
+
+    try:
+
+        # Title: the text of span#productTitle, which must not contain any other element
+
+        position = find_unique(content, TITLE_MARKER)
+
+        if position is None or not content.startswith(b"<span", content.rfind(b"<", 0, position)):
+            return None
+
+        text_start = content.index(b">", position) + 1
+        text_end = content.index(b"<", text_start)
+
+        if not content.startswith(b"</span>", text_end):
+            return None
+
+        title = normalize_space(content[text_start:text_end])
+
+        # Price: whole and fraction parts inside the apex_desktop price box
+
+        position = find_unique(content, PRICE_MARKER)
+        apex = find_unique(content, APEX_MARKER)
+        price = 0.0
+        availability = False
+
+        if position is not None and apex is not None and apex < position < content.rfind(b"<", 0, apex) + len(div_region(content, apex)):
+
+            region = div_region(content, position)
+            price_decimal = region_text(region, PRICE_WHOLE_TEXT, b"a-price-whole")
+            price_floating = region_text(region, PRICE_FRACTION_TEXT, b"a-price-fraction")
+
+            if price_decimal and price_floating:
+                price = float(f"{price_decimal.replace('.','')}.{price_floating}")
+                availability = True
+
+        position = find_unique(content, VENDOR_MARKER)
+        vendor = region_text(div_region(content, position), VENDOR_TEXT, b"offer-display-feature-text-message") if position is not None else ""
+
+        position = find_unique(content, RATING_MARKER)
+        rating = region_text(div_region(content, position), RATING_TEXT, b"a-size-base a-color-base") if position is not None else ""
+
+        return AmazonProduct(
+
+            url = url,
+            title = title,
+            vendor = vendor or "N/A",
+            rating = float(rating.replace(",", ".")) if rating else 0,
+            current_price = price,
+            availability = availability
+
+        )
+
+    except (AmbiguousPage, ValueError):  # ValueError covers bytes.index misses and invalid UTF-8
+        return None
+
+
+# Streaming fetch helper: feeds the body to an lxml pull parser and reports once the closing tags of every container the
+# parsers read have gone by, so the rest of the page (reviews, recommendations, scripts) need not be downloaded.
+# A page missing one of the containers is read to the end
+
+class ProductPageWatcher:
+
+    __slots__ = ("parser", "pending")
+
+    containers = ("productTitle", "apex_desktop", "merchantInfoFeature_feature_div", "averageCustomerReviews_feature_div")
+
+    def __init__(self):
+        self.parser = etree.HTMLPullParser(events = ("end",), tag = ("span", "div"))
+        self.pending = set(self.containers)
+
+    def feed(self, chunk: bytes) -> bool:
+
+        self.parser.feed(chunk)
+
+        for _, element in self.parser.read_events():
+            self.pending.discard(element.get("id"))
+
+        return not self.pending
+
+
+# Parses one page according to the parser mode, returns the product and the (level, message) log records of diff mode.
+# Module-level and free of shared state, so it runs the same on the event loop or in a parser process
+
+def parse_page(url: str, content: bytes, mode: str = PARSER_MODE) -> tuple:
+
+    if mode == "lxml":
+        return extract_product(url, content), []
+
+    product_data = extract_product_fast(url, content)
+
+    if mode == "diff":
+
+        reference = extract_product(url, content)
+
+        if product_data is None:
+            return reference, [("info", f"Parser diff: fast path fell back to lxml for {url}")]
+
+        if product_data != reference:
+            mismatches = [f"{field.name} {getattr(product_data, field.name)!r} != {getattr(reference, field.name)!r}" for field in fields(AmazonProduct) if getattr(product_data, field.name) != getattr(reference, field.name)]
+            return reference, [("warning", f"Parser diff: fast path disagrees with lxml for {url}: " + ", ".join(mismatches))]
+
+        return reference, []
+
+    return product_data if product_data is not None else extract_product(url, content), []
+
+
+class ProductParser:
+
+    __slots__ = ("logger", "mode", "workers", "executor")
+
+    def __init__(self, logger, mode: str = PARSER_MODE, workers: int = PARSER_WORKERS):
+        self.logger = logger
+        self.mode = mode
+        self.workers = max(0, workers)
+        self.executor = None
+
+        if self.workers:
+            self.start_executor()
+
+    # Process pool parse backend: raw bytes go to the workers, AmazonProduct dataclasses come back.
+    # The first task makes the pool fork its workers right away, before the event loop and the database threads exist.
+    # A replacement pool started later passes a spawn context instead, its workers never inherit those
+
+    def start_executor(self, context: Optional[multiprocessing.context.BaseContext] = None) -> None:
+
+        self.executor = ProcessPoolExecutor(max_workers = self.workers, mp_context = context)
+        self.executor.submit(int).result()
+        self.logger.info(f"Parser: Started {self.workers} parser processes")
+
+    def close(self) -> None:
+
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures = True)
+            self.executor = None
+
+    # Main method of the class assigned to scrape html content: the precompiled XPath expressions of extract_product,
+    # the byte-level fast path with lxml fallback, or both compared field by field depending on PARSER_MODE
+
+    async def parse_product_data(self, HTTPResponse: classmethod) -> AmazonProduct:
+
+        executor = self.executor
+
+        try:
+
+                url, content = str(HTTPResponse.url), HTTPResponse.request_content.content
+
+                if executor is None:
+                    product_data, records = parse_page(url, content, self.mode)
+                else:
+                    product_data, records = await asyncio.get_running_loop().run_in_executor(executor, parse_page, url, content, self.mode)
+
+                for level, message in records:
+                    getattr(self.logger, level)(message)
+
+                return product_data
+
+        except BrokenProcessPool as e:  # a parser process died, the first failing page replaces the pool
+                self.logger.error(f"Generic Scraping Data Error: {e}")
+
+                # The new pool starts in a thread so the event loop keeps running, meanwhile pages are parsed in this process
+
+                if self.executor is executor:
+                    executor.shutdown(wait = False)
+                    self.executor = None
+
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(None, self.start_executor, multiprocessing.get_context("spawn"))
+                    except Exception as e:
+                        self.logger.error(f"Parser: Unable to restart the parser processes, parsing in this process: {e}")
+
+        except Exception as e:  # errors handling
+                self.logger.error(f"Generic Scraping Data Error: {e}")
@@ -0,0 +1,28 @@
+import bisect, hashlib
+
+
+# Consistent hash ring assigning every ASIN to one of the ProductMonitor shards. Each shard owns many virtual points
+# on the ring, so changing the number of shards only moves the ASINs next to the added or removed points
+# (about 1/N of the catalogue) and every process computes the same owner without talking to the others
+
+class HashRing:
+
+    __slots__ = ("shards", "points", "owners")
+
+    replicas = 128  # virtual points per shard, more points spread the ASINs more evenly
+
+    def __init__(self, shards: int):
+
+        self.shards = max(1, shards)
+        ring = sorted((self.hash(f"shard-{shard}-{replica}"), shard) for shard in range(self.shards) for replica in range(self.replicas))
+        self.points = [point for point, _ in ring]
+        self.owners = [shard for _, shard in ring]
+
+    # Stable across processes and restarts, unlike the salted built-in hash()
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size = 8).digest(), "big")
+
+    def owner(self, asin: str) -> int:
+        return self.owners[bisect.bisect(self.points, self.hash(asin)) % len(self.points)]
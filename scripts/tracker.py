@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+from typing import Any, Callable, List
+from scripts.scraper import AmazonProduct
+
+# Data struct describing a single field that changed between two scrapes of the same product
+@dataclass(frozen=True)
+class ProductChange:
+
+    asin: str
+    field: str
+    old: Any
+    new: Any
+
+
+# Class assigned to remember the last AmazonProduct seen for every ASIN and to diff new scrapes against it
+
+class ProductTracker:
+
+    __slots__ = ("logger", "products")
+
+    tracked_fields = ("title", "vendor", "rating", "current_price", "availability")
+
+    def __init__(self, logger: Callable):
+        self.logger = logger
+        self.products = dict()
+
+    # Seeds the tracker from the ASIN table, so a restart does not rewrite every product on the first cycle
+
+    async def load(self, db: Callable) -> None:
+
+        for asin, title, last_price in await db.get_asin_snapshots():
+            self.products[asin] = self.snapshot(asin, title, last_price)
+
+        self.logger.info(f"Tracker: Loaded {len(self.products)} products from the database")
+
+    # Lease mode: another worker may have written the product since this one last polled it. When the database row
+    # differs from the remembered title or price the row becomes the new baseline, returns whether it was replaced
+
+    def sync(self, asin: str, title: str, last_price: float) -> bool:
+
+        previous = self.products.get(asin)
+
+        if previous is not None and previous.title == title and previous.current_price == (last_price or 0.0):
+            return False
+
+        self.products[asin] = self.snapshot(asin, title, last_price)
+        return True
+
+    @staticmethod
+    def snapshot(asin: str, title: str, last_price: float) -> AmazonProduct:
+
+        last_price = last_price or 0.0
+
+        return AmazonProduct(
+
+            url = f"https://amazon.it/dp/{asin}",
+            title = title,
+            vendor = "N/A",
+            rating = 0,
+            current_price = last_price,
+            availability = last_price > 0
+
+        )
+
+    # Stores the new scrape and returns the fields that differ from the previous one
+
+    def update(self, asin: str, product: AmazonProduct) -> List[ProductChange]:
+
+        previous = self.products.get(asin)
+        self.products[asin] = product
+
+        changes = list()
+
+        for field in self.tracked_fields:
+
+            old = getattr(previous, field) if previous is not None else None
+            new = getattr(product, field)
+
+            if old != new:
+                changes.append(ProductChange(asin = asin, field = field, old = old, new = new))
+
+        return changes
+
+    def get(self, asin: str) -> AmazonProduct:
+        return self.products.get(asin)
+
+    def forget(self, asin: str) -> None:
+        self.products.pop(asin, None)
+
+    # Drops every product outside the given ASINs, e.g. the ones another monitor shard owns
+
+    def retain(self, asins: set) -> None:
+
+        for asin in self.products.keys() - asins:
+            del self.products[asin]
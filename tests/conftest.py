@@ -0,0 +1,23 @@
+import logging, os, sys
+import pytest
+
+# The settings are read from the environment and the .env file at import: the tests run on the defaults
+# (variables already set in the environment still win) and import the packages from the repository root
+
+for name, value in (("MONITOR_PRODUCT_DELAY", "900"), ("ADMIN_CHAT_ID", "0"), ("SAVE_LOGS_TO_FILE", "false"), ("EMAIL_USE_TLS", "true")):
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db.db import DatabaseManager
+
+
+# Fresh DatabaseManager on an empty file. It is a singleton, so the instance is reset around every test.
+# Its connection pool belongs to the event loop of the test, which must close it before returning
+
+@pytest.fixture
+def database(tmp_path):
+
+    DatabaseManager._instance = None
+    yield DatabaseManager(logging.getLogger("tests"), db_name = str(tmp_path / "amazon_bot.db"))
+    DatabaseManager._instance = None
@@ -0,0 +1,64 @@
+import asyncio, time
+import pytest
+import db.db as db_module
+
+
+# A digest claim pulls the recipient's alerts still waiting for their window, never a failed one before its backoff is over
+
+def test_digest_claim_skips_alerts_in_retry_backoff(database):
+
+    async def claim():
+        try:
+            await database.create_tables()
+            now = time.time()
+
+            async with database.connection() as db:
+                await db.executemany('''
+                    INSERT INTO AlertOutbox (idempotency_key, channel, chat_id, asin, payload, attempts, created_at, next_attempt_at)
+                    VALUES (?, 'telegram', 1, ?, '{}', ?, ?, ?)
+                ''', [("due", "B0EXAMPLE1", 0, now, now - 1),
+                      ("window", "B0EXAMPLE2", 0, now, now + 600),
+                      ("backoff", "B0EXAMPLE3", 1, now, now + 600),
+                      ("retry", "B0EXAMPLE4", 2, now, now - 1)])
+
+            return await database.claim_alerts(1, 60, by_recipient = True)
+        finally:
+            await database.close()
+
+    assert sorted(row[4] for row in asyncio.run(claim())) == ["B0EXAMPLE1", "B0EXAMPLE2", "B0EXAMPLE4"]
+
+
+# The same user is alerted again once the price falls by either configured threshold, the smaller one decides
+
+@pytest.mark.parametrize("min_drop, min_drop_percent, price, alerted", [
+    (5.0, 2.0, 48.0, True),  # 2 euros: under 5 but over 2% of 50
+    (5.0, 10.0, 48.0, False),  # under both
+    (0.0, 10.0, 48.0, False),  # an unset threshold does not lower the other one
+    (0.0, 10.0, 45.0, True),
+    (1.0, 0.0, 49.0, True),
+    (0.0, 0.0, 49.99, True),
+    (0.0, 0.0, 49.999, False),  # half a cent at least
+])
+def test_alert_hysteresis_takes_the_smaller_threshold(database, monkeypatch, min_drop, min_drop_percent, price, alerted):
+
+    monkeypatch.setattr(db_module, "ALERT_MIN_DROP", min_drop)
+    monkeypatch.setattr(db_module, "ALERT_MIN_DROP_PERCENT", min_drop_percent)
+
+    async def alerts_after_drop():
+        try:
+            await database.create_tables()
+            await database.add_user(1)
+            await database.add_asin("B0EXAMPLE1")
+            await database.link_user_to_asin(1, "B0EXAMPLE1", 100)
+
+            for new_price in (50.0, price):
+                await database.buffer_last_price("B0EXAMPLE1", new_price, alert = {})
+                await database.flush_updates()
+
+            async with database.connection() as db:
+                async with db.execute('SELECT COUNT(*) FROM AlertOutbox') as cursor:
+                    return (await cursor.fetchone())[0]
+        finally:
+            await database.close()
+
+    assert asyncio.run(alerts_after_drop()) == (2 if alerted else 1)
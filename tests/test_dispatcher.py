@@ -0,0 +1,64 @@
+import asyncio, json, logging
+from types import SimpleNamespace
+import scripts.dispatcher as dispatcher_module
+from scripts.dispatcher import AlertDispatcher
+
+PAYLOAD = json.dumps({"url": "https://amazon.it/dp/B0EXAMPLE1", "title": "Product", "vendor": "Amazon", "rating": 4.6,
+                      "current_price": 35.0, "availability": True})
+
+
+# Stand-in for the DatabaseManager alert methods, raising once where told to and stopping the loop on the third claim
+
+class FlakyOutbox:
+
+    def __init__(self, failing: set):
+        self.failing = failing
+        self.calls = list()
+
+    def call(self, name: str) -> None:
+        self.calls.append(name)
+        if name in self.failing:
+            self.failing.discard(name)
+            raise RuntimeError("database is locked")
+
+    async def prune_alerts(self, cutoff: float) -> None:
+        self.call("prune")
+
+    async def claim_alerts(self, limit: int, claim_seconds: float, by_recipient: bool = False) -> list:
+        self.call("claim")
+        if self.calls.count("claim") == 3:
+            raise asyncio.CancelledError()
+        return [(1, "telegram", 1, None, "B0EXAMPLE1", PAYLOAD, 0)] if self.calls.count("claim") == 1 else []
+
+    async def complete_alerts(self, sent: list, failed: list, max_attempts: int, retry_backoff: float) -> int:
+        self.call(f"complete {sent}")
+        return 0
+
+
+# Database errors are retried instead of killing the dispatcher, and a delivered batch whose outcome could not be
+# recorded is recorded again before anything else is claimed, never delivered twice
+
+def test_dispatcher_survives_database_errors(monkeypatch):
+
+    monkeypatch.setattr(dispatcher_module, "ALERT_POLL_INTERVAL", 0)
+
+    outbox = FlakyOutbox({"prune", "complete [1]"})
+    delivered = list()
+
+    async def enqueue_menu(chat_id, text, keyboard):
+        delivered.append(chat_id)
+        return True
+
+    async def send_email_batch(messages):
+        return []
+
+    bot = SimpleNamespace(enqueue_menu = enqueue_menu, outbox = SimpleNamespace(summary = lambda: ""))
+    dispatcher = AlertDispatcher(logging.getLogger("tests"), outbox, bot, SimpleNamespace(send_email_batch = send_email_batch))
+
+    try:
+        asyncio.run(dispatcher.run())
+    except asyncio.CancelledError:
+        pass
+
+    assert delivered == [1]
+    assert outbox.calls == ["prune", "prune", "claim", "complete [1]", "complete [1]", "claim", "claim"]
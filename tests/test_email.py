@@ -0,0 +1,95 @@
+import asyncio, logging, socket
+import pytest
+from scripts.alert import AlertManager
+
+aiosmtpd = pytest.importorskip("aiosmtpd")
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+
+def free_port() -> int:
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Local stand-in SMTP server with AUTH and no TLS, keeping every message it receives
+
+class Mailbox:
+
+    def __init__(self):
+        self.received = list()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received.append(envelope.rcpt_tos[0])
+        return "250 OK"
+
+
+def stand_in_server(mailbox: Mailbox, port: int) -> Controller:
+
+    return Controller(mailbox, hostname = "127.0.0.1", port = port, auth_require_tls = False,
+                      authenticator = lambda server, session, envelope, mechanism, auth_data: AuthResult(success = True))
+
+
+@pytest.fixture
+def alert_manager(monkeypatch):
+
+    manager = AlertManager(logging.getLogger("tests"))
+    manager.email_smtp_server = "127.0.0.1"
+    manager.email_smtp_port = free_port()
+    manager.email_use_tls = False
+
+    connections = list()
+    connect = AlertManager.connect
+
+    def counted_connect(self):
+        connections.append(self.email_smtp_port)
+        return connect(self)
+
+    monkeypatch.setattr(AlertManager, "connect", counted_connect)
+    yield manager, connections
+    manager.close()
+
+
+def batch(count: int, start: int = 0) -> list:
+    return [(f"user{number}@example.com", f"Alert {number}", f"<alert-{number}@amazon-it-price-tracker>") for number in range(start, start + count)]
+
+
+# Two batches go over a single session, and a session the server dropped (restart) is reopened for the next message
+
+def test_batch_reuses_the_session_and_reconnects(alert_manager):
+
+    manager, connections = alert_manager
+    mailbox = Mailbox()
+    server = stand_in_server(mailbox, manager.email_smtp_port)
+    server.start()
+
+    try:
+        first = asyncio.run(manager.send_email_batch(batch(5)))
+        second = asyncio.run(manager.send_email_batch(batch(5, start = 5)))
+
+        assert first + second == [True] * 10
+        assert len(connections) == 1
+
+        server.stop()
+        server = stand_in_server(mailbox, manager.email_smtp_port)
+        server.start()
+
+        assert asyncio.run(manager.send_email_batch(batch(3, start = 10))) == [True] * 3
+        assert len(connections) == 2
+        assert mailbox.received == [f"user{number}@example.com" for number in range(13)]
+
+    finally:
+        server.stop()
+
+
+# With the server unreachable the batch fails after one connection attempt, not one (or two) per message
+
+def test_unreachable_server_fails_the_batch_at_once(alert_manager):
+
+    manager, connections = alert_manager
+
+    assert asyncio.run(manager.send_email_batch(batch(20))) == [False] * 20
+    assert len(connections) == 1
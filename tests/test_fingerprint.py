@@ -0,0 +1,88 @@
+import asyncio, logging, os
+import httpx
+import pytest
+from scripts.client import WebRequest, content_fingerprint
+
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "pages")
+URL = "https://www.amazon.it/dp/B0EXAMPLE1"
+
+def load_page(page: str) -> bytes:
+
+    with open(os.path.join(PAGES, page), "rb") as file:
+        return file.read()
+
+def replace_once(content: bytes, old: bytes, new: bytes) -> bytes:
+
+    assert content.count(old) == 1
+    return content.replace(old, new)
+
+# Price of in_stock.html (the carousels hold other prices), a 10€ drop, and a 5 KB inline style for the top of the price box
+PRICE = b'<span class="a-price-whole">89<span class="a-price-decimal">,</span></span><span class="a-price-fraction">99<'
+LOWER_PRICE = PRICE.replace(b">89<", b">79<")
+PRICE_BOX = b'data-csa-c-slot-id="corePriceDisplay_desktop_feature_div">'
+STYLE = b"<style>" + b".a-price-override{color:#B12704;}" * 160 + b"</style>"
+
+
+@pytest.mark.parametrize("page", sorted(name for name in os.listdir(PAGES) if name.endswith(".html")))
+def test_every_page_has_a_stable_fingerprint(page):
+
+    content = load_page(page)
+
+    assert content_fingerprint(content) is not None
+    assert content_fingerprint(content) == content_fingerprint(bytes(content))
+
+
+@pytest.mark.parametrize("old, new", [
+    (PRICE, LOWER_PRICE),
+    (b"Grafite       </span>", b"Nero       </span>"),  # title
+    (b'offer-display-feature-text-message">Amazon<', b'offer-display-feature-text-message">Altro venditore<'),  # seller
+    (b'<span class="a-size-base a-color-base">4,6</span> <i', b'<span class="a-size-base a-color-base">4,5</span> <i'),  # rating
+])
+def test_changes_the_parsers_read_change_the_fingerprint(old, new):
+
+    content = load_page("in_stock.html")
+    assert content_fingerprint(replace_once(content, old, new)) != content_fingerprint(content)
+
+
+def test_price_drop_behind_a_large_style_changes_the_fingerprint():
+
+    styled = replace_once(load_page("in_stock.html"), PRICE_BOX, PRICE_BOX + STYLE)
+    assert content_fingerprint(replace_once(styled, PRICE, LOWER_PRICE)) != content_fingerprint(styled)
+
+
+def test_changes_outside_the_product_regions_keep_the_fingerprint():
+
+    content = load_page("in_stock.html")
+    changed = content.replace(b'name="session-id" value="', b'name="session-id" value="1')
+    changed = replace_once(changed, b'<div id="navFooter"', b'<div id="sponsored">Annuncio</div><div id="navFooter"')
+
+    assert changed != content
+    assert content_fingerprint(changed) == content_fingerprint(content)
+
+
+def test_duplicate_containers_have_no_fingerprint():
+
+    content = load_page("in_stock.html").replace(b"</body>", b'<div id="apex_desktop"></div></body>')
+    assert content_fingerprint(content) is None
+
+
+# A price drop behind a large inline style must be reported as a changed page, so the monitor parses it again,
+# while the same page fetched again is still recognised as unchanged
+
+def test_price_drop_behind_a_large_style_is_not_reported_unchanged():
+
+    styled = replace_once(load_page("in_stock.html"), PRICE_BOX, PRICE_BOX + STYLE)
+    dropped = replace_once(styled, PRICE, LOWER_PRICE)
+    responses = [styled, dropped, dropped]
+
+    async def fetch_all():
+
+        client = WebRequest(logging.getLogger("tests"))
+        client.session.pools["amazon"].client = httpx.AsyncClient(transport = httpx.MockTransport(lambda request: httpx.Response(200, content = responses.pop(0))))
+
+        try:
+            return [(await client.make_request("GET", URL, revalidate = True)).unchanged for _ in range(3)]
+        finally:
+            await client.close()
+
+    assert asyncio.run(fetch_all()) == [False, False, True]
@@ -0,0 +1,157 @@
+import asyncio, logging, multiprocessing, time
+from dataclasses import replace
+from types import SimpleNamespace
+from db.db import DatabaseManager
+from scripts.functions import lease_monitor_loop
+from scripts.tracker import ProductTracker
+
+
+# Two workers share the database: A polls the product at 40, B later writes 45 (re-arming the alert for a 42 target).
+# When A claims it again the stored 45 must be its baseline, so seeing 40 once more is a price change
+
+def test_claimed_product_is_diffed_against_the_database(database):
+
+    async def claim_after_other_worker():
+        try:
+            await database.create_tables()
+            await database.add_user(1)
+            await database.add_asin("B0EXAMPLE1", title = "Product", current_price = 40.0)
+            await database.link_user_to_asin(1, "B0EXAMPLE1", 42)
+
+            tracker = ProductTracker(logging.getLogger("tests"))
+            await tracker.load(database)
+            seen = tracker.get("B0EXAMPLE1")
+
+            await database.update_last_price("B0EXAMPLE1", 45.0)
+            return tracker, seen, await database.claim_due_asins("worker-a", 10, 60)
+        finally:
+            await database.close()
+
+    tracker, seen, rows = asyncio.run(claim_after_other_worker())
+
+    assert rows == [("B0EXAMPLE1", "Product", 45.0)]
+    assert tracker.sync(*rows[0])
+    assert tracker.get("B0EXAMPLE1").current_price == 45.0
+    assert not tracker.sync(*rows[0])
+
+    changes = tracker.update("B0EXAMPLE1", replace(seen))
+    assert [(change.field, change.old, change.new) for change in changes] == [("current_price", 45.0, 40.0)]
+
+
+# Worker process of the lease tests: claims batches of limit products until none is due, on its own DatabaseManager
+
+def claim_until_empty(db_name: str, owner: str, limit: int, lease_seconds: float, start, results) -> None:
+
+    async def claim() -> list:
+
+        DatabaseManager._instance = None
+        database = DatabaseManager(logging.getLogger("tests"), db_name = db_name)
+        claimed = list()
+
+        try:
+            start.wait()
+
+            while rows := await database.claim_due_asins(owner, limit, lease_seconds):
+                claimed += [asin for asin, title, last_price in rows]
+        finally:
+            await database.close()
+
+        return claimed
+
+    results.put((owner, asyncio.run(claim())))
+
+
+def run_workers(db_name: str, owners: list, limit: int, lease_seconds: float) -> dict:
+
+    context = multiprocessing.get_context("spawn")
+    start = context.Barrier(len(owners))
+    results = context.Queue()
+    workers = [context.Process(target = claim_until_empty, args = (db_name, owner, limit, lease_seconds, start, results)) for owner in owners]
+
+    for worker in workers:
+        worker.start()
+
+    claims = dict(results.get(timeout = 60) for _ in workers)
+
+    for worker in workers:
+        worker.join()
+
+    return claims
+
+
+# Processes sharing one SQLite file claim concurrently: every due product goes to exactly one of them, and a lease
+# that expired (its worker crashed) is claimed again by another process
+
+def test_processes_sharing_the_database_never_claim_the_same_product(database):
+
+    asins = [f"B0EXAMPLE{number:02d}" for number in range(40)]
+
+    async def populate():
+        try:
+            await database.create_tables()
+            await database.add_user(1)
+
+            for asin in asins:
+                await database.add_asin(asin)
+                await database.link_user_to_asin(1, asin, 42)
+        finally:
+            await database.close()
+
+    asyncio.run(populate())
+
+    async def claim_now():
+        try:
+            return await database.claim_due_asins("worker-d", 50, 60)
+        finally:
+            await database.close()
+
+    claims = run_workers(database.db_name, ["worker-a", "worker-b", "worker-c"], 3, 1.0)
+    claimed = [asin for owner_claims in claims.values() for asin in owner_claims]
+
+    assert asyncio.run(claim_now()) == []  # the leases are still held
+    assert sorted(claimed) == asins
+    assert len(set(claimed)) == len(claimed)
+
+    time.sleep(1.1)
+    assert sorted(run_workers(database.db_name, ["worker-d"], 50, 60)["worker-d"]) == asins
+
+
+# Cancelled mid-cycle, the worker writes the buffered results before giving its leases back as due
+
+def test_shutdown_flushes_results_before_releasing_leases():
+
+    calls = list()
+
+    async def get_watch_stats():
+        return [("B0EXAMPLE1", 1, 42.0)]
+
+    async def claim_due_asins(owner, limit, lease_seconds):
+        return [("B0EXAMPLE1", "Product", 40.0)]
+
+    async def flush_updates():
+        calls.append("flush")
+
+    async def release_leases(owner, due_times):
+        calls.append(f"release {sorted(due_times)}")
+
+    async def run_cycle(asins):
+        await asyncio.sleep(60)
+
+    db = SimpleNamespace(get_watch_stats = get_watch_stats, claim_due_asins = claim_due_asins, flush_updates = flush_updates, release_leases = release_leases)
+    pipeline = SimpleNamespace(run_cycle = run_cycle, client = SimpleNamespace(invalidate = lambda url: None))
+    scheduler = SimpleNamespace(sync = lambda watch_stats: None)
+
+    async def cancel_mid_cycle():
+
+        task = asyncio.ensure_future(lease_monitor_loop(logging.getLogger("tests"), db, ProductTracker(logging.getLogger("tests")), pipeline, scheduler))
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(cancel_mid_cycle())
+
+    assert calls == ["flush", "release ['B0EXAMPLE1']"]
@@ -0,0 +1,108 @@
+import asyncio, json, logging, os
+import httpx
+import pytest
+from scripts.client import HTTPResponse
+from scripts.scraper import AmazonProduct, ProductParser, extract_product, extract_product_fast, parse_page
+
+# Saved product pages and the AmazonProduct the original parser (before the precompiled XPath engine) read from each one
+
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "pages")
+URL = "https://www.amazon.it/dp/B0EXAMPLE1"
+
+with open(os.path.join(PAGES, "expected.json"), encoding = "utf-8") as file:
+    EXPECTED = json.load(file)
+
+def load_page(page: str) -> bytes:
+
+    with open(os.path.join(PAGES, page), "rb") as file:
+        return file.read()
+
+def expected_product(page: str) -> AmazonProduct:
+    return AmazonProduct(url = URL, **EXPECTED[page])
+
+
+@pytest.mark.parametrize("page", sorted(EXPECTED))
+def test_extract_product_matches_the_original_parser(page):
+    assert extract_product(URL, load_page(page)) == expected_product(page)
+
+
+@pytest.mark.parametrize("page", sorted(EXPECTED))
+def test_lxml_mode_parses_like_the_original_parser(page):
+    assert parse_page(URL, load_page(page), "lxml") == (expected_product(page), [])
+
+
+@pytest.mark.parametrize("page", sorted(EXPECTED))
+def test_product_parser_reads_the_http_response(page):
+
+    response = httpx.Response(200, content = load_page(page), request = httpx.Request("GET", URL))
+    parser = ProductParser(logging.getLogger("tests"), mode = "lxml", workers = 0)
+
+    product = asyncio.run(parser.parse_product_data(HTTPResponse(url = response.url, status_code = 200, headers = {}, request_content = response)))
+
+    assert product == expected_product(page)
+
+
+
+# The byte-level fast path must read every page of the corpus by itself, without falling back to lxml
+
+@pytest.mark.parametrize("page", sorted(EXPECTED))
+def test_fast_path_reads_the_page_without_falling_back(page):
+    assert extract_product_fast(URL, load_page(page)) == expected_product(page)
+
+
+@pytest.mark.parametrize("page", sorted(EXPECTED))
+def test_diff_mode_finds_no_disagreement(page):
+    assert parse_page(URL, load_page(page), "diff") == (expected_product(page), [])
+
+
+def test_fast_path_falls_back_on_a_duplicate_price_box():
+
+    content = load_page("in_stock.html").replace(b"</body>", b'<div id="corePriceDisplay_desktop_feature_div"></div></body>')
+
+    assert extract_product_fast(URL, content) is None
+    assert parse_page(URL, content, "fast") == (expected_product("in_stock.html"), [])
+
+
+# A parser process that dies breaks the pool: the failing page is lost, the pool is replaced by spawned workers
+# started off the event loop (a heartbeat task keeps ticking meanwhile) and the next page is parsed by them
+
+def test_product_parser_replaces_a_broken_pool_off_the_event_loop():
+
+    response = httpx.Response(200, content = load_page("in_stock.html"), request = httpx.Request("GET", URL))
+    http_response = HTTPResponse(url = response.url, status_code = 200, headers = {}, request_content = response)
+    parser = ProductParser(logging.getLogger("tests"), mode = "lxml", workers = 1)
+    broken = parser.executor
+
+    async def parse_after_crash():
+
+        gaps = list()
+
+        async def heartbeat():
+            while True:
+                tick = asyncio.get_running_loop().time()
+                await asyncio.sleep(0.01)
+                gaps.append(asyncio.get_running_loop().time() - tick)
+
+        ticker = asyncio.ensure_future(heartbeat())
+
+        for process in list(broken._processes.values()):
+            process.kill()
+            process.join()
+
+        lost = await parser.parse_product_data(http_response)
+        restarted = parser.executor
+        product = await parser.parse_product_data(http_response)
+        ticker.cancel()
+
+        return lost, restarted, product, max(gaps)
+
+    try:
+        lost, restarted, product, lag = asyncio.run(parse_after_crash())
+    finally:
+        parser.close()
+
+    assert lost is None
+    assert restarted is not None and restarted is not broken
+    assert restarted._mp_context.get_start_method() == "spawn"
+    assert product == expected_product("in_stock.html")
+    assert lag < 0.25
@@ -0,0 +1,70 @@
+import asyncio, sqlite3
+import pytest
+from db.db import HOT_QUERIES, SCHEMA_MIGRATIONS
+
+
+# Every statement on a hot lookup path must be answered from an index, a full table scan fails the test
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_uses_an_index(database, name):
+
+    async def plan_scans():
+        try:
+            await database.create_tables()
+            return await database.query_plan_scans({name: HOT_QUERIES[name]})
+        finally:
+            await database.close()
+
+    assert asyncio.run(plan_scans()) == {}
+
+
+def test_verify_query_plans_reports_a_missing_index(database):
+
+    async def plan_scans():
+        try:
+            await database.create_tables()
+
+            async with database.connection() as db:
+                await db.execute('DROP INDEX idx_usertoasin_asin_target')
+
+            return await database.query_plan_scans(), await database.verify_query_plans()
+        finally:
+            await database.close()
+
+    scans, valid = asyncio.run(plan_scans())
+
+    assert {"notify_users", "enqueue_alerts", "mark_notified"} <= set(scans)
+    assert not valid
+
+
+# A database created by the version before the migrations, duplicate links included, is upgraded in place
+
+def test_migrations_upgrade_an_unversioned_database(database):
+
+    with sqlite3.connect(database.db_name) as db:
+
+        for statement in SCHEMA_MIGRATIONS[0]:
+            db.execute(statement)
+
+        db.execute("INSERT INTO User (chat_id) VALUES (1)")
+        db.execute("INSERT INTO ASIN (asin, title, last_price) VALUES ('B000000001', 'Product', 10.0)")
+        db.executemany("INSERT INTO UserToAsin (user_id, asin_id, target_price) VALUES (1, 1, ?)", [(9,), (8,)])
+
+    async def upgrade():
+        try:
+            await database.create_tables()
+            await database.create_tables()  # a second run finds nothing left to apply
+            return await database.query_plan_scans()
+        finally:
+            await database.close()
+
+    assert asyncio.run(upgrade()) == {}
+
+    with sqlite3.connect(database.db_name) as db:
+
+        assert db.execute("PRAGMA user_version").fetchone()[0] == len(SCHEMA_MIGRATIONS)
+        assert db.execute("SELECT target_price FROM UserToAsin").fetchall() == [(9,)]
+        assert db.execute("SELECT subscribers FROM ASIN").fetchone()[0] == 1
+
+        with pytest.raises(sqlite3.IntegrityError):
+            db.execute("INSERT INTO UserToAsin (user_id, asin_id, target_price) VALUES (1, 1, 7)")
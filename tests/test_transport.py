@@ -0,0 +1,53 @@
+import asyncio
+from scripts.client import TransportPool
+
+
+# Local stand-in keep-alive HTTP/1.1 server, answering every request after a short delay
+
+async def slow_server() -> asyncio.AbstractServer:
+
+    async def handle(reader, writer):
+
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                await asyncio.sleep(0.1)
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+# Five concurrent requests on a pool of two connections: both connections are in use while the other requests queue,
+# then both stay open and idle for reuse
+
+def test_summary_reports_connections_in_use():
+
+    async def run_requests():
+
+        server = await slow_server()
+        url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+        pool = TransportPool("test", (), 2)
+
+        async def get():
+            async with pool.request():
+                return (await pool.client.get(url, extensions = {"trace": pool.trace})).status_code
+
+        try:
+            requests = asyncio.gather(*[get() for _ in range(5)])
+            await asyncio.sleep(0.05)
+            busy = pool.connections()
+            statuses = await requests
+            return busy, statuses, pool.connections(), pool.summary()
+        finally:
+            await pool.client.aclose()
+            server.close()
+            await server.wait_closed()
+
+    busy, statuses, idle, summary = asyncio.run(run_requests())
+
+    assert busy == (2, 2)
+    assert statuses == [200] * 5
+    assert idle == (2, 0)
+    assert summary.startswith("test 0/2 conn in use (peak 2, 2 max) 0 active req (peak 5) 5 req 2 new conn 60% reuse")
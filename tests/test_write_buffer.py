@@ -0,0 +1,55 @@
+import asyncio, logging, sqlite3
+import db.db as db_module
+from db.db import DatabaseManager
+from scripts.pipeline import STOP, MonitorPipeline, StageStats
+from scripts.scraper import AmazonProduct
+from scripts.tracker import ProductTracker
+
+
+# A product whose title and price both changed: the threshold flush run by the title fails ("database is locked"),
+# the price must still be buffered and both updates written by the next flush, not lost behind the tracker
+
+def test_failed_threshold_flush_keeps_the_product_updates(database, monkeypatch):
+
+    monkeypatch.setattr(db_module, "WRITE_BUFFER_MAX_SIZE", 1)
+
+    transaction = DatabaseManager.transaction
+    failures = list()
+
+    def locked_once(self):
+        if failures:
+            raise failures.pop()
+        return transaction(self)
+
+    monkeypatch.setattr(DatabaseManager, "transaction", locked_once)
+
+    async def persist_new_scrape():
+        try:
+            await database.create_tables()
+            await database.add_asin("B0EXAMPLE1", title = "Old title", current_price = 40.0)
+
+            tracker = ProductTracker(logging.getLogger("tests"))
+            await tracker.load(database)
+
+            pipeline = MonitorPipeline(None, None, logging.getLogger("tests"), database, tracker)
+            pipeline.stats = {"persist": StageStats("persist")}
+
+            queue = asyncio.Queue()
+            await queue.put(("B0EXAMPLE1", AmazonProduct(url = "https://amazon.it/dp/B0EXAMPLE1", title = "New title", vendor = "Amazon",
+                                                         rating = "4,6", current_price = 35.0, availability = True)))
+            await queue.put(STOP)
+
+            failures.append(sqlite3.OperationalError("database is locked"))
+            changes = list()
+            await pipeline._persist_worker(queue, changes)
+            await database.flush_updates()
+
+            return pipeline.stats["persist"].errors, await database.get_asin_snapshots()
+        finally:
+            await database.close()
+
+    errors, snapshots = asyncio.run(persist_new_scrape())
+
+    assert not failures
+    assert errors == 0
+    assert snapshots == [("B0EXAMPLE1", "New title", 35.0)]